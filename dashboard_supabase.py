@@ -15,8 +15,15 @@ print(f"Python version: {sys.version}", flush=True)
 import os
 import re
 import time
+import threading
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+try:
+    # Контекст запуска скрипта для рабочих потоков: без него st.cache_data в потоке не видит сессию
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except Exception:
+    add_script_run_ctx = get_script_run_ctx = None
 
 _PLOTLY_STACK_ERROR = None
 try:
@@ -128,9 +135,15 @@ try:
         deal_stages,
         deal_stages_funnel,
         rejection_reasons,
-        ensure_cache_table,
+        migrate_cache_schema,
         cache_is_empty,
         get_responsible_id_to_name_map,
+        start_refresh_scheduler,
+        refresh_runs,
+        cache_generation,
+        pool_stats,
+        load_bundle,
+        compare,
     )
 except Exception as _e_data:
     _DATA_IMPORT_ERROR = _e_data
@@ -1581,19 +1594,31 @@ def _run_bounds_or_regions(fn, default):
         raise
 
 
-@st.cache_data(ttl=600, show_spinner=False)
-def _cached_bounds():
-    """Границы дат из БД. Кэш 10 мин — иначе каждый rerun 12–15 s."""
+# Кэши данных без TTL: ключ включает generation (kpi_cache_meta), поэтому результат живёт ровно до refresh.
+# max_entries ограничивает память — старые поколения и редкие фильтры вытесняются.
+_CACHE_MAX_ENTRIES = 256
+
+
+def _cache_generation():
+    """Поколение кэша для ключей st.cache_data. Без kpi_cache_meta — 10-минутная корзина (как прежний ttl)."""
+    engine = _engine()
+    generation = cache_generation(engine) if engine is not None else None
+    return generation if generation is not None else f"t{int(time.time() // 600)}"
+
+
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_bounds(generation=None):
+    """Границы дат из БД. Кэш до следующего refresh (generation) — иначе каждый rerun 12–15 s."""
     return _run_bounds_or_regions(date_bounds, None)
 
 
-@st.cache_data(ttl=600, show_spinner=False)
-def _cached_regions():
-    """Список регионов. Кэш 10 мин. Engine берётся внутри _run_bounds_or_regions (не в аргументах)."""
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_regions(generation=None):
+    """Список регионов. Кэш до следующего refresh. Engine берётся внутри _run_bounds_or_regions (не в аргументах)."""
     return _run_bounds_or_regions(region_list, [])
 
-@st.cache_data(ttl=600, show_spinner=False)
-def _cached_kpi(date_from_str, date_to_str, region_key=None, region_list=None):
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_kpi(date_from_str, date_to_str, region_key=None, region_list=None, generation=None):
     region_list = tuple(region_list) if region_list else None
     engine = _engine()
     if engine is None:
@@ -1602,8 +1627,21 @@ def _cached_kpi(date_from_str, date_to_str, region_key=None, region_list=None):
         return kpi_by_region(engine, date_from_str, date_to_str, list(region_list))
     return kpi_extended(engine, date_from_str, date_to_str, region=region_key if region_key and region_key != "Все" else None, region_list=region_list if (isinstance(region_list, (list, tuple)) and len(region_list) == 1) else None)
 
-@st.cache_data(ttl=600, show_spinner=False)
-def _cached_funnel(date_from_str, date_to_str, region_key=None, region_list=None):
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_kpi_compare(date_from_str, date_to_str, date_from_2_str, date_to_2_str, region_key=None, region_list=None, generation=None):
+    """KPI двух периодов одним statement (compare): m — Период 1, m_2 — Период 2. Только один регион / «Все»."""
+    region_list = tuple(region_list) if region_list else None
+    engine = _engine()
+    if engine is None:
+        return None
+    return compare(
+        engine, kpi_extended, (date_from_str, date_to_str), (date_from_2_str, date_to_2_str),
+        region=region_key if region_key and region_key != "Все" else None,
+        region_list=region_list if (isinstance(region_list, (list, tuple)) and len(region_list) == 1) else None,
+    )
+
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_funnel(date_from_str, date_to_str, region_key=None, region_list=None, generation=None):
     region_list = tuple(region_list) if region_list else None
     engine = _engine()
     if engine is None:
@@ -1633,8 +1671,8 @@ def _run_details_query(fn, *args, **kwargs):
         raise
 
 
-@st.cache_data(ttl=600, show_spinner=False)
-def _cached_managers(date_from_str, date_to_str, region_key=None, region_list=None):
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_managers(date_from_str, date_to_str, region_key=None, region_list=None, generation=None):
     region_list = tuple(region_list) if region_list else None
     return _run_details_query(
         top_managers, date_from_str, date_to_str,
@@ -1642,8 +1680,8 @@ def _cached_managers(date_from_str, date_to_str, region_key=None, region_list=No
         region_list=region_list, limit=10,
     )
 
-@st.cache_data(ttl=600, show_spinner=False)
-def _cached_daily(date_from_str, date_to_str, region_key=None, region_list=None):
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_daily(date_from_str, date_to_str, region_key=None, region_list=None, generation=None):
     region_list = tuple(region_list) if region_list else None
     engine = _engine()
     if engine is None:
@@ -1652,37 +1690,37 @@ def _cached_daily(date_from_str, date_to_str, region_key=None, region_list=None)
         return daily_series_by_region(engine, date_from_str, date_to_str, list(region_list))
     return daily_series(engine, date_from_str, date_to_str, region=region_key if region_key and region_key != "Все" else None, region_list=region_list if (isinstance(region_list, (list, tuple)) and len(region_list) == 1) else None)
 
-@st.cache_data(ttl=600, show_spinner=False)
-def _cached_by_region(date_from_str, date_to_str):
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_by_region(date_from_str, date_to_str, generation=None):
     engine = _engine()
     return by_region(engine, date_from_str, date_to_str) if engine is not None else pd.DataFrame()
 
-@st.cache_data(ttl=300, show_spinner=False)
-def _cached_by_utm(date_from_str, date_to_str, region_key=None, region_list=None):
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_by_utm(date_from_str, date_to_str, region_key=None, region_list=None, generation=None):
     region_list = tuple(region_list) if region_list else None
     engine = _engine()
     if engine is None:
         return pd.DataFrame()
     return by_utm(engine, date_from_str, date_to_str, region=region_key if region_key and region_key != "Все" else None, region_list=region_list, limit=25)
 
-@st.cache_data(ttl=600, show_spinner=False)
-def _cached_by_formname(date_from_str, date_to_str, region_key=None, region_list=None):
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_by_formname(date_from_str, date_to_str, region_key=None, region_list=None, generation=None):
     region_list = tuple(region_list) if region_list else None
     engine = _engine()
     if engine is None:
         return pd.DataFrame()
     return by_formname(engine, date_from_str, date_to_str, region=region_key if region_key and region_key != "Все" else None, region_list=region_list, limit=30)
 
-@st.cache_data(ttl=300, show_spinner=False)
-def _cached_by_landing(date_from_str, date_to_str, region_key=None, region_list=None):
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_by_landing(date_from_str, date_to_str, region_key=None, region_list=None, generation=None):
     region_list = tuple(region_list) if region_list else None
     engine = _engine()
     if engine is None:
         return pd.DataFrame()
     return by_landing(engine, date_from_str, date_to_str, region=region_key if region_key and region_key != "Все" else None, region_list=region_list, limit=30)
 
-@st.cache_data(ttl=600, show_spinner=False)
-def _cached_deal_stages(date_from_str, date_to_str, region_key=None, region_list=None):
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_deal_stages(date_from_str, date_to_str, region_key=None, region_list=None, generation=None):
     region_list = tuple(region_list) if region_list else None
     return _run_details_query(
         deal_stages, date_from_str, date_to_str,
@@ -1690,8 +1728,8 @@ def _cached_deal_stages(date_from_str, date_to_str, region_key=None, region_list
         region_list=region_list, limit=12,
     )
 
-@st.cache_data(ttl=600, show_spinner=False)
-def _cached_deal_stages_funnel(date_from_str, date_to_str, region_key=None, region_list=None):
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_deal_stages_funnel(date_from_str, date_to_str, region_key=None, region_list=None, generation=None):
     region_list = tuple(region_list) if region_list else None
     return _run_details_query(
         deal_stages_funnel, date_from_str, date_to_str,
@@ -1699,8 +1737,8 @@ def _cached_deal_stages_funnel(date_from_str, date_to_str, region_key=None, regi
         region_list=region_list,
     )
 
-@st.cache_data(ttl=600, show_spinner=False)
-def _cached_reject_reasons(date_from_str, date_to_str, region_key=None, region_list=None):
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_reject_reasons(date_from_str, date_to_str, region_key=None, region_list=None, generation=None):
     region_list = tuple(region_list) if region_list else None
     return _run_details_query(
         rejection_reasons, date_from_str, date_to_str,
@@ -1708,12 +1746,42 @@ def _cached_reject_reasons(date_from_str, date_to_str, region_key=None, region_l
         region_list=region_list, limit=15,
     )
 
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def _cached_bundle(date_from_str, date_to_str, region_key=None, region_list=None, parts=(), generation=None):
+    """Наборы фазы одним запросом к БД (load_bundle): {ключ: DataFrame} — те же ключи и данные, что у _cached_*."""
+    region_list = tuple(region_list) if region_list else None
+    engine = _engine()
+    if engine is None:
+        return None
+    return load_bundle(
+        engine, date_from_str, date_to_str, regions=region_list, parts=tuple(parts),
+        region=region_key if region_key and region_key != "Все" else None,
+    )
+
 @st.cache_resource(show_spinner=False)
 def _engine():
     """Один engine на процесс без принудительного прогрева соединения."""
     return get_engine()
 
 
+@st.cache_data(ttl=60, show_spinner=False)
+def _cached_refresh_runs(limit=10):
+    try:
+        return refresh_runs(_engine(), limit=limit)
+    except Exception:
+        return None
+
+
+@st.cache_resource(show_spinner=False)
+def _refresh_scheduler():
+    """Фоновый refresh кэша — один поток на процесс; между репликами refresh делает держатель advisory lock."""
+    try:
+        return start_refresh_scheduler(_engine())
+    except Exception as e:
+        print(f"[refresh] scheduler start failed: {e}", flush=True)
+        return None
+
+
 def _render_forma_block(block_name, gid, color, idx, subtitle="", chart_prefix="om"):
     """Отрисовка одного блока: заголовок → таблица → график (для ОМ и Источников)."""
     subtitle_html = f'<span style="font-size:0.8rem;color:#94A3B8;margin-left:1rem;">{subtitle}</span>' if subtitle else ""
@@ -1991,20 +2059,76 @@ def forma_ist_page():
                 _draw_forma_table_and_chart(blk["block_name"], blk["color"], idx, blk["html_table"], blk["chart_df"], "ist", blk["subtitle"])
 
 
-def _run_parallel_tasks(tasks, max_workers):
+# Сколько ждать одну задачу фазы 1/2 (с момента её старта); зависшая задача получает ошибку, остальные не ждут её
+PARALLEL_TASK_TIMEOUT_S = float(os.environ.get("DASHBOARD_TASK_TIMEOUT_S", "") or 90)
+
+
+def _db_pool_slots():
+    """Размер пула соединений дашборда: параллельных запросов больше него всё равно ждали бы соединение."""
+    engine = _engine()
+    return (pool_stats(engine).get("maxconn") if engine is not None else None) or 1
+
+
+def _run_parallel_tasks(tasks, max_workers, timeout_s=None):
     """
-    Выполняет задачи СЕКВЕНТАЛЬНО для избежания дедлоков Streamlit.
+    Параллельно выполняет задачи фаз 1/2 (обёртки st.cache_data над запросами к кэш-таблицам).
     tasks: список кортежей (key, func, args, kwargs)
-    Возвращает dict {key: result}
+    Возвращает dict {key: result}; при ошибке/таймауте — result None и key + "_error".
+
+    Рабочим потокам передаётся ScriptRunContext текущего запуска (add_script_run_ctx) — st.cache_data
+    в них работает как в основном потоке. Потоков не больше max_workers и размера пула соединений.
+    Таймаут — на задачу с момента её старта; зависший поток не прерывается (его запрос ограничен
+    statement_timeout), но результат больше не ждём. Без контекста Streamlit — последовательно, как раньше.
     """
     results = {}
-    for task in tasks:
-        key, func, args, kwargs = task
-        try:
-            results[key] = func(*args, **kwargs)
-        except Exception as e:
-            results[key] = None
-            results[key + "_error"] = str(e)[:500]
+    if not tasks:
+        return results
+    timeout_s = PARALLEL_TASK_TIMEOUT_S if timeout_s is None else timeout_s
+    ctx = get_script_run_ctx() if get_script_run_ctx is not None else None
+    workers = max(1, min(max_workers, len(tasks), _db_pool_slots()))
+    if ctx is None or workers == 1:
+        for key, func, args, kwargs in tasks:
+            try:
+                results[key] = func(*args, **kwargs)
+            except Exception as e:
+                results[key] = None
+                results[key + "_error"] = str(e)[:500]
+        return results
+
+    started = {}
+
+    def _one(key, func, args, kwargs):
+        started[key] = time.time()
+        return func(*args, **kwargs)
+
+    ex = ThreadPoolExecutor(
+        max_workers=workers,
+        thread_name_prefix="dash-task",
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+    )
+    futures = {ex.submit(_one, key, func, args, kwargs): key for key, func, args, kwargs in tasks}
+    pending = set(futures)
+    try:
+        while pending:
+            now = time.time()
+            for fut in [f for f in pending if futures[f] in started and now - started[futures[f]] > timeout_s]:
+                key = futures[fut]
+                pending.discard(fut)
+                results[key] = None
+                results[key + "_error"] = f"таймаут {timeout_s:.0f} с"
+                print(f"[TIMING] задача {key}: таймаут {timeout_s:.0f}s")
+            deadlines = [started[futures[f]] + timeout_s for f in pending if futures[f] in started]
+            wait_s = max(0.05, min(deadlines) - now) if deadlines else timeout_s
+            done, pending = wait(pending, timeout=wait_s, return_when=FIRST_COMPLETED)
+            for fut in done:
+                key = futures[fut]
+                try:
+                    results[key] = fut.result()
+                except Exception as e:
+                    results[key] = None
+                    results[key + "_error"] = str(e)[:500]
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
     return results
 
 
@@ -2038,6 +2162,22 @@ def _run_parallel_tasks_io(tasks, max_workers=6):
     return results
 
 
+def _load_phase(tasks, extra_tasks=(), max_workers=4):
+    """Наборы фазы (tasks: ключи = части load_bundle) — одним запросом через _cached_bundle с фильтрами первой задачи,
+    параллельно с extra_tasks (другой период и т.п.). Если пакетный запрос упал — tasks по отдельности, как раньше."""
+    _key, _func, args, kwargs = tasks[0]
+    bundle_task = ("bundle", _cached_bundle, args, {**kwargs, "parts": tuple(key for key, *_rest in tasks)})
+    out = _run_parallel_tasks([bundle_task, *extra_tasks], max_workers=max_workers)
+    bundle = out.pop("bundle", None)
+    error = out.pop("bundle_error", None)
+    if bundle is None:
+        print(f"[TIMING] load_bundle не удался ({error}) — загрузка по отдельности")
+        out.update(_run_parallel_tasks(tasks, max_workers=max_workers))
+    else:
+        out.update(bundle)
+    return out
+
+
 def _run_dashboard():
     """Весь контент основного дашборда (Supabase-данные, KPI, воронка и т.д.)."""
     t0 = time.time()
@@ -2054,13 +2194,14 @@ def _run_dashboard():
         )
         return
 
-    if "cache_tables_ensured" not in st.session_state:
-        st.session_state["cache_tables_ensured"] = True  # ставим до вызова — не повторять даже при ошибке
-        try:
-            ensure_cache_table(engine)
-        except Exception:
-            pass
-    print(f"[TIMING] после ensure_cache_table: {time.time() - t0:.2f}s")
+    # Версия схемы проверяется один раз на процесс; DDL — только если версия в базе устарела
+    try:
+        migrate_cache_schema(engine)
+    except Exception as e:
+        print(f"[migrate_cache_schema] ERROR: {e}")
+    print(f"[TIMING] после migrate_cache_schema: {time.time() - t0:.2f}s")
+    scheduler = _refresh_scheduler()
+    generation = _cache_generation()
 
     # Одна проверка на весь запуск: от неё зависят и debug, и сообщение «напрямую из таблицы»
     cache_empty = cache_is_empty(engine)
@@ -2068,8 +2209,8 @@ def _run_dashboard():
 
     try:
         with st.spinner("Загрузка…"):
-            bounds = _cached_bounds()
-            regions = _cached_regions()
+            bounds = _cached_bounds(generation)
+            regions = _cached_regions(generation)
         print(f"[TIMING] после bounds + regions: {time.time() - t0:.2f}s")
         if not isinstance(regions, list):
             regions = list(regions) if regions is not None else []
@@ -2227,6 +2368,36 @@ def _run_dashboard():
             region_key, region_list = None, tuple(selected_regions)
         compare_mode = region_list is not None and len(region_list) > 1
 
+        if scheduler is not None:
+            sched = scheduler.status()
+            if sched["running"]:
+                st.caption("Кэш: идёт обновление…")
+            elif sched["last_finished"]:
+                when = datetime.fromtimestamp(sched["last_finished"]).strftime("%H:%M")
+                if sched["last_ok"]:
+                    st.caption(f"Кэш обновлён в {when} ({sched['last_mode']}, {sched['last_duration_s']} с)")
+                else:
+                    st.caption(f"Кэш: ошибка обновления в {when}")
+
+        with st.expander("Журнал обновлений кэша", expanded=False):
+            runs = _cached_refresh_runs()
+            if runs is None or runs.empty:
+                st.caption("Запусков пока нет.")
+            else:
+                runs = runs.assign(
+                    started_at=runs["started_at"].dt.strftime("%d.%m %H:%M"),
+                    duration_s=(runs["duration_ms"] / 1000).round(1),
+                    status=runs["error"].isna().map({True: "ok", False: "ошибка"}),
+                )
+                st.dataframe(
+                    runs[["started_at", "mode", "duration_s", "rows", "retries", "status"]],
+                    hide_index=True,
+                    use_container_width=True,
+                )
+                failed = runs[runs["error"].notna()]
+                if not failed.empty:
+                    st.caption(f"Последняя ошибка: {failed['error'].iloc[0][:300]}")
+
     date_from_str = date_from_1.isoformat() if hasattr(date_from_1, "isoformat") else str(date_from_1)
     date_to_str = date_to_1.isoformat() if hasattr(date_to_1, "isoformat") else str(date_to_1)
     date_from_2_str = date_to_2_str = None
@@ -2245,6 +2416,7 @@ def _run_dashboard():
             date_to_2_str,
             region_key,
             tuple(region_list) if region_list else None,
+            generation,
         )
 
         loaded = None
@@ -2263,16 +2435,17 @@ def _run_dashboard():
             t_phase1 = time.time()
             with st.spinner("Загружаю данные…"):
                 phase1_tasks = [
-                    ("kpi", _cached_kpi, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list}),
-                    ("funnel", _cached_funnel, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list}),
-                    ("daily", _cached_daily, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list}),
-                    ("by_region", _cached_by_region, (date_from_str, date_to_str), {}),
+                    ("kpi", _cached_kpi, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list, "generation": generation}),
+                    ("funnel", _cached_funnel, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list, "generation": generation}),
+                    ("daily", _cached_daily, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list, "generation": generation}),
+                    ("by_region", _cached_by_region, (date_from_str, date_to_str), {"generation": generation}),
                 ]
+                extra_tasks = []
                 if (not compare_mode) and date_from_2_str and date_to_2_str:
-                    phase1_tasks.append(
-                        ("kpi2", _cached_kpi, (date_from_2_str, date_to_2_str), {"region_key": region_key, "region_list": region_list}),
+                    extra_tasks.append(
+                        ("kpi2", _cached_kpi_compare, (date_from_str, date_to_str, date_from_2_str, date_to_2_str), {"region_key": region_key, "region_list": region_list, "generation": generation}),
                     )
-                out = _run_parallel_tasks(phase1_tasks, max_workers=4)
+                out = _load_phase(phase1_tasks, extra_tasks, max_workers=4)
                 loaded = out
                 print(f"[TIMING] phase1 параллельная загрузка (kpi/funnel/daily/by_region): {time.time() - t_phase1:.2f}s")
                 st.session_state["last_loaded_filters_key"] = filters_key
@@ -2379,9 +2552,9 @@ def _run_dashboard():
         sdelki = int(row.get("sdelki", 0) or 0)
         kommissii = float(row.get("komissi", 0) or 0)
 
-        # Если выбран Период 2 — считаем дельты по нему
+        # Если выбран Период 2 — считаем дельты по нему (kpi2 — compare: колонки Периода 2 с суффиксом _2)
         if kpi2 is not None and isinstance(kpi2, pd.DataFrame) and not kpi2.empty:
-            prev_row = kpi2.iloc[0]
+            prev_row = pd.Series({c[: -len("_2")]: v for c, v in kpi2.iloc[0].items() if c.endswith("_2")})
             delta_leads = leads - int(prev_row.get("leads", 0) or 0)
             delta_quals = quals - int(prev_row.get("quals", 0) or 0)
             delta_prequals = prequals - int(prev_row.get("prequals", 0) or 0)
@@ -2612,16 +2785,16 @@ def _run_dashboard():
     )
     if phase2_should_run:
         phase2_tasks = [
-            ("utm", _cached_by_utm, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list}),
-            ("landing", _cached_by_landing, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list}),
-            ("by_formname", _cached_by_formname, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list}),
-            ("managers", _cached_managers, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list}),
-            ("stages_funnel", _cached_deal_stages_funnel, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list}),
-            ("reject_reasons", _cached_reject_reasons, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list}),
+            ("utm", _cached_by_utm, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list, "generation": generation}),
+            ("landing", _cached_by_landing, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list, "generation": generation}),
+            ("by_formname", _cached_by_formname, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list, "generation": generation}),
+            ("managers", _cached_managers, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list, "generation": generation}),
+            ("stages_funnel", _cached_deal_stages_funnel, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list, "generation": generation}),
+            ("reject_reasons", _cached_reject_reasons, (date_from_str, date_to_str), {"region_key": region_key, "region_list": region_list, "generation": generation}),
         ]
         t_phase2 = time.time()
         with st.spinner("Загружаю детали…"):
-            phase2_results = _run_parallel_tasks(phase2_tasks, max_workers=6)
+            phase2_results = _load_phase(phase2_tasks, max_workers=6)
             base = dict(st.session_state.get("last_loaded_data") or {})
             base.update(phase2_results)
             st.session_state["last_loaded_data"] = base
@@ -2847,7 +3020,7 @@ def _run_dashboard():
         with tab_region:
             df_region = loaded.get("by_region")
             if df_region is None or (isinstance(df_region, pd.DataFrame) and df_region.empty):
-                df_region = _cached_by_region(date_from_str, date_to_str)
+                df_region = _cached_by_region(date_from_str, date_to_str, generation=generation)
             if df_region is not None and not df_region.empty:
                 rename_map = {"region": "Регион", "leads": "Лиды", "prequals": "Предквалы", "quals": "Квалы"}
                 region_cols = [c for c in ["region", "leads", "prequals", "quals"] if c in df_region.columns]
@@ -7,10 +7,11 @@
 
 ОСНОВНАЯ ТАБЛИЦА (сырьё для ETL, не для чтения дашборда):
   public."For dash" — лиды из AmoCRM. Дашборд к ней не обращается.
-  Заливка кэшей: refresh_kpi_daily_region() и INSERT_* в этом файле — они читают «For dash».
+  Заливка кэшей: refresh_kpi_daily_region() — читает «For dash».
+  Refresh идёт через _single_pass_refresh_sql(): один скан «For dash» на все кэш-таблицы.
 
 ДАШБОРД — ТОЛЬКО КЭШ-ТАБЛИЦЫ:
-  • kpi_daily_region — KPI, воронка, динамика по дням, by_region
+  • kpi_daily_region — KPI, воронка, динамика по дням, by_region (одна строка на регион×день)
   • kpi_cache_managers — топ брокеров
   • kpi_cache_stages — этапы сделок
   • kpi_cache_reasons — причины отказа
@@ -23,13 +24,61 @@
 
 АРХИТЕКТУРА КЭША:
   - kpi_daily_region и остальные кэши обновляются через refresh_kpi_daily_region() (раз в 10–15 мин или по кнопке).
+    Периодически — start_refresh_scheduler() (только при KPI_REFRESH_SCHEDULER=1): фоновый поток в процессе
+    дашборда, инкремент каждый тик и полный refresh раз в KPI_REFRESH_FULL_INTERVAL_S (сутки); из нескольких
+    реплик refresh выполняет только держатель pg_advisory_lock. Та же блокировка — у ручных запусков любого режима
+    (full/incremental/parallel/chunked/monthly): пока идёт один, остальные сразу возвращают (False, REFRESH_BUSY).
+    mode="incremental" пересчитывает только дни, затронутые лидами с updated_at > watermark (kpi_cache_meta);
+    mode="full" — полная перезаливка в теневые таблицы (<table>__next) с атомарной подменой live-таблиц,
+    поэтому читатели никогда не видят пустой или частично залитый кэш.
+    refresh_kpi_daily_region_parallel() — то же, но «For dash» сканируется один раз в промежуточную таблицу,
+    а кэш-таблицы заливаются из неё параллельно на нескольких соединениях;
+    refresh_kpi_daily_region_monthly() — по месяцам в свои теневые <table>__monthly, с возобновлением
+    после сбоя (kpi_refresh_progress, run_id запуска).
+    Каждый запуск (режим, шаги, время, строки, повторы, ошибка) пишется в kpi_refresh_log — refresh_runs().
+  - Refresh увеличивает kpi_cache_meta.generation; UI включает cache_generation() в ключи st.cache_data,
+    поэтому кэш Streamlit живёт ровно до следующего refresh, без слепого TTL.
+  - Там же refresh хранит min/max day, список регионов и число строк по кэш-таблицам: date_bounds(),
+    region_list() и cache_is_empty() читают одну строку meta (cache_meta()) вместо агрегатов.
+  - kpi_cache_utm/landing/formnames/stages/reasons хранят измерения как INT id; сами строки — в справочниках
+    kpi_dim_<dim> (новые значения получают id в том же statement refresh). Запросы группируют по id и
+    подтягивают имена только для итоговых top-K строк. Регион — тоже справочник (kpi_dim_region): region_id есть
+    во всех кэш-таблицах, фильтры по региону — region_id = ANY(:region_ids) по индексам (region_id, day).
+  - Индексы кэш-таблиц — покрывающие (_CACHE_INDEXES: ключ под предикат, INCLUDE — читаемые колонки);
+    после refresh фоновый VACUUM переписанных таблиц/секций, чтение — Index Only Scan.
+    Проверка планов — explain_cache_indexes(engine).
+  - Семь кэш-таблиц секционированы по месяцам day (PARTITION BY RANGE; <table>_pYYYYMM с KPI_PARTITION_START
+    по следующий месяц, остальное — <table>_default): запросы по диапазону дат читают только свои секции.
+    mode="incremental" пересобирает затронутые месяцы целиком в новые секции (и теневые накопительную/свёртки),
+    затем подменяет их DETACH/ATTACH и rename одной короткой транзакцией вместе с meta — ACCESS EXCLUSIVE
+    на живых таблицах не ждёт конца пересчёта, а читатели не видят смеси поколений.
+  - Фаза 1 (kpi_extended, kpi_by_region, funnel_*, daily_series*, by_region, deal_stages_funnel) считается
+    из куба kpi_daily_region в памяти (_KpiCube), загружаемого один раз на поколение кэша.
+    Без куба kpi_extended/kpi_by_region читают kpi_daily_region_cum: любой диапазон — два lookup по дню.
+  - load_bundle(engine, date_from, date_to, regions, parts) — наборы фазы 1 или 2 одним statement
+    (подзапрос json_agg на набор); функции чтения строят _SqlPlan, который можно выполнить и по отдельности.
+  - compare(engine, fn, period1, period2, ...) — два периода одним statement: источники периодов помечаются
+    (p=1/2, с rollup по неделям/месяцам) и агрегируются условно; колонки m, m_2, m_delta.
+  - Ряды по дням и детальные разбивки без куба идут через сегментный кэш процесса (KPI_SEGMENT_CACHE=0 — выключить):
+    строки за день / полный месяц по (fn, регионы) до смены поколения; из БД дочитываются только недостающие блоки.
+  - Схема кэша версионируется (kpi_schema_version, CACHE_SCHEMA_VERSION): migrate_cache_schema() сверяет версию
+    один раз на процесс и применяет DDL ensure_cache_table() только при её смене.
+  - Соединения: get_engine()/get_direct_engine() держат пул (_ConnectionPool); run_sql, DDL и refresh
+    берут соединение из пула, а не открывают новое на каждый запрос. Статистика — pool_stats(engine).
+    Одинаковые одновременные запросы run_sql склеиваются (singleflight): в БД идёт один, остальные ждут его.
 """
+import inspect
+import json
 import os
+import random
 import re
 import time
 import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 try:
     from dotenv import load_dotenv
@@ -37,8 +86,20 @@ try:
 except ImportError:
     pass
 
+import numpy as np
 import pandas as pd
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.pool
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, "") or default)
+    except ValueError:
+        return default
+
 
 # ── Основные константы ────────────────────────────────────────────────────────
 TABLE       = '"For dash"'
@@ -49,8 +110,45 @@ CACHE_REASONS  = "public.kpi_cache_reasons"
 CACHE_FORMNAMES = "public.kpi_cache_formnames"
 CACHE_UTM = "public.kpi_cache_utm"
 CACHE_LANDING = "public.kpi_cache_landing"
+CACHE_CUM = "public.kpi_daily_region_cum"
+# Служебная однострочная таблица кэша: watermark источника, время/режим последнего refresh
+CACHE_META = "public.kpi_cache_meta"
+REFRESH_PROGRESS = "public.kpi_refresh_progress"
+REFRESH_LOG = "public.kpi_refresh_log"
+# Префикс промежуточной (UNLOGGED) таблицы параллельного refresh: срез «For dash» на время одного запуска
+REFRESH_SOURCE_PREFIX = "public.kpi_refresh_src_"
+# Версия схемы кэша, применённая к базе (см. migrate_cache_schema)
+SCHEMA_VERSION_TABLE = "public.kpi_schema_version"
+# Увеличивать при любом изменении DDL кэш-таблиц, справочников, meta/log/progress
+CACHE_SCHEMA_VERSION = 2
+# Сколько дней хранить журнал refresh
+REFRESH_LOG_RETENTION_DAYS = 30
 # Ключ строки в "For dash": id или lead_id (в Supabase часто lead_id)
 PK_COLUMN   = "lead_id"
+# Время последнего изменения лида в "For dash" — по нему инкрементальный refresh ищет затронутые дни
+SOURCE_UPDATED_COLUMN = "updated_at"
+# Прерванная помесячная пересборка старше N часов не продолжается, а начинается заново (теневые копии устарели)
+REFRESH_RESUME_MAX_AGE_H = _env_int("KPI_REFRESH_RESUME_MAX_AGE_H", 24)
+# Инкрементальный refresh всегда пересчитывает и последние N дней (страховка от сдвига дат у лида)
+INCREMENTAL_LOOKBACK_DAYS = 2
+# Сколько соединений параллельно заливают кэш-таблицы в refresh_kpi_daily_region_parallel()
+REFRESH_PARALLELISM = _env_int("KPI_REFRESH_PARALLELISM", 3)
+# Фоновый refresh в процессе дашборда — только по явному KPI_REFRESH_SCHEDULER=1 (обычно refresh делает внешний job)
+REFRESH_SCHEDULER_ENABLED = os.environ.get("KPI_REFRESH_SCHEDULER", "0") == "1"
+# Его интервал: базовый + случайная добавка (реплики не стартуют синхронно); 0 — выключен
+REFRESH_INTERVAL_S = _env_int("KPI_REFRESH_INTERVAL_S", 600)
+REFRESH_JITTER_S = _env_int("KPI_REFRESH_JITTER_S", 300)
+# Полный фоновый refresh — если последний успешный полный (kpi_refresh_log) старше N секунд
+# (инкремент не видит удалённых лидов); по умолчанию раз в сутки, 0 — только инкремент
+REFRESH_FULL_INTERVAL_S = _env_int("KPI_REFRESH_FULL_INTERVAL_S", 86400)
+# Ключ pg_advisory_lock: refresh (любой режим) в один момент выполняет только одно соединение
+REFRESH_LOCK_KEY = 7_240_117_001
+# Ошибка refresh, если блокировка занята: другой refresh ещё идёт
+REFRESH_BUSY = "refresh уже выполняется (pg_advisory_lock занят другим процессом)"
+# Ключ pg_advisory_xact_lock миграции схемы: DDL применяет один процесс, остальные ждут и видят новую версию
+SCHEMA_LOCK_KEY = 7_240_117_002
+# Кэш-таблицы секционированы по месяцам day: партиции с этого месяца по следующий за текущим, остальное — в DEFAULT
+CACHE_PARTITION_START = datetime.strptime(os.environ.get("KPI_PARTITION_START", "") or "2022-01-01", "%Y-%m-%d").date().replace(day=1)
 
 REGION_EXPR = "COALESCE(NULLIF(TRIM(t.region_kvalifikacii), ''), NULLIF(TRIM(t.direction), ''), NULLIF(TRIM(t.region_klienta), ''))"
 REGION_EXPR_NO_ALIAS = "COALESCE(NULLIF(TRIM(region_kvalifikacii), ''), NULLIF(TRIM(direction), ''), NULLIF(TRIM(region_klienta), ''))"
@@ -215,6 +313,7 @@ def _empty_funnel_stages_df():
 # ── Engine ────────────────────────────────────────────────────────────────────
 # Один psycopg2 pool на процесс. На этом окружении transaction pooler :6543
 # рвёт SSL, поэтому локально принудительно используем session pooler :5432.
+# Размер пулов: SUPABASE_POOL_SIZE (дашборд) и SUPABASE_DIRECT_POOL_SIZE (refresh).
 _engine_instance = None
 _direct_engine_instance = None
 
@@ -246,23 +345,267 @@ def _connect_kwargs_from_url(url: str, statement_timeout_ms: int) -> dict:
     }
 
 
-def _new_engine_config(url: str, statement_timeout_ms: int):
-    return {"connect_kwargs": _connect_kwargs_from_url(url, statement_timeout_ms=statement_timeout_ms)}
+class _ConnectionPool:
+    """Потокобезопасный пул psycopg2-соединений одного engine.
+
+    Ограничен maxconn; при выдаче соединение, простоявшее дольше health_check_after_s,
+    проверяется SELECT 1; простаивающие дольше max_idle_s и живущие дольше max_lifetime_s
+    закрываются (pooler Supabase сам рвёт старые сессии). stats() — счётчики пула.
+    """
+
+    def __init__(self, connect_kwargs, maxconn=5, max_idle_s=300, max_lifetime_s=1800,
+                 health_check_after_s=30, checkout_timeout_s=30):
+        self._connect_kwargs = connect_kwargs
+        self.maxconn = max(1, int(maxconn))
+        self.max_idle_s = max_idle_s
+        self.max_lifetime_s = max_lifetime_s
+        self.health_check_after_s = health_check_after_s
+        self.checkout_timeout_s = checkout_timeout_s
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []  # [(conn, created_ts, last_used_ts)] — LIFO: берём самое «тёплое»
+        self._born = {}  # id(conn) -> created_ts для выданных соединений
+        self._total = 0
+        self._stats = {
+            "created": 0,
+            "closed": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "health_checks": 0,
+            "health_check_failures": 0,
+            "recycled": 0,
+            "discarded": 0,
+        }
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _expired(self, created, last_used, now):
+        return (now - last_used) > self.max_idle_s or (now - created) > self.max_lifetime_s
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        deadline = time.time() + self.checkout_timeout_s
+        while True:
+            candidate = None
+            create = False
+            with self._cond:
+                while True:
+                    now = time.time()
+                    while self._idle:
+                        conn, created, last_used = self._idle.pop()
+                        if conn.closed or self._expired(created, last_used, now):
+                            self._total -= 1
+                            self._stats["recycled"] += 1
+                            self._stats["closed"] += 1
+                            self._close_quietly(conn)
+                            continue
+                        candidate = (conn, created, last_used)
+                        break
+                    if candidate is not None:
+                        break
+                    if self._total < self.maxconn:
+                        self._total += 1  # резервируем слот; connect — вне блокировки
+                        create = True
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise psycopg2.pool.PoolError(
+                            f"connection pool exhausted: {self.maxconn} in use > {self.checkout_timeout_s}s"
+                        )
+                    self._stats["waits"] += 1
+                    self._cond.wait(remaining)
+                self._stats["checkouts"] += 1
+            if create:
+                try:
+                    conn = psycopg2.connect(**self._connect_kwargs)
+                except Exception:
+                    with self._cond:
+                        self._total -= 1
+                        self._stats["checkouts"] -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._stats["created"] += 1
+                    self._born[id(conn)] = time.time()
+                return conn
+            conn, created, last_used = candidate
+            if time.time() - last_used > self.health_check_after_s:
+                with self._cond:
+                    self._stats["health_checks"] += 1
+                if not self._healthy(conn):
+                    self._close_quietly(conn)
+                    with self._cond:
+                        self._total -= 1
+                        self._stats["checkouts"] -= 1
+                        self._stats["health_check_failures"] += 1
+                        self._stats["closed"] += 1
+                        self._cond.notify()
+                    continue
+            with self._cond:
+                self._born[id(conn)] = created
+            return conn
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        else:
+            discard = True
+        with self._cond:
+            created = self._born.pop(id(conn), time.time())
+            if discard:
+                self._total -= 1
+                self._stats["discarded"] += 1
+                self._stats["closed"] += 1
+            else:
+                self._idle.append((conn, created, time.time()))
+            self._cond.notify()
+        if discard:
+            self._close_quietly(conn)
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._total -= len(idle)
+            self._stats["closed"] += len(idle)
+        for conn, _, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                **self._stats,
+                "maxconn": self.maxconn,
+                "open": self._total,
+                "idle": len(self._idle),
+                "in_use": self._total - len(self._idle),
+            }
+
+
+def _new_engine_config(url: str, statement_timeout_ms: int, maxconn: int = 5):
+    connect_kwargs = _connect_kwargs_from_url(url, statement_timeout_ms=statement_timeout_ms)
+    return {
+        "connect_kwargs": connect_kwargs,
+        "pool": _ConnectionPool(
+            connect_kwargs,
+            maxconn=maxconn,
+            max_idle_s=_env_int("SUPABASE_POOL_MAX_IDLE_S", 300),
+            max_lifetime_s=_env_int("SUPABASE_POOL_MAX_LIFETIME_S", 1800),
+        ),
+    }
 
 
 def _connect_once(engine):
     return psycopg2.connect(**engine["connect_kwargs"])
 
 
+@contextmanager
+def _pooled_connection(engine):
+    """Соединение из пула engine. Обрыв (OperationalError/InterfaceError) — соединение выбрасывается,
+    прочие ошибки — rollback и возврат в пул."""
+    pool = engine.get("pool") if isinstance(engine, dict) else None
+    if pool is None:
+        conn = _connect_once(engine)
+        try:
+            yield conn
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        return
+    conn = pool.getconn()
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        pool.putconn(conn, discard=True)
+        raise
+    except BaseException:
+        pool.putconn(conn)
+        raise
+    else:
+        pool.putconn(conn)
+
+
+def pool_stats(engine) -> dict:
+    """Счётчики пула соединений engine (created/closed/checkouts/waits/in_use/idle...)."""
+    pool = engine.get("pool") if isinstance(engine, dict) else None
+    return pool.stats() if pool is not None else {}
+
+
+# OID типов Postgres (cursor.description[i].type_code) → колоночные numpy-типы
+_PG_INT_OIDS = {20, 21, 23, 26}           # int8, int2, int4, oid
+_PG_FLOAT_OIDS = {700, 701, 1700}         # float4, float8, numeric (SUM по NUMERIC/bigint)
+_PG_BOOL_OIDS = {16}
+_PG_DATE_OIDS = {1082, 1114}              # date, timestamp
+_PG_TIMESTAMPTZ_OIDS = {1184}
+_PG_TEXT_OIDS = {19, 25, 1042, 1043}      # name, text, bpchar, varchar
+# category только там, где строки реально повторяются (детальные кэши, day×region), иначе object
+_CATEGORY_MIN_ROWS = 32
+_CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+
+def _typed_column(values, type_code):
+    """Колонка результата → numpy/pandas-массив по OID типа.
+    Числа с NULL остаются object (None), чтобы не превращать «нет данных» в NaN незаметно."""
+    n = len(values)
+    if type_code in _PG_INT_OIDS or type_code in _PG_FLOAT_OIDS or type_code in _PG_BOOL_OIDS:
+        if any(v is None for v in values):
+            return np.array(values, dtype=object)
+        if type_code in _PG_INT_OIDS:
+            return np.fromiter(values, dtype=np.int64, count=n)
+        if type_code in _PG_BOOL_OIDS:
+            return np.fromiter(values, dtype=bool, count=n)
+        return np.fromiter((float(v) for v in values), dtype=np.float64, count=n)
+    if type_code in _PG_DATE_OIDS:
+        return pd.to_datetime(pd.Series(values, dtype=object)).to_numpy()
+    if type_code in _PG_TIMESTAMPTZ_OIDS:
+        return pd.to_datetime(pd.Series(values, dtype=object), utc=True).dt.tz_convert("Europe/Moscow").array
+    if type_code in _PG_TEXT_OIDS and n >= _CATEGORY_MIN_ROWS:
+        col = pd.Series(values, dtype=object)
+        if col.nunique(dropna=True) <= n * _CATEGORY_MAX_UNIQUE_RATIO:
+            return pd.Categorical(col)
+        return col.to_numpy()
+    # Через Series: массивы/JSON (list, dict) остаются значениями ячеек, а не новой размерностью
+    return pd.Series(values, dtype=object).to_numpy() if n else np.empty(0, dtype=object)
+
+
+_NAMED_PARAM_RE = re.compile(r"(?<!:):([A-Za-z_][A-Za-z0-9_]*)")
+
+
 def _fetch_df(conn, sql: str, params=None) -> pd.DataFrame:
-    sql = re.sub(r"(?<!:):([A-Za-z_][A-Za-z0-9_]*)", r"%(\1)s", sql)
+    sql = _NAMED_PARAM_RE.sub(r"%(\1)s", sql)
     with conn.cursor() as cur:
         cur.execute(sql, params or {})
         if cur.description is None:
             return pd.DataFrame()
         columns = [desc[0] for desc in cur.description]
+        type_codes = [desc[1] for desc in cur.description]
         rows = cur.fetchall()
-    return pd.DataFrame(rows, columns=columns)
+    col_values = list(zip(*rows)) if rows else [()] * len(columns)
+    data = {i: _typed_column(list(vals), oid) for i, (vals, oid) in enumerate(zip(col_values, type_codes))}
+    df = pd.DataFrame(data)
+    df.columns = columns
+    return df
 
 
 def get_engine():
@@ -273,7 +616,9 @@ def get_engine():
     url = _normalize_db_url(os.environ.get("SUPABASE_DB_URL", ""), prefer_session_pooler=True)
     if not url:
         return None
-    _engine_instance = _new_engine_config(url, statement_timeout_ms=120000)
+    _engine_instance = _new_engine_config(
+        url, statement_timeout_ms=120000, maxconn=_env_int("SUPABASE_POOL_SIZE", 5)
+    )
     return _engine_instance
 
 
@@ -285,39 +630,97 @@ def get_direct_engine():
     url = _normalize_db_url(os.environ.get("SUPABASE_DIRECT_URL", ""), prefer_session_pooler=False)
     if not url:
         return None
-    _direct_engine_instance = _new_engine_config(url, statement_timeout_ms=600000)
+    _direct_engine_instance = _new_engine_config(
+        url, statement_timeout_ms=600000, maxconn=_env_int("SUPABASE_DIRECT_POOL_SIZE", 4)
+    )
     return _direct_engine_instance
 
 
-def run_sql(engine, sql: str, params=None) -> pd.DataFrame:
-    """Выполняет SQL через отдельное короткоживущее psycopg2 соединение."""
+def _run_sql_once(engine, sql: str, params=None) -> pd.DataFrame:
     last_err = None
     for attempt in range(3):
-        conn = None
         try:
-            conn = _connect_once(engine)
-            df = _fetch_df(conn, sql, params=params)
-            conn.rollback()
-            conn.close()
+            with _pooled_connection(engine) as conn:
+                df = _fetch_df(conn, sql, params=params)
+                conn.rollback()
             return df
         except Exception as e:
             last_err = e
-            if conn is not None:
-                try:
-                    conn.rollback()
-                except Exception:
-                    pass
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-            if attempt < 2 and any(k in str(e).lower() for k in ("timed out", "timeout", "could not receive", "operationalerror", "ssl connection")):
+            if attempt < 2 and any(k in str(e).lower() for k in ("timed out", "timeout", "could not receive", "operationalerror", "ssl connection", "server closed")):
                 time.sleep(2 * (attempt + 1))
                 continue
             raise
     raise last_err
 
 
+class _InFlight:
+    """Выполняющийся запрос singleflight: ведомые ждут done и берут result/error ведущего."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_INFLIGHT_LOCK = threading.Lock()
+_INFLIGHT = {}
+_SINGLEFLIGHT_STATS = {"executed": 0, "coalesced": 0}
+
+
+def _freeze_param(value):
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = sorted(value, key=repr) if isinstance(value, (set, frozenset)) else value
+        return tuple(_freeze_param(v) for v in items)
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), _freeze_param(v)) for k, v in value.items()))
+    return value
+
+
+def _singleflight_key(engine, sql: str, params) -> tuple:
+    """engine + SQL без лишних пробелов и переносов + параметры (списки → кортежи, dict — по ключам)."""
+    return (id(engine), " ".join(sql.split()), repr(_freeze_param(params)))
+
+
+def run_sql(engine, sql: str, params=None) -> pd.DataFrame:
+    """Выполняет SQL на соединении из пула engine (без нового TCP/TLS/auth на каждый запрос).
+
+    Singleflight: одинаковые (_singleflight_key) запросы, пришедшие, пока такой же уже выполняется, в БД
+    не идут — ждут его и получают копию результата (или то же исключение). Утренний всплеск сессий
+    с одним фильтром по умолчанию и kpi/funnel одного рендера дают один запрос. Счётчики — singleflight_stats().
+    """
+    key = _singleflight_key(engine, sql, params)
+    with _INFLIGHT_LOCK:
+        flight = _INFLIGHT.get(key)
+        leader = flight is None
+        if leader:
+            flight = _INFLIGHT[key] = _InFlight()
+            _SINGLEFLIGHT_STATS["executed"] += 1
+        else:
+            _SINGLEFLIGHT_STATS["coalesced"] += 1
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result.copy()
+    try:
+        # Копия — вызывающему: исходный DataFrame остаётся нетронутым для ведомых
+        flight.result = _run_sql_once(engine, sql, params)
+        return flight.result.copy()
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(key, None)
+        flight.done.set()
+
+
+def singleflight_stats() -> dict:
+    """Сколько запросов run_sql ушло в БД (executed) и сколько дождались чужого результата (coalesced)."""
+    with _INFLIGHT_LOCK:
+        return {**_SINGLEFLIGHT_STATS, "in_flight": len(_INFLIGHT)}
+
+
 def get_responsible_id_to_name_map(engine) -> dict:
     """Возвращает словарь {responsible_user_id: responsible_name} из For dash.
 
@@ -411,10 +814,11 @@ def _funnel_stage_expr(col: str, region_cond: str = "") -> str:
 # КЭШИРУЮЩИЙ СЛОЙ: kpi_daily_region
 # ══════════════════════════════════════════════════════════════════════════════
 
-# Полная DDL кэша: таблица + индексы под все запросы дашборда
+# DDL кэш-таблиц; их индексы — в _CACHE_INDEXES (покрывающие, под запросы дашборда)
 DDL_CACHE_TABLE = f"""
 CREATE TABLE IF NOT EXISTS {CACHE_TABLE} (
   region          TEXT,
+  region_id       INT,
   day             DATE,
   leads           INT DEFAULT 0,
   prequals        INT DEFAULT 0,
@@ -426,10 +830,7 @@ CREATE TABLE IF NOT EXISTS {CACHE_TABLE} (
   deals           INT DEFAULT 0,
   commission      NUMERIC(18,2) DEFAULT 0,
   summa           NUMERIC(18,2) DEFAULT 0
-);
-CREATE INDEX IF NOT EXISTS idx_kpi_daily_region_day ON {CACHE_TABLE} (day);
-CREATE INDEX IF NOT EXISTS idx_kpi_daily_region_region_day ON {CACHE_TABLE} (region, day);
-CREATE INDEX IF NOT EXISTS idx_kpi_daily_region_day_region ON {CACHE_TABLE} (day, region);
+) PARTITION BY RANGE (day);
 """
 
 # Логика региона: тег «Первичные Сочи» → Сочи, иначе COALESCE по полям направления
@@ -448,44 +849,42 @@ QUAL_DATE_EXPR = "COALESCE(qualification_date_krym, qualification_date_sochi, qu
 DDL_CACHE_MANAGERS = f"""
 CREATE TABLE IF NOT EXISTS {CACHE_MANAGERS} (
   region       TEXT,
+  region_id    INT,
   day          DATE,
   broker_id    BIGINT,
   broker_name  TEXT,
   leads        INT DEFAULT 0,
   prequals     INT DEFAULT 0,
   quals        INT DEFAULT 0
-);
-CREATE INDEX IF NOT EXISTS idx_kpi_cache_managers_day ON {CACHE_MANAGERS} (day);
-CREATE INDEX IF NOT EXISTS idx_kpi_cache_managers_region_day ON {CACHE_MANAGERS} (region, day);
+) PARTITION BY RANGE (day);
 """
 
 DDL_CACHE_STAGES = f"""
 CREATE TABLE IF NOT EXISTS {CACHE_STAGES} (
-  region  TEXT,
-  day     DATE,
-  stage   TEXT,
-  cnt     INT DEFAULT 0
-);
-CREATE INDEX IF NOT EXISTS idx_kpi_cache_stages_day ON {CACHE_STAGES} (day);
-CREATE INDEX IF NOT EXISTS idx_kpi_cache_stages_region_day ON {CACHE_STAGES} (region, day);
+  region    TEXT,
+  region_id INT,
+  day       DATE,
+  stage_id  INT,
+  cnt       INT DEFAULT 0
+) PARTITION BY RANGE (day);
 """
 
 DDL_CACHE_REASONS = f"""
 CREATE TABLE IF NOT EXISTS {CACHE_REASONS} (
-  region  TEXT,
-  day     DATE,
-  reason  TEXT,
-  cnt     INT DEFAULT 0
-);
-CREATE INDEX IF NOT EXISTS idx_kpi_cache_reasons_day ON {CACHE_REASONS} (day);
-CREATE INDEX IF NOT EXISTS idx_kpi_cache_reasons_region_day ON {CACHE_REASONS} (region, day);
+  region     TEXT,
+  region_id  INT,
+  day        DATE,
+  reason_id  INT,
+  cnt        INT DEFAULT 0
+) PARTITION BY RANGE (day);
 """
 
 DDL_CACHE_FORMNAMES = f"""
 CREATE TABLE IF NOT EXISTS {CACHE_FORMNAMES} (
   region          TEXT,
+  region_id       INT,
   day             DATE,
-  formname        TEXT,
+  formname_id     INT,
   leads           INT DEFAULT 0,
   quals           INT DEFAULT 0,
   prequals        INT DEFAULT 0,
@@ -493,29 +892,28 @@ CREATE TABLE IF NOT EXISTS {CACHE_FORMNAMES} (
   pokaz_naznachen INT DEFAULT 0,
   pokaz_proveden  INT DEFAULT 0,
   broni           INT DEFAULT 0
-);
-CREATE INDEX IF NOT EXISTS idx_kpi_cache_formnames_region_day ON {CACHE_FORMNAMES} (region, day);
+) PARTITION BY RANGE (day);
 """
 
 DDL_CACHE_UTM = f"""
 CREATE TABLE IF NOT EXISTS {CACHE_UTM} (
-  region       TEXT,
-  day          DATE,
-  event_type   TEXT,
-  utm_source   TEXT,
-  utm_medium   TEXT,
-  utm_campaign TEXT,
-  cnt          INT DEFAULT 0
-);
-CREATE INDEX IF NOT EXISTS idx_kpi_cache_utm_day ON {CACHE_UTM} (day);
-CREATE INDEX IF NOT EXISTS idx_kpi_cache_utm_region_day ON {CACHE_UTM} (region, day);
+  region          TEXT,
+  region_id       INT,
+  day             DATE,
+  event_type      TEXT,
+  utm_source_id   INT,
+  utm_medium_id   INT,
+  utm_campaign_id INT,
+  cnt             INT DEFAULT 0
+) PARTITION BY RANGE (day);
 """
 
 DDL_CACHE_LANDING = f"""
 CREATE TABLE IF NOT EXISTS {CACHE_LANDING} (
   region          TEXT,
+  region_id       INT,
   day             DATE,
-  landing         TEXT,
+  landing_id      INT,
   leads           INT DEFAULT 0,
   prequals        INT DEFAULT 0,
   quals           INT DEFAULT 0,
@@ -523,322 +921,427 @@ CREATE TABLE IF NOT EXISTS {CACHE_LANDING} (
   pokaz_proveden  INT DEFAULT 0,
   passports       INT DEFAULT 0,
   broni_cnt       INT DEFAULT 0
-);
-CREATE INDEX IF NOT EXISTS idx_kpi_cache_landing_day ON {CACHE_LANDING} (day);
-CREATE INDEX IF NOT EXISTS idx_kpi_cache_landing_region_day ON {CACHE_LANDING} (region, day);
+) PARTITION BY RANGE (day);
 """
 
-_QUALS_FILTER_STR = (
-    "qualification_date IS NOT NULL OR qualification_date_krym IS NOT NULL "
-    "OR qualification_date_sochi IS NOT NULL OR qualification_date_anapa IS NOT NULL OR qualification_date_baku IS NOT NULL"
-)
+# Справочники измерений: длинные строки (UTM, посадочные, формы, этапы, причины) хранятся один раз,
+# кэш-таблицы держат только INT id. id выдаются при refresh и не меняются между генерациями кэша.
+# region — тоже справочник, но текст региона остаётся в строке (по нему группируют куб и by_region);
+# фильтры идут по region_id: имя → id один раз в Python (_region_ids), в SQL — region_id = ANY(:region_ids).
+DIMENSIONS = ("region", "formname", "landing", "utm_source", "utm_medium", "utm_campaign", "stage", "reason")
+_KEEP_TEXT_DIMENSIONS = ("region",)
+# Значения, которые INSERT'ы подставляют константой (регион квалы), а не берут из src
+_DIMENSION_FIXED_VALUES = {"region": tuple(ALLOWED_DIRECTIONS)}
+# кэш-таблица → её измерения (колонки <dim>_id)
+_TABLE_DIMENSIONS = {
+    CACHE_TABLE: ("region",),
+    CACHE_MANAGERS: ("region",),
+    CACHE_STAGES: ("region", "stage"),
+    CACHE_REASONS: ("region", "reason"),
+    CACHE_FORMNAMES: ("region", "formname"),
+    CACHE_UTM: ("region", "utm_source", "utm_medium", "utm_campaign"),
+    CACHE_LANDING: ("region", "landing"),
+}
 
-INSERT_CACHE_FORMNAMES = f"""
-INSERT INTO {CACHE_FORMNAMES} (region, day, formname, leads, quals, prequals, passports, pokaz_naznachen, pokaz_proveden, broni)
-SELECT
-  {REGION_SQL} AS region,
-  (lead_created_at AT TIME ZONE 'Europe/Moscow')::date AS day,
-  COALESCE(NULLIF(TRIM(formname), ''), '(пусто)') AS formname,
-  COUNT(*)::int AS leads,
-  COUNT(*) FILTER (WHERE {_QUALS_FILTER_STR})::int AS quals,
-  COUNT(*) FILTER (WHERE pre_qual_date IS NOT NULL)::int AS prequals,
-  COUNT(*) FILTER (WHERE pasport_poluchen IS NOT NULL)::int AS passports,
-  COUNT(*) FILTER (WHERE pokaz_naznachen IS NOT NULL)::int AS pokaz_naznachen,
-  COUNT(*) FILTER (WHERE pokaz_proveden IS NOT NULL OR pokaz_proveden_date IS NOT NULL)::int AS pokaz_proveden,
-  COUNT(*) FILTER (WHERE objekt_zabronirovan IS NOT NULL OR data_oplaty_broni_1 IS NOT NULL)::int AS broni
-FROM public."For dash"
-WHERE lead_created_at IS NOT NULL AND ({UTM_FILTER})
-GROUP BY 1, 2, 3;
-"""
 
-_LANDING_EXPR_SQL = "COALESCE(NULLIF(TRIM(SPLIT_PART(COALESCE(utm_referrer, referrer, ''), '?', 1)), ''), '(без посадки)')"
+def _dim_table(dim: str) -> str:
+    return f"public.kpi_dim_{dim}"
 
-# Landing: широкая таблица (region, day, landing) с отдельными счётчиками на каждый этап
-INSERT_CACHE_LANDING = f"""
-INSERT INTO {CACHE_LANDING} (region, day, landing, leads, prequals, quals, pokaz_naznachen, pokaz_proveden, passports, broni_cnt)
-SELECT
-  {REGION_SQL} AS region,
-  (lead_created_at AT TIME ZONE 'Europe/Moscow')::date AS day,
-  {_LANDING_EXPR_SQL} AS landing,
-  COUNT(*)::int AS leads,
-  COUNT(*) FILTER (WHERE pre_qual_date IS NOT NULL)::int AS prequals,
-  COUNT(*) FILTER (WHERE {_QUALS_FILTER_STR})::int AS quals,
-  COUNT(*) FILTER (WHERE pokaz_naznachen IS NOT NULL)::int AS pokaz_naznachen,
-  COUNT(*) FILTER (WHERE pokaz_proveden IS NOT NULL OR pokaz_proveden_date IS NOT NULL)::int AS pokaz_proveden,
-  COUNT(*) FILTER (WHERE pasport_poluchen IS NOT NULL)::int AS passports,
-  COUNT(*) FILTER (WHERE objekt_zabronirovan IS NOT NULL OR data_oplaty_broni_1 IS NOT NULL)::int AS broni_cnt
-FROM public.{TABLE}
-WHERE lead_created_at IS NOT NULL AND ({UTM_FILTER})
-GROUP BY 1, 2, 3;
-"""
-INSERT_CACHE_LANDING_SOCHI = f"""
-INSERT INTO {CACHE_LANDING} (region, day, landing, leads, prequals, quals, pokaz_naznachen, pokaz_proveden, passports, broni_cnt)
-SELECT
-  'Сочи',
-  (lead_created_at AT TIME ZONE 'Europe/Moscow')::date AS day,
-  {_LANDING_EXPR_SQL} AS landing,
-  COUNT(*)::int AS leads,
-  COUNT(*) FILTER (WHERE pre_qual_date IS NOT NULL)::int AS prequals,
-  COUNT(*) FILTER (WHERE {_QUALS_FILTER_STR})::int AS quals,
-  COUNT(*) FILTER (WHERE pokaz_naznachen IS NOT NULL)::int AS pokaz_naznachen,
-  COUNT(*) FILTER (WHERE pokaz_proveden IS NOT NULL OR pokaz_proveden_date IS NOT NULL)::int AS pokaz_proveden,
-  COUNT(*) FILTER (WHERE pasport_poluchen IS NOT NULL)::int AS passports,
-  COUNT(*) FILTER (WHERE objekt_zabronirovan IS NOT NULL OR data_oplaty_broni_1 IS NOT NULL)::int AS broni_cnt
-FROM public.{TABLE}
-WHERE lead_created_at IS NOT NULL AND ({UTM_FILTER}) AND ({_SOCHI_TAG_NOT_SOCHI})
-GROUP BY 2, 3;
-"""
-INSERT_CACHE_LANDING_PARTS = [INSERT_CACHE_LANDING, INSERT_CACHE_LANDING_SOCHI]
-
-# UTM: leads, prequals по lead_/pre_qual_date; quals по региональным датам с константой
-INSERT_CACHE_UTM_LEADS = f"""
-INSERT INTO {CACHE_UTM} (region, day, event_type, utm_source, utm_medium, utm_campaign, cnt)
-SELECT {REGION_SQL} AS region, (lead_created_at AT TIME ZONE 'Europe/Moscow')::date AS day, 'lead',
-  COALESCE(NULLIF(TRIM(utm_source), ''), '(без source)'),
-  COALESCE(NULLIF(TRIM(utm_medium), ''), '(без medium)'),
-  COALESCE(NULLIF(TRIM(utm_campaign), ''), '(без campaign)'),
-  COUNT(*)::int
-FROM public.{TABLE} WHERE lead_created_at IS NOT NULL AND ({UTM_FILTER}) GROUP BY 1, 2, 4, 5, 6;
-"""
-INSERT_CACHE_UTM_LEADS_SOCHI = f"""
-INSERT INTO {CACHE_UTM} (region, day, event_type, utm_source, utm_medium, utm_campaign, cnt)
-SELECT 'Сочи', (lead_created_at AT TIME ZONE 'Europe/Moscow')::date, 'lead',
-  COALESCE(NULLIF(TRIM(utm_source), ''), '(без source)'),
-  COALESCE(NULLIF(TRIM(utm_medium), ''), '(без medium)'),
-  COALESCE(NULLIF(TRIM(utm_campaign), ''), '(без campaign)'),
-  COUNT(*)::int
-FROM public.{TABLE} WHERE lead_created_at IS NOT NULL AND ({UTM_FILTER}) AND ({_SOCHI_TAG_NOT_SOCHI}) GROUP BY 2, 3, 4, 5, 6;
-"""
-INSERT_CACHE_UTM_PREQUALS = f"""
-INSERT INTO {CACHE_UTM} (region, day, event_type, utm_source, utm_medium, utm_campaign, cnt)
-SELECT {REGION_SQL} AS region, (pre_qual_date AT TIME ZONE 'Europe/Moscow')::date AS day, 'prequal',
-  COALESCE(NULLIF(TRIM(utm_source), ''), '(без source)'),
-  COALESCE(NULLIF(TRIM(utm_medium), ''), '(без medium)'),
-  COALESCE(NULLIF(TRIM(utm_campaign), ''), '(без campaign)'),
-  COUNT(*)::int
-FROM public.{TABLE} WHERE pre_qual_date IS NOT NULL AND ({UTM_FILTER}) GROUP BY 1, 2, 4, 5, 6;
+
+def _dim_ddl(dim: str) -> str:
+    # уникальность по md5: посадочные URL бывают длиннее лимита строки btree
+    return f"""
+CREATE TABLE IF NOT EXISTS {_dim_table(dim)} (
+  id     SERIAL PRIMARY KEY,
+  value  TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_kpi_dim_{dim}_value ON {_dim_table(dim)} (md5(value));
 """
-INSERT_CACHE_UTM_PREQUALS_SOCHI = f"""
-INSERT INTO {CACHE_UTM} (region, day, event_type, utm_source, utm_medium, utm_campaign, cnt)
-SELECT 'Сочи', (pre_qual_date AT TIME ZONE 'Europe/Moscow')::date, 'prequal',
-  COALESCE(NULLIF(TRIM(utm_source), ''), '(без source)'),
-  COALESCE(NULLIF(TRIM(utm_medium), ''), '(без medium)'),
-  COALESCE(NULLIF(TRIM(utm_campaign), ''), '(без campaign)'),
-  COUNT(*)::int
-FROM public.{TABLE} WHERE pre_qual_date IS NOT NULL AND ({UTM_FILTER}) AND ({_SOCHI_TAG_NOT_SOCHI}) GROUP BY 2, 3, 4, 5, 6;
+
+
+# Накопительные итоги kpi_daily_region: плотная сетка регион × день (от MIN(day)-1 с нулями до MAX(day)),
+# в каждой строке — суммы метрик с начала истории (n_rows — сколько строк kpi_daily_region уже было). Сумма за [a, b] = cum(b) − cum(a−1): два lookup по индексу.
+DDL_CACHE_CUM = f"""
+CREATE TABLE IF NOT EXISTS {CACHE_CUM} (
+  region          TEXT,
+  region_id       INT,
+  day             DATE,
+  leads           BIGINT,
+  prequals        BIGINT,
+  quals           BIGINT,
+  pokaz_naznachen BIGINT,
+  shows           BIGINT,
+  passports       BIGINT,
+  broni           BIGINT,
+  deals           BIGINT,
+  commission      NUMERIC(18,2),
+  summa           NUMERIC(18,2),
+  n_rows          BIGINT
+);
 """
-INSERT_CACHE_UTM_QUALS_KRYM = f"""
-INSERT INTO {CACHE_UTM} (region, day, event_type, utm_source, utm_medium, utm_campaign, cnt)
-SELECT 'Крым', (qualification_date_krym AT TIME ZONE 'Europe/Moscow')::date, 'qual',
-  COALESCE(NULLIF(TRIM(utm_source), ''), '(без source)'),
-  COALESCE(NULLIF(TRIM(utm_medium), ''), '(без medium)'),
-  COALESCE(NULLIF(TRIM(utm_campaign), ''), '(без campaign)'),
-  COUNT(*)::int
-FROM public.{TABLE} WHERE qualification_date_krym IS NOT NULL AND ({UTM_FILTER}) GROUP BY 2, 3, 4, 5, 6;
+
+DDL_CACHE_META = f"""
+CREATE TABLE IF NOT EXISTS {CACHE_META} (
+  id               SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+  source_watermark TIMESTAMPTZ,
+  refresh_mode     TEXT,
+  refreshed_at     TIMESTAMPTZ,
+  generation       BIGINT NOT NULL DEFAULT 0,
+  min_day          DATE,
+  max_day          DATE,
+  regions          TEXT[],
+  row_counts       JSONB
+);
+ALTER TABLE {CACHE_META} ADD COLUMN IF NOT EXISTS generation BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE {CACHE_META} ADD COLUMN IF NOT EXISTS min_day DATE;
+ALTER TABLE {CACHE_META} ADD COLUMN IF NOT EXISTS max_day DATE;
+ALTER TABLE {CACHE_META} ADD COLUMN IF NOT EXISTS regions TEXT[];
+ALTER TABLE {CACHE_META} ADD COLUMN IF NOT EXISTS row_counts JSONB;
 """
-INSERT_CACHE_UTM_QUALS_SOCHI = f"""
-INSERT INTO {CACHE_UTM} (region, day, event_type, utm_source, utm_medium, utm_campaign, cnt)
-SELECT 'Сочи', (qualification_date_sochi AT TIME ZONE 'Europe/Moscow')::date, 'qual',
-  COALESCE(NULLIF(TRIM(utm_source), ''), '(без source)'),
-  COALESCE(NULLIF(TRIM(utm_medium), ''), '(без medium)'),
-  COALESCE(NULLIF(TRIM(utm_campaign), ''), '(без campaign)'),
-  COUNT(*)::int
-FROM public.{TABLE} WHERE qualification_date_sochi IS NOT NULL AND ({UTM_FILTER}) GROUP BY 2, 3, 4, 5, 6;
+
+# Журнал refresh: строка step='run' на запуск + строка на каждый statement/задачу (см. _RefreshLog)
+DDL_REFRESH_LOG = f"""
+CREATE TABLE IF NOT EXISTS {REFRESH_LOG} (
+  id          BIGSERIAL PRIMARY KEY,
+  run_id      TEXT NOT NULL,
+  mode        TEXT NOT NULL,
+  step        TEXT NOT NULL,
+  started_at  TIMESTAMPTZ NOT NULL,
+  finished_at TIMESTAMPTZ,
+  duration_ms INTEGER,
+  rows        BIGINT,
+  retries     INTEGER NOT NULL DEFAULT 0,
+  error       TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_kpi_refresh_log_run ON {REFRESH_LOG} (run_id);
+CREATE INDEX IF NOT EXISTS idx_kpi_refresh_log_started ON {REFRESH_LOG} (started_at DESC) WHERE step = 'run';
 """
-INSERT_CACHE_UTM_QUALS_ANAPA = f"""
-INSERT INTO {CACHE_UTM} (region, day, event_type, utm_source, utm_medium, utm_campaign, cnt)
-SELECT 'Анапа', (qualification_date_anapa AT TIME ZONE 'Europe/Moscow')::date, 'qual',
-  COALESCE(NULLIF(TRIM(utm_source), ''), '(без source)'),
-  COALESCE(NULLIF(TRIM(utm_medium), ''), '(без medium)'),
-  COALESCE(NULLIF(TRIM(utm_campaign), ''), '(без campaign)'),
-  COUNT(*)::int
-FROM public.{TABLE} WHERE qualification_date_anapa IS NOT NULL AND ({UTM_FILTER}) GROUP BY 2, 3, 4, 5, 6;
+
+DDL_SCHEMA_VERSION = f"""
+CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (
+  id         SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+  version    INTEGER NOT NULL,
+  applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
 """
-INSERT_CACHE_UTM_QUALS_BAKU = f"""
-INSERT INTO {CACHE_UTM} (region, day, event_type, utm_source, utm_medium, utm_campaign, cnt)
-SELECT 'Баку', (qualification_date_baku AT TIME ZONE 'Europe/Moscow')::date, 'qual',
-  COALESCE(NULLIF(TRIM(utm_source), ''), '(без source)'),
-  COALESCE(NULLIF(TRIM(utm_medium), ''), '(без medium)'),
-  COALESCE(NULLIF(TRIM(utm_campaign), ''), '(без campaign)'),
-  COUNT(*)::int
-FROM public.{TABLE} WHERE qualification_date_baku IS NOT NULL AND ({UTM_FILTER}) GROUP BY 2, 3, 4, 5, 6;
+
+# Помесячная пересборка: какие месяцы уже залиты в теневые таблицы (для возобновления после сбоя)
+DDL_REFRESH_PROGRESS = f"""
+CREATE TABLE IF NOT EXISTS {REFRESH_PROGRESS} (
+  month_start      DATE PRIMARY KEY,
+  month_end        DATE NOT NULL,
+  source_watermark TIMESTAMPTZ,
+  done_at          TIMESTAMPTZ NOT NULL DEFAULT now(),
+  run_id           TEXT
+);
+ALTER TABLE {REFRESH_PROGRESS} ADD COLUMN IF NOT EXISTS run_id TEXT;
 """
-INSERT_CACHE_UTM_PARTS = [
-    INSERT_CACHE_UTM_LEADS,
-    INSERT_CACHE_UTM_LEADS_SOCHI,
-    INSERT_CACHE_UTM_PREQUALS,
-    INSERT_CACHE_UTM_PREQUALS_SOCHI,
-    INSERT_CACHE_UTM_QUALS_KRYM,
-    INSERT_CACHE_UTM_QUALS_SOCHI,
-    INSERT_CACHE_UTM_QUALS_ANAPA,
-    INSERT_CACHE_UTM_QUALS_BAKU,
+
+_QUALS_FILTER_STR = (
+    "qualification_date IS NOT NULL OR qualification_date_krym IS NOT NULL "
+    "OR qualification_date_sochi IS NOT NULL OR qualification_date_anapa IS NOT NULL OR qualification_date_baku IS NOT NULL"
+)
+
+_LANDING_EXPR_SQL = "COALESCE(NULLIF(TRIM(SPLIT_PART(COALESCE(utm_referrer, referrer, ''), '?', 1)), ''), '(без посадки)')"
+# Показ проведён / бронь: дата события — первое непустое из двух полей
+_SHOW_DAY_EXPR = "COALESCE(pokaz_proveden, pokaz_proveden_date)"
+_BRONI_DAY_EXPR = "COALESCE(objekt_zabronirovan, data_oplaty_broni_1)"
+# Метрики kpi_daily_region в порядке колонок
+_C = "leads, prequals, quals, pokaz_naznachen, shows, passports, broni, deals, commission, summa"
+
+
+# ── Single-pass refresh ───────────────────────────────────────────────────────
+# Вместо ~33 отдельных INSERT (каждый — полный скан «For dash») источник читается ОДИН раз
+# в CTE src (MATERIALIZED): там считаются регион, все даты событий и измерения. Дальше строки
+# событий «разворачиваются» (LATERAL VALUES) и раскладываются по всем кэш-таблицам
+# data-modifying CTE в одном statement. Правила раскладки событий по регионам:
+# доп. строки Сочи идут отдельной частью (part), квалы — по региональным датам, регион константой.
+# kpi_daily_region дополнительно компактится: одна строка на (region, day) вместо строки на событие.
+# Текстовые измерения кэшей пишутся как id справочников kpi_dim_<dim> (_dimension_ctes, _dim_encoded_insert).
+def _msk_day(expr: str) -> str:
+    return f"(({expr}) AT TIME ZONE 'Europe/Moscow')::date"
+
+
+# Даты событий (МСК) — по ним раскладываются строки кэшей и ищутся затронутые дни
+_EVENT_DAY_EXPRS = [
+    ("lead_day",            _msk_day("lead_created_at")),
+    ("prequal_day",         _msk_day("pre_qual_date")),
+    ("qual_krym_day",       _msk_day("qualification_date_krym")),
+    ("qual_sochi_day",      _msk_day("qualification_date_sochi")),
+    ("qual_anapa_day",      _msk_day("qualification_date_anapa")),
+    ("qual_baku_day",       _msk_day("qualification_date_baku")),
+    ("pokaz_naznachen_day", _msk_day("pokaz_naznachen")),
+    ("show_day",            _msk_day(_SHOW_DAY_EXPR)),
+    ("passport_day",        _msk_day("pasport_poluchen")),
+    ("broni_day",           _msk_day(_BRONI_DAY_EXPR)),
+    ("deal_day",            _msk_day("sdelka_sostoyalas")),
+    ("commission_day",      _msk_day("komissiya_poluchena")),
+    ("reason_day",          _msk_day("COALESCE(zakryto_ne_realizovano, closed_at)")),
 ]
+_EVENT_DAY_SELECT = ",\n".join(f"  {expr} AS {alias}" for alias, expr in _EVENT_DAY_EXPRS)
 
-INSERT_CACHE_MANAGERS = f"""
-INSERT INTO {CACHE_MANAGERS} (region, day, broker_id, broker_name, leads, prequals, quals)
+_SINGLE_PASS_SRC_SQL = f"""
 SELECT
   {REGION_SQL} AS region,
-  (lead_created_at AT TIME ZONE 'Europe/Moscow')::date AS day,
+  ({_SOCHI_TAG_NOT_SOCHI}) AS sochi_extra,
+{_EVENT_DAY_SELECT},
+  COALESCE(obshaya_summa, 0) AS summa,
+  COALESCE(obshaya_summa_komissiy, 0) AS commission,
+  ({_QUALS_FILTER_STR}) AS has_qual,
+  pre_qual_date IS NOT NULL AS has_prequal,
+  pasport_poluchen IS NOT NULL AS has_passport,
+  pokaz_naznachen IS NOT NULL AS has_pokaz_naznachen,
+  (pokaz_proveden IS NOT NULL OR pokaz_proveden_date IS NOT NULL) AS has_show,
+  (objekt_zabronirovan IS NOT NULL OR data_oplaty_broni_1 IS NOT NULL) AS has_broni,
+  COALESCE(NULLIF(TRIM(formname), ''), '(пусто)') AS formname,
+  {_LANDING_EXPR_SQL} AS landing,
+  COALESCE(NULLIF(TRIM(utm_source), ''), '(без source)') AS utm_source,
+  COALESCE(NULLIF(TRIM(utm_medium), ''), '(без medium)') AS utm_medium,
+  COALESCE(NULLIF(TRIM(utm_campaign), ''), '(без campaign)') AS utm_campaign,
   responsible_user_id AS broker_id,
   COALESCE(NULLIF(TRIM(responsible_name), ''), 'ID ' || responsible_user_id::text) AS broker_name,
-  COUNT(*)::int AS leads,
-  COUNT(*) FILTER (WHERE pre_qual_date IS NOT NULL)::int AS prequals,
-  COUNT(*) FILTER (WHERE {_QUALS_FILTER_STR})::int AS quals
-FROM public."For dash"
-WHERE lead_created_at IS NOT NULL AND responsible_user_id IS NOT NULL AND ({UTM_FILTER})
-GROUP BY 1, 2, 3, 4;
+  COALESCE(NULLIF(TRIM(prev_etap), ''), NULLIF(TRIM(status_id::text), ''), '(не указан)') AS stage,
+  COALESCE(NULLIF(TRIM(COALESCE(prichina_otkaza, '')), ''), '(не указана)') AS reason
+FROM public.{TABLE}
+WHERE ({UTM_FILTER})
 """
 
-INSERT_CACHE_STAGES = f"""
-INSERT INTO {CACHE_STAGES} (region, day, stage, cnt)
-SELECT
-  {REGION_SQL} AS region,
-  (lead_created_at AT TIME ZONE 'Europe/Moscow')::date AS day,
-  COALESCE(NULLIF(TRIM(prev_etap), ''), NULLIF(TRIM(status_id::text), ''), '(не указан)') AS stage,
-  COUNT(*) AS cnt
-FROM public."For dash"
-WHERE lead_created_at IS NOT NULL AND ({UTM_FILTER})
-GROUP BY 1, 2, 3;
+
+def _sochi_day(col: str) -> str:
+    """Дата события для доп. строки Сочи: только у лидов с тегом «Первичные Сочи» и базовым регионом ≠ Сочи."""
+    return f"CASE WHEN s.sochi_extra THEN s.{col} END"
+
+
+# (part, region, day, leads, prequals, quals, pokaz_naznachen, shows, passports, broni, deals, commission, summa)
+# part 0 — основной регион, 1 — доп. Сочи. Сделки без доп. Сочи.
+_KPI_EVENT_VALUES = f"""
+  (0, s.region, s.lead_day,                 1,0,0,0,0,0,0,0, 0::numeric, 0::numeric),
+  (1, 'Сочи',   {_sochi_day("lead_day")},            1,0,0,0,0,0,0,0, 0::numeric, 0::numeric),
+  (0, s.region, s.prequal_day,              0,1,0,0,0,0,0,0, 0::numeric, 0::numeric),
+  (1, 'Сочи',   {_sochi_day("prequal_day")},         0,1,0,0,0,0,0,0, 0::numeric, 0::numeric),
+  (0, s.region, s.pokaz_naznachen_day,      0,0,0,1,0,0,0,0, 0::numeric, 0::numeric),
+  (1, 'Сочи',   {_sochi_day("pokaz_naznachen_day")}, 0,0,0,1,0,0,0,0, 0::numeric, 0::numeric),
+  (0, s.region, s.show_day,                 0,0,0,0,1,0,0,0, 0::numeric, 0::numeric),
+  (1, 'Сочи',   {_sochi_day("show_day")},            0,0,0,0,1,0,0,0, 0::numeric, 0::numeric),
+  (0, s.region, s.passport_day,             0,0,0,0,0,1,0,0, 0::numeric, 0::numeric),
+  (1, 'Сочи',   {_sochi_day("passport_day")},        0,0,0,0,0,1,0,0, 0::numeric, 0::numeric),
+  (0, s.region, s.broni_day,                0,0,0,0,0,0,1,0, 0::numeric, s.summa),
+  (1, 'Сочи',   {_sochi_day("broni_day")},           0,0,0,0,0,0,1,0, 0::numeric, s.summa),
+  (0, s.region, s.deal_day,                 0,0,0,0,0,0,0,1, 0::numeric, 0::numeric),
+  (0, s.region, s.commission_day,           0,0,0,0,0,0,0,0, s.commission, 0::numeric),
+  (1, 'Сочи',   {_sochi_day("commission_day")},      0,0,0,0,0,0,0,0, s.commission, 0::numeric)
 """
+_KPI_EVENT_COLS = "part, region, day, leads, prequals, quals, pokaz_naznachen, shows, passports, broni, deals, commission, summa"
 
-INSERT_CACHE_REASONS = f"""
-INSERT INTO {CACHE_REASONS} (region, day, reason, cnt)
-SELECT
-  {REGION_SQL} AS region,
-  (COALESCE(zakryto_ne_realizovano, closed_at) AT TIME ZONE 'Europe/Moscow')::date AS day,
-  COALESCE(NULLIF(TRIM(COALESCE(prichina_otkaza, '')), ''), '(не указана)') AS reason,
-  COUNT(*) AS cnt
-FROM public."For dash"
-WHERE COALESCE(zakryto_ne_realizovano, closed_at) IS NOT NULL AND ({UTM_FILTER})
-GROUP BY 1, 2, 3;
+_QUAL_REGION_VALUES = """
+  ('Крым',  s.qual_krym_day),
+  ('Сочи',  s.qual_sochi_day),
+  ('Анапа', s.qual_anapa_day),
+  ('Баку',  s.qual_baku_day)
 """
 
-# KPI по событиям: каждое событие по своей дате. Для non-qual метрик — основной INSERT (с REGION_SQL)
-# + доп. INSERT в Сочи для лидов с тегом «Первичные Сочи» (когда базовый регион ≠ Сочи).
-# Квалы — по региональным датам, регион константой (без доп. Сочи).
-_C = "leads, prequals, quals, pokaz_naznachen, shows, passports, broni, deals, commission, summa"
 
-INSERT_CACHE_SQL_LEADS = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT {REGION_SQL}, (lead_created_at AT TIME ZONE 'Europe/Moscow')::date, 1,0,0,0,0,0,0,0,0,0
-FROM public.{TABLE} WHERE lead_created_at IS NOT NULL AND ({UTM_FILTER});
-"""
-INSERT_CACHE_SQL_LEADS_SOCHI = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT 'Сочи', (lead_created_at AT TIME ZONE 'Europe/Moscow')::date, 1,0,0,0,0,0,0,0,0,0
-FROM public.{TABLE} WHERE lead_created_at IS NOT NULL AND ({UTM_FILTER}) AND ({_SOCHI_TAG_NOT_SOCHI});
-"""
-INSERT_CACHE_SQL_PREQUALS = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT {REGION_SQL}, (pre_qual_date AT TIME ZONE 'Europe/Moscow')::date, 0,1,0,0,0,0,0,0,0,0
-FROM public.{TABLE} WHERE pre_qual_date IS NOT NULL AND ({UTM_FILTER});
-"""
-INSERT_CACHE_SQL_PREQUALS_SOCHI = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT 'Сочи', (pre_qual_date AT TIME ZONE 'Europe/Moscow')::date, 0,1,0,0,0,0,0,0,0,0
-FROM public.{TABLE} WHERE pre_qual_date IS NOT NULL AND ({UTM_FILTER}) AND ({_SOCHI_TAG_NOT_SOCHI});
-"""
-INSERT_CACHE_SQL_QUALS_KRYM = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT 'Крым', (qualification_date_krym AT TIME ZONE 'Europe/Moscow')::date, 0,0,COUNT(*)::int,0,0,0,0,0,0,0
-FROM public.{TABLE} WHERE qualification_date_krym IS NOT NULL AND ({UTM_FILTER}) GROUP BY 2;
-"""
-INSERT_CACHE_SQL_QUALS_SOCHI = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT 'Сочи', (qualification_date_sochi AT TIME ZONE 'Europe/Moscow')::date, 0,0,COUNT(*)::int,0,0,0,0,0,0,0
-FROM public.{TABLE} WHERE qualification_date_sochi IS NOT NULL AND ({UTM_FILTER}) GROUP BY 2;
-"""
-INSERT_CACHE_SQL_QUALS_ANAPA = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT 'Анапа', (qualification_date_anapa AT TIME ZONE 'Europe/Moscow')::date, 0,0,COUNT(*)::int,0,0,0,0,0,0,0
-FROM public.{TABLE} WHERE qualification_date_anapa IS NOT NULL AND ({UTM_FILTER}) GROUP BY 2;
-"""
-INSERT_CACHE_SQL_QUALS_BAKU = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT 'Баку', (qualification_date_baku AT TIME ZONE 'Europe/Moscow')::date, 0,0,COUNT(*)::int,0,0,0,0,0,0,0
-FROM public.{TABLE} WHERE qualification_date_baku IS NOT NULL AND ({UTM_FILTER}) GROUP BY 2;
-"""
-# pokaz_naznachen — по колонке pokaz_naznachen; shows — только COALESCE(pokaz_proveden, pokaz_proveden_date)
-INSERT_CACHE_SQL_POKAZ_NAZNACHEN = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT {REGION_SQL}, (pokaz_naznachen AT TIME ZONE 'Europe/Moscow')::date, 0,0,0,1,0,0,0,0,0,0
-FROM public.{TABLE} WHERE pokaz_naznachen IS NOT NULL AND ({UTM_FILTER});
-"""
-INSERT_CACHE_SQL_POKAZ_NAZNACHEN_SOCHI = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT 'Сочи', (pokaz_naznachen AT TIME ZONE 'Europe/Moscow')::date, 0,0,0,1,0,0,0,0,0,0
-FROM public.{TABLE} WHERE pokaz_naznachen IS NOT NULL AND ({UTM_FILTER}) AND ({_SOCHI_TAG_NOT_SOCHI});
-"""
-_SHOW_DAY_EXPR = "COALESCE(pokaz_proveden, pokaz_proveden_date)"
-INSERT_CACHE_SQL_SHOWS = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT {REGION_SQL}, ({_SHOW_DAY_EXPR} AT TIME ZONE 'Europe/Moscow')::date, 0,0,0,0,1,0,0,0,0,0
-FROM public.{TABLE} WHERE {_SHOW_DAY_EXPR} IS NOT NULL AND ({UTM_FILTER});
-"""
-INSERT_CACHE_SQL_SHOWS_SOCHI = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT 'Сочи', ({_SHOW_DAY_EXPR} AT TIME ZONE 'Europe/Moscow')::date, 0,0,0,0,1,0,0,0,0,0
-FROM public.{TABLE} WHERE {_SHOW_DAY_EXPR} IS NOT NULL AND ({UTM_FILTER}) AND ({_SOCHI_TAG_NOT_SOCHI});
-"""
-INSERT_CACHE_SQL_PASSPORTS = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT {REGION_SQL}, (pasport_poluchen AT TIME ZONE 'Europe/Moscow')::date, 0,0,0,0,0,1,0,0,0,0
-FROM public.{TABLE} WHERE pasport_poluchen IS NOT NULL AND ({UTM_FILTER});
-"""
-INSERT_CACHE_SQL_PASSPORTS_SOCHI = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT 'Сочи', (pasport_poluchen AT TIME ZONE 'Europe/Moscow')::date, 0,0,0,0,0,1,0,0,0,0
-FROM public.{TABLE} WHERE pasport_poluchen IS NOT NULL AND ({UTM_FILTER}) AND ({_SOCHI_TAG_NOT_SOCHI});
-"""
-# Брони + summa: по objekt_zabronirovan/data_oplaty_broni_1; SUM(obshaya_summa)
-_BRONI_DAY_EXPR = "COALESCE(objekt_zabronirovan, data_oplaty_broni_1)"
-INSERT_CACHE_SQL_BRONI = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT {REGION_SQL}, ({_BRONI_DAY_EXPR} AT TIME ZONE 'Europe/Moscow')::date, 0,0,0,0,0,0,1,0,0,COALESCE(obshaya_summa,0)
-FROM public.{TABLE} WHERE {_BRONI_DAY_EXPR} IS NOT NULL AND ({UTM_FILTER});
-"""
-INSERT_CACHE_SQL_BRONI_SOCHI = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT 'Сочи', ({_BRONI_DAY_EXPR} AT TIME ZONE 'Europe/Moscow')::date, 0,0,0,0,0,0,1,0,0,COALESCE(obshaya_summa,0)
-FROM public.{TABLE} WHERE {_BRONI_DAY_EXPR} IS NOT NULL AND ({UTM_FILTER}) AND ({_SOCHI_TAG_NOT_SOCHI});
-"""
-INSERT_CACHE_SQL_DEALS = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT {REGION_SQL}, (sdelka_sostoyalas AT TIME ZONE 'Europe/Moscow')::date, 0,0,0,0,0,0,0,1,0,0
-FROM public.{TABLE} WHERE sdelka_sostoyalas IS NOT NULL AND ({UTM_FILTER});
-"""
-# commission — по komissiya_poluchena; SUM(obshaya_summa_komissiy)
-INSERT_CACHE_SQL_COMMISSION = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT {REGION_SQL}, (komissiya_poluchena AT TIME ZONE 'Europe/Moscow')::date, 0,0,0,0,0,0,0,0,COALESCE(obshaya_summa_komissiy,0),0
-FROM public.{TABLE} WHERE komissiya_poluchena IS NOT NULL AND ({UTM_FILTER});
-"""
-INSERT_CACHE_SQL_COMMISSION_SOCHI = f"""
-INSERT INTO {CACHE_TABLE} (region, day, {_C})
-SELECT 'Сочи', (komissiya_poluchena AT TIME ZONE 'Europe/Moscow')::date, 0,0,0,0,0,0,0,0,COALESCE(obshaya_summa_komissiy,0),0
-FROM public.{TABLE} WHERE komissiya_poluchena IS NOT NULL AND ({UTM_FILTER}) AND ({_SOCHI_TAG_NOT_SOCHI});
-"""
-INSERT_CACHE_SQL_KPI_PARTS = [
-    INSERT_CACHE_SQL_LEADS,
-    INSERT_CACHE_SQL_LEADS_SOCHI,
-    INSERT_CACHE_SQL_PREQUALS,
-    INSERT_CACHE_SQL_PREQUALS_SOCHI,
-    INSERT_CACHE_SQL_QUALS_KRYM,
-    INSERT_CACHE_SQL_QUALS_SOCHI,
-    INSERT_CACHE_SQL_QUALS_ANAPA,
-    INSERT_CACHE_SQL_QUALS_BAKU,
-    INSERT_CACHE_SQL_POKAZ_NAZNACHEN,
-    INSERT_CACHE_SQL_POKAZ_NAZNACHEN_SOCHI,
-    INSERT_CACHE_SQL_SHOWS,
-    INSERT_CACHE_SQL_SHOWS_SOCHI,
-    INSERT_CACHE_SQL_PASSPORTS,
-    INSERT_CACHE_SQL_PASSPORTS_SOCHI,
-    INSERT_CACHE_SQL_BRONI,
-    INSERT_CACHE_SQL_BRONI_SOCHI,
-    INSERT_CACHE_SQL_DEALS,
-    INSERT_CACHE_SQL_COMMISSION,
-    INSERT_CACHE_SQL_COMMISSION_SOCHI,
-]
+# Начало текста ошибки «значения нет в справочнике» (_dim_encoded_insert): refresh повторяется с дозаполнением
+_MISSING_DIM_ERROR = "нет id в "
+
+
+def _dim_encoded_insert(table: str, target: str, cols, select_sql: str) -> str:
+    """INSERT в target из select_sql (отдаёт cols, измерения — текстом): строки уже сгруппированы,
+    текст измерений заменяется на id из CTE dim_<dim> (см. _dimension_ctes) — join только по итоговым группам.
+    LEFT JOIN + проверка: значение без id в справочнике — ошибка statement, а не молча пропавшая строка."""
+    dims = _TABLE_DIMENSIONS[table]
+    target_cols, select = [], []
+    for c in cols:
+        if c not in dims or c in _KEEP_TEXT_DIMENSIONS:
+            target_cols.append(c)
+            select.append(f"g.{c}")
+        if c in dims:
+            target_cols.append(f"{c}_id")
+            # В SQL нет RAISE: приведение текста к int падает с сообщением, в котором видно справочник и значение
+            select.append(
+                f"CASE WHEN g.{c} IS NULL OR d_{c}.id IS NOT NULL THEN d_{c}.id "
+                f"ELSE CAST('{_MISSING_DIM_ERROR}{_dim_table(c)}: ' || g.{c} AS int) END"
+            )
+    joins = "".join(f"\nLEFT JOIN dim_{d} d_{d} ON d_{d}.value = g.{d}" for d in dims)
+    return (
+        f"INSERT INTO {target} ({', '.join(target_cols)})\n"
+        f"SELECT {', '.join(select)}\nFROM ({select_sql.strip()}\n) g{joins}\nRETURNING 1"
+    )
+
+
+def _dimension_ctes(tables, fill=False) -> list:
+    """CTE справочников: dim_<dim> — id значений измерений. Refresh справочники только читает — их заранее
+    заполняет _fill_dimensions (fill=True: новые значения из src дописываются в kpi_dim_<dim>)."""
+    ctes = []
+    for dim in DIMENSIONS:
+        if not any(dim in _TABLE_DIMENSIONS.get(t, ()) for t in tables):
+            continue
+        table = _dim_table(dim)
+        if not fill:
+            ctes.append(f"dim_{dim} AS (SELECT id, value FROM {table})")
+            continue
+        values = f"SELECT s.{dim} AS v FROM src s"
+        if dim in _DIMENSION_FIXED_VALUES:
+            fixed = ", ".join(f"('{v}')" for v in _DIMENSION_FIXED_VALUES[dim])
+            values += f" UNION SELECT v FROM (VALUES {fixed}) AS f(v)"
+        ctes.append(f"""dim_new_{dim} AS (
+INSERT INTO {table} (value)
+SELECT DISTINCT s.v FROM ({values}) s
+WHERE s.v IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {table} d WHERE md5(d.value) = md5(s.v))
+ON CONFLICT ((md5(value))) DO NOTHING
+RETURNING id, value)""")
+        ctes.append(f"dim_{dim} AS (SELECT id, value FROM {table} UNION ALL SELECT id, value FROM dim_new_{dim})")
+    return ctes
+
+
+def _single_pass_inserts(table: str, target: str, day_pred=None) -> list:
+    """INSERT ... SELECT ... FROM src для одной кэш-таблицы (table — логическое имя, target — куда писать).
+    day_pred(col) -> SQL-условие на дату строки кэша (инкрементальный refresh); None — все дни."""
+    dp = day_pred or (lambda col: "TRUE")
+    if table == CACHE_TABLE:
+        # Стадия компакции: события и квалы сворачиваются в одну строку на (region, day) со всеми метриками
+        return [_dim_encoded_insert(table, target, ("region", "day", *_C.split(", ")), f"""
+SELECT ev.region, ev.day,
+  SUM(ev.leads)::int AS leads, SUM(ev.prequals)::int AS prequals, SUM(ev.quals)::int AS quals,
+  SUM(ev.pokaz_naznachen)::int AS pokaz_naznachen, SUM(ev.shows)::int AS shows, SUM(ev.passports)::int AS passports,
+  SUM(ev.broni)::int AS broni, SUM(ev.deals)::int AS deals, SUM(ev.commission) AS commission, SUM(ev.summa) AS summa
+FROM (
+  SELECT e.region, e.day, e.leads, e.prequals, e.quals, e.pokaz_naznachen, e.shows, e.passports, e.broni, e.deals, e.commission, e.summa
+  FROM src s
+  CROSS JOIN LATERAL (VALUES {_KPI_EVENT_VALUES}) AS e({_KPI_EVENT_COLS})
+  WHERE e.day IS NOT NULL AND {dp("e.day")}
+  UNION ALL
+  SELECT q.region, q.day, 0,0,1,0,0,0,0,0, 0::numeric, 0::numeric
+  FROM src s
+  CROSS JOIN LATERAL (VALUES {_QUAL_REGION_VALUES}) AS q(region, day)
+  WHERE q.day IS NOT NULL AND {dp("q.day")}
+) ev
+GROUP BY ev.region, ev.day""")]
+    if table == CACHE_MANAGERS:
+        cols = ("region", "day", "broker_id", "broker_name", "leads", "prequals", "quals")
+        return [_dim_encoded_insert(table, target, cols, f"""
+SELECT s.region, s.lead_day AS day, s.broker_id, s.broker_name,
+  COUNT(*)::int AS leads,
+  COUNT(*) FILTER (WHERE s.has_prequal)::int AS prequals,
+  COUNT(*) FILTER (WHERE s.has_qual)::int AS quals
+FROM src s
+WHERE s.lead_day IS NOT NULL AND s.broker_id IS NOT NULL AND {dp("s.lead_day")}
+GROUP BY s.region, s.lead_day, s.broker_id, s.broker_name""")]
+    if table == CACHE_STAGES:
+        return [_dim_encoded_insert(table, target, ("region", "day", "stage", "cnt"), f"""
+SELECT s.region, s.lead_day AS day, s.stage, COUNT(*) AS cnt
+FROM src s
+WHERE s.lead_day IS NOT NULL AND {dp("s.lead_day")}
+GROUP BY s.region, s.lead_day, s.stage""")]
+    if table == CACHE_REASONS:
+        return [_dim_encoded_insert(table, target, ("region", "day", "reason", "cnt"), f"""
+SELECT s.region, s.reason_day AS day, s.reason, COUNT(*) AS cnt
+FROM src s
+WHERE s.reason_day IS NOT NULL AND {dp("s.reason_day")}
+GROUP BY s.region, s.reason_day, s.reason""")]
+    if table == CACHE_FORMNAMES:
+        cols = ("region", "day", "formname", "leads", "quals", "prequals", "passports", "pokaz_naznachen", "pokaz_proveden", "broni")
+        return [_dim_encoded_insert(table, target, cols, f"""
+SELECT s.region, s.lead_day AS day, s.formname,
+  COUNT(*)::int AS leads,
+  COUNT(*) FILTER (WHERE s.has_qual)::int AS quals,
+  COUNT(*) FILTER (WHERE s.has_prequal)::int AS prequals,
+  COUNT(*) FILTER (WHERE s.has_passport)::int AS passports,
+  COUNT(*) FILTER (WHERE s.has_pokaz_naznachen)::int AS pokaz_naznachen,
+  COUNT(*) FILTER (WHERE s.has_show)::int AS pokaz_proveden,
+  COUNT(*) FILTER (WHERE s.has_broni)::int AS broni
+FROM src s
+WHERE s.lead_day IS NOT NULL AND {dp("s.lead_day")}
+GROUP BY s.region, s.lead_day, s.formname""")]
+    if table == CACHE_UTM:
+        cols = ("region", "day", "event_type", "utm_source", "utm_medium", "utm_campaign", "cnt")
+        return [_dim_encoded_insert(table, target, cols, f"""
+SELECT u.region, u.day, u.event_type, s.utm_source, s.utm_medium, s.utm_campaign, COUNT(*)::int AS cnt
+FROM src s
+CROSS JOIN LATERAL (VALUES
+  (0, s.region, s.lead_day,    'lead'),
+  (1, 'Сочи',   {_sochi_day("lead_day")},    'lead'),
+  (0, s.region, s.prequal_day, 'prequal'),
+  (1, 'Сочи',   {_sochi_day("prequal_day")}, 'prequal'),
+  (2, 'Крым',   s.qual_krym_day,  'qual'),
+  (2, 'Сочи',   s.qual_sochi_day, 'qual'),
+  (2, 'Анапа',  s.qual_anapa_day, 'qual'),
+  (2, 'Баку',   s.qual_baku_day,  'qual')
+) AS u(part, region, day, event_type)
+WHERE u.day IS NOT NULL AND {dp("u.day")}
+GROUP BY u.part, u.region, u.day, u.event_type, s.utm_source, s.utm_medium, s.utm_campaign""")]
+    if table == CACHE_LANDING:
+        cols = ("region", "day", "landing", "leads", "prequals", "quals", "pokaz_naznachen", "pokaz_proveden", "passports", "broni_cnt")
+        return [_dim_encoded_insert(table, target, cols, f"""
+SELECT r.region, s.lead_day AS day, s.landing,
+  COUNT(*)::int AS leads,
+  COUNT(*) FILTER (WHERE s.has_prequal)::int AS prequals,
+  COUNT(*) FILTER (WHERE s.has_qual)::int AS quals,
+  COUNT(*) FILTER (WHERE s.has_pokaz_naznachen)::int AS pokaz_naznachen,
+  COUNT(*) FILTER (WHERE s.has_show)::int AS pokaz_proveden,
+  COUNT(*) FILTER (WHERE s.has_passport)::int AS passports,
+  COUNT(*) FILTER (WHERE s.has_broni)::int AS broni_cnt
+FROM src s
+CROSS JOIN LATERAL (VALUES (0, s.region), (1, 'Сочи')) AS r(part, region)
+WHERE s.lead_day IS NOT NULL AND (r.part = 0 OR s.sochi_extra) AND {dp("s.lead_day")}
+GROUP BY r.part, r.region, s.lead_day, s.landing""")]
+    raise ValueError(f"неизвестная кэш-таблица: {table}")
+
+
+def _date_array_sql(days) -> str:
+    """Литерал date[] из объектов date (без параметров: в SQL кэша есть «%» в ILIKE)."""
+    return "'{" + ",".join(d.isoformat() for d in sorted(days)) + "}'::date[]"
+
+
+def _day_in_pred(days):
+    arr = _date_array_sql(days)
+    return lambda col: f"{col} = ANY({arr})"
+
+
+def _day_between_pred(d_from, d_to):
+    return lambda col: f"{col} BETWEEN DATE '{d_from.isoformat()}' AND DATE '{d_to.isoformat()}'"
+
+
+def _single_pass_src(source=None, day_pred=None) -> str:
+    """Тело CTE src: скан «For dash» (или среза source); day_pred — только лиды с событиями в подходящие дни."""
+    src = f"SELECT * FROM {source}" if source else _SINGLE_PASS_SRC_SQL
+    if day_pred is not None:
+        any_day = " OR ".join(day_pred(f"s0.{alias}") for alias, _ in _EVENT_DAY_EXPRS)
+        src = f"SELECT * FROM ({src}) s0 WHERE {any_day}"
+    return src
+
+
+def _single_pass_refresh_sql(tables=None, day_pred=None, targets=None, source=None) -> str:
+    """Один statement: скан «For dash» → INSERT во все tables. Возвращает одну строку с числом вставленных строк по таблицам.
+    day_pred — пересчитать только строки кэша с подходящей датой (источник заранее сужается до лидов с такими событиями);
+    targets — {таблица: куда писать} (теневые таблицы при полной пересборке);
+    source — таблица с уже снятым срезом источника (_stage_source) вместо скана «For dash».
+    Справочники statement только читает: до него их заполняет _fill_dimensions отдельной закоммиченной транзакцией."""
+    tables = list(tables or _ALL_CACHE_TABLES)
+    targets = targets or {}
+    ctes = [f"src AS MATERIALIZED ({_single_pass_src(source, day_pred)})"] + _dimension_ctes(tables)
+    counters = []
+    for table in tables:
+        names = []
+        for sql in _single_pass_inserts(table, targets.get(table, table), day_pred=day_pred):
+            name = f"ins_{len(ctes)}"
+            ctes.append(f"{name} AS ({sql.strip()})")
+            names.append(f"(SELECT COUNT(*) FROM {name})")
+        counters.append(f"{' + '.join(names)} AS \"{table.split('.')[-1]}\"")
+    return "WITH " + ",\n".join(ctes) + "\nSELECT " + ",\n  ".join(counters)
+
+
+def _fill_dimensions(cur, log, tables=None, source=None, day_pred=None):
+    """Дописывает в справочники новые значения измерений из «For dash» (или среза source; day_pred — только лиды
+    с событиями в эти дни) — отдельным statement, закоммиченным до refresh. Refresh сам справочник не пишет:
+    значение, которое параллельно закоммитила другая транзакция, не вернёт ни RETURNING его ON CONFLICT DO NOTHING,
+    ни его снимок, а задачи одного экспортированного снимка падали бы с serialization failure."""
+    tables = list(tables or _ALL_CACHE_TABLES)
+    ctes = [f"src AS MATERIALIZED ({_single_pass_src(source, day_pred)})"] + _dimension_ctes(tables, fill=True)
+    counters = [c.split(" AS ", 1)[0] for c in ctes if c.startswith("dim_new_")]
+    with log.step("dimensions") as entry:
+        cur.execute("WITH " + ",\n".join(ctes) + "\nSELECT " + " + ".join(f"(SELECT COUNT(*) FROM {c})" for c in counters))
+        entry["rows"] = cur.fetchone()[0]
 
 
 def _run_ddl(conn, ddl_block):
@@ -851,160 +1354,1525 @@ def _run_ddl(conn, ddl_block):
 
 _ALL_CACHE_TABLES = (CACHE_TABLE, CACHE_MANAGERS, CACHE_STAGES, CACHE_REASONS, CACHE_FORMNAMES, CACHE_UTM, CACHE_LANDING)
 
+# ── Покрывающие индексы ───────────────────────────────────────────────────────
+# Ключи — предикаты запросов дашборда: диапазон day (+ region_id = ANY) и region_id = ANY + диапазон day;
+# INCLUDE — всё, что запрос читает (измерения группировки и суммируемые метрики). После VACUUM
+# (_vacuum_cache_tables, после каждого refresh — по переписанным таблицам) чтение идёт Index Only Scan без обращения к heap.
+# Индексы кэш-таблиц заданы только здесь: ensure_cache_table удаляет с них индексы не из этого списка.
+_KPI_INDEX_INCLUDE = ("region", "leads", "prequals", "quals", "pokaz_naznachen", "shows", "passports", "broni", "deals", "commission", "summa")
+_DAY_REGION_KEYS = (("day", "region_id"), ("region_id", "day"))
+# таблица → (ключи индексов, INCLUDE, unique)
+_CACHE_INDEXES = {
+    CACHE_TABLE: (_DAY_REGION_KEYS, _KPI_INDEX_INCLUDE, False),
+    CACHE_MANAGERS: (_DAY_REGION_KEYS, ("broker_id", "broker_name", "leads", "prequals", "quals"), False),
+    CACHE_STAGES: (_DAY_REGION_KEYS, ("stage_id", "cnt"), False),
+    CACHE_REASONS: (_DAY_REGION_KEYS, ("reason_id", "cnt"), False),
+    CACHE_FORMNAMES: (
+        _DAY_REGION_KEYS,
+        ("formname_id", "leads", "quals", "prequals", "passports", "pokaz_naznachen", "pokaz_proveden", "broni"),
+        False,
+    ),
+    CACHE_UTM: (_DAY_REGION_KEYS, ("event_type", "utm_source_id", "cnt"), False),
+    CACHE_LANDING: (
+        _DAY_REGION_KEYS,
+        ("landing_id", "leads", "prequals", "quals", "pokaz_naznachen", "pokaz_proveden", "passports", "broni_cnt"),
+        False,
+    ),
+    # hi/lo lookup по дню; n_rows — признак «регион есть в диапазоне» в kpi_by_region
+    CACHE_CUM: ((("day", "region_id"),), _KPI_INDEX_INCLUDE + ("n_rows",), True),
+}
 
-def ensure_cache_table(engine):
-    """Создаёт все таблицы кэша и индексы (только DDL, без ANALYZE — он занимает ~57с)."""
-    conn = _connect_once(engine)
-    try:
-        _run_ddl(conn, DDL_CACHE_TABLE)
-        _run_ddl(conn, DDL_CACHE_MANAGERS)
-        _run_ddl(conn, DDL_CACHE_STAGES)
-        _run_ddl(conn, DDL_CACHE_REASONS)
-        _run_ddl(conn, DDL_CACHE_FORMNAMES)
-        _run_ddl(conn, DDL_CACHE_UTM)
-        _run_ddl(conn, DDL_CACHE_LANDING)
-        conn.commit()
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
+
+def _cache_index_ddl(table: str) -> str:
+    keys, include, unique = _CACHE_INDEXES[table]
+    bare = table.split(".")[-1]
+    return "".join(
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS idx_{bare}_{'_'.join(k)}_cov "
+        f"ON {table} ({', '.join(k)}) INCLUDE ({', '.join(include)});\n"
+        for k in keys
+    )
 
 
-def _is_connection_error(e):
-    """Обрыв соединения (EOF, timeout) — имеет смысл повторить."""
-    msg = str(e).lower()
-    return (
-        "eof detected" in msg
-        or "connection" in msg
-        or "ssl syscall" in msg
-        or "timed out" in msg
-        or "statement_timeout" in msg
+_CACHE_DDL = {
+    table: ddl + _cache_index_ddl(table)
+    for table, ddl in (
+        (CACHE_TABLE, DDL_CACHE_TABLE),
+        (CACHE_MANAGERS, DDL_CACHE_MANAGERS),
+        (CACHE_STAGES, DDL_CACHE_STAGES),
+        (CACHE_REASONS, DDL_CACHE_REASONS),
+        (CACHE_FORMNAMES, DDL_CACHE_FORMNAMES),
+        (CACHE_UTM, DDL_CACHE_UTM),
+        (CACHE_LANDING, DDL_CACHE_LANDING),
+        (CACHE_CUM, DDL_CACHE_CUM),
     )
+}
 
+# ── Свёртки по неделям и месяцам ──────────────────────────────────────────────
+# <table>_week / <table>_month: те же колонки, day — начало периода (date_trunc), метрики просуммированы.
+# Детальные запросы берут целые месяцы из _month, целые недели по краям из _week, остаток — из дневной
+# таблицы (_grain_segments). kpi_daily_region не сворачиваем: его суммы за диапазон уже дают куб и _cum.
+ROLLUP_GRAINS = ("week", "month")
+# таблица → (измерения кроме region/day, метрики)
+_ROLLUP_SPEC = {
+    CACHE_MANAGERS: (("broker_id", "broker_name"), ("leads", "prequals", "quals")),
+    CACHE_STAGES: (("stage_id",), ("cnt",)),
+    CACHE_REASONS: (("reason_id",), ("cnt",)),
+    CACHE_FORMNAMES: (("formname_id",), ("leads", "quals", "prequals", "passports", "pokaz_naznachen", "pokaz_proveden", "broni")),
+    CACHE_UTM: (("event_type", "utm_source_id", "utm_medium_id", "utm_campaign_id"), ("cnt",)),
+    CACHE_LANDING: (("landing_id",), ("leads", "prequals", "quals", "pokaz_naznachen", "pokaz_proveden", "passports", "broni_cnt")),
+}
 
-def _month_ranges(min_d, max_d):
-    """Итератор (d_from, d_to) по месяцам от min_d до max_d включительно."""
-    from datetime import date
-    from calendar import monthrange
-    if min_d is None or max_d is None or min_d > max_d:
-        return
-    y, m = min_d.year, min_d.month
-    end_y, end_m = max_d.year, max_d.month
-    while (y, m) <= (end_y, end_m):
-        start = date(y, m, 1)
-        last = monthrange(y, m)[1]
-        stop = date(y, m, last)
-        if start < min_d:
-            start = min_d
-        if stop > max_d:
-            stop = max_d
-        yield (start, stop)
-        if m == 12:
-            y, m = y + 1, 1
-        else:
-            m += 1
 
+def _rollup_name(table: str, grain: str) -> str:
+    return f"{table}_{grain}"
 
-def refresh_kpi_daily_region(engine):
-    """Полная перезаливка всех кэш-таблиц из 'For dash'."""
-    max_attempts = 3
-    last_error = None
-    for attempt in range(max_attempts):
-        conn = None
-        try:
-            conn = _connect_once(engine)
-            try:
-                with conn.cursor() as cur:
-                    cur.execute("SET statement_timeout = '600000'")
-                    for tbl in _ALL_CACHE_TABLES:
-                        cur.execute(f"TRUNCATE {tbl}")
-                    for sql in INSERT_CACHE_SQL_KPI_PARTS:
-                        cur.execute(sql)
-                    for sql in [INSERT_CACHE_MANAGERS, INSERT_CACHE_STAGES, INSERT_CACHE_REASONS, INSERT_CACHE_FORMNAMES]:
-                        cur.execute(sql)
-                    for sql in INSERT_CACHE_UTM_PARTS:
-                        cur.execute(sql)
-                    for sql in INSERT_CACHE_LANDING_PARTS:
-                        cur.execute(sql)
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                last_error = e
-                if attempt < max_attempts - 1 and _is_connection_error(e):
-                    try:
-                        conn.close()
-                    except Exception:
-                        pass
-                    time.sleep(5 * (attempt + 1))
-                    continue
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-                return (False, str(e))
-            conn.close()
-            return (True, None)
-        except Exception as e:
-            last_error = e
-            if conn is not None:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-            if attempt < max_attempts - 1 and _is_connection_error(e):
-                time.sleep(5 * (attempt + 1))
-                continue
-            return (False, str(e))
-    return (False, str(last_error) if last_error else "неизвестная ошибка")
 
+def _rollup_ddl(table: str, grain: str) -> str:
+    """DDL свёртки = DDL дневной таблицы с другим именем таблицы и индексов (свёртки маленькие — без секций)."""
+    ddl = re.sub(re.escape(table) + r"\b", _rollup_name(table, grain), _CACHE_DDL[table]).replace(" PARTITION BY RANGE (day)", "")
+    return re.sub(r"(INDEX IF NOT EXISTS )(\w+)", lambda m: f"{m.group(1)}{m.group(2)}_{grain}", ddl)
 
-def refresh_kpi_daily_region_chunked(engine):
-    """Заполняет кэш по шагам с commit после каждого — меньше шанс таймаута/обрыва."""
-    conn = None
-    try:
-        conn = _connect_once(engine)
-        with conn.cursor() as cur:
-            cur.execute("SET statement_timeout = '300000'")
-            for tbl in _ALL_CACHE_TABLES:
-                cur.execute(f"TRUNCATE {tbl}")
-        conn.commit()
-        conn.close()
-        for sql in INSERT_CACHE_SQL_KPI_PARTS:
-            conn = _connect_once(engine)
-            with conn.cursor() as cur:
-                cur.execute(sql)
-            conn.commit()
-            conn.close()
-        for sql in [INSERT_CACHE_MANAGERS, INSERT_CACHE_STAGES, INSERT_CACHE_REASONS, INSERT_CACHE_FORMNAMES]:
-            conn = _connect_once(engine)
-            with conn.cursor() as cur:
-                cur.execute(sql)
-            conn.commit()
-            conn.close()
-        for sql in INSERT_CACHE_UTM_PARTS:
-            conn = _connect_once(engine)
-            with conn.cursor() as cur:
-                cur.execute(sql)
+
+_ROLLUP_TABLES = tuple(_rollup_name(t, g) for t in _ROLLUP_SPEC for g in ROLLUP_GRAINS)
+_CACHE_DDL.update({_rollup_name(t, g): _rollup_ddl(t, g) for t in _ROLLUP_SPEC for g in ROLLUP_GRAINS})
+
+# Производные таблицы строятся не из «For dash», а из готовых кэш-таблиц (после них, в той же генерации)
+_DERIVED_CACHE_TABLES = (CACHE_CUM,) + _ROLLUP_TABLES
+_SWAP_TABLES = _ALL_CACHE_TABLES + _DERIVED_CACHE_TABLES
+
+# ── Теневые таблицы ───────────────────────────────────────────────────────────
+# Полная пересборка пишет в <table>__next (индексы — после заливки), затем одной транзакцией
+# переименовывает live → __old и __next → live вместе с индексами. Читатели всегда видят целое
+# поколение кэша; __old удаляется в фоне после commit.
+# Помесячная пересборка держит свои теневые копии (__monthly) между запусками — другие refresh их не трогают.
+_SHADOW_SUFFIX = "__next"
+_MONTHLY_SUFFIX = "__monthly"
+_OLD_SUFFIX = "__old"
+
+
+def _ddl_statements(ddl_block) -> list:
+    return [stmt.strip() for stmt in ddl_block.strip().split(";") if stmt.strip()]
+
+
+def _index_names(table) -> list:
+    return re.findall(r"INDEX IF NOT EXISTS (\w+)", _CACHE_DDL[table])
+
+
+def _shadow_name(table: str, suffix: str = _SHADOW_SUFFIX) -> str:
+    return table + suffix
+
+
+def _old_name(table: str) -> str:
+    return table + _OLD_SUFFIX
+
+
+_PARTITIONED_TABLES = _ALL_CACHE_TABLES
+
+
+def _partition_name(table: str, month) -> str:
+    return f"{table}_p{month:%Y%m}"
+
+
+def _partition_months(d_from=None, d_to=None) -> list:
+    """Начала месяцев [d_from, d_to]; по умолчанию — от CACHE_PARTITION_START до следующего за текущим."""
+    d_from = _period_start(d_from or CACHE_PARTITION_START, "month")
+    d_to = d_to or _period_start(datetime.now(timezone.utc).date(), "month") + timedelta(days=32)
+    months = []
+    while d_from <= d_to:
+        months.append(d_from)
+        d_from = _period_start(d_from + timedelta(days=32), "month")
+    return months
+
+
+def _month_partition_bounds(month) -> str:
+    next_month = _period_start(month + timedelta(days=32), "month")
+    return f"FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month.isoformat()}')"
+
+
+def _create_month_partitions(cur, table):
+    """Партиции новой (пустой) секционированной таблицы: помесячные + DEFAULT — одним запросом."""
+    stmts = [f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"]
+    stmts += [
+        f"CREATE TABLE IF NOT EXISTS {_partition_name(table, m)} PARTITION OF {table} {_month_partition_bounds(m)}"
+        for m in _partition_months()
+    ]
+    cur.execute(";\n".join(stmts))
+
+
+def _partitions(cur, table) -> list:
+    cur.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass", (table,))
+    return [row[0] for row in cur.fetchall()]
+
+
+def _rename_partition_indexes(cur, table: str, partition: str):
+    """Индексы секции (Postgres именует их сам, с обрезкой до 63 символов) → <секция>_<ключи индекса>."""
+    schema = table.split(".")[0]
+    cur.execute(
+        "SELECT c.relname, p.relname FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid "
+        "JOIN pg_inherits i ON i.inhrelid = x.indexrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE x.indrelid = %s::regclass",
+        (partition,),
+    )
+    for index, parent_index in cur.fetchall():
+        for key in _CACHE_INDEXES[table][0]:
+            name = f"{partition.split('.')[-1]}_{'_'.join(key)}"
+            if f"_{'_'.join(key)}_cov" in parent_index and index != name:
+                cur.execute(f"ALTER INDEX {schema}.{index} RENAME TO {name}")
+
+
+def _rename_partitions(cur, table: str, parent: str, old_prefix: str, new_prefix: str):
+    """Секции parent с именами <old_prefix>_… → <new_prefix>_… (вслед за переименованием родителя при swap)."""
+    schema = parent.split(".")[0]
+    for name in _partitions(cur, parent):
+        if name.startswith(old_prefix + "_"):
+            new_name = new_prefix + name[len(old_prefix):]
+            cur.execute(f"ALTER TABLE {schema}.{name} RENAME TO {new_name}")
+            _rename_partition_indexes(cur, table, f"{schema}.{new_name}")
+
+
+def _add_month_partition(cur, table, month):
+    """Новая месячная секция живой таблицы: строки этого месяца, попавшие в DEFAULT, переносятся в неё до ATTACH."""
+    part = _partition_name(table, month)
+    next_month = _period_start(month + timedelta(days=32), "month")
+    cur.execute(f"CREATE TABLE {part} (LIKE {table} INCLUDING DEFAULTS)")
+    cur.execute(
+        f"WITH moved AS (DELETE FROM {table}_default WHERE day >= %s AND day < %s RETURNING *) "
+        f"INSERT INTO {part} SELECT * FROM moved",
+        (month, next_month),
+    )
+    cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {part} {_month_partition_bounds(month)}")
+    _rename_partition_indexes(cur, table, part)
+
+
+def _extend_month_partitions(cur, table):
+    """Докладывает недостающие месячные секции живой таблицы (до следующего за текущим месяца)."""
+    existing = set(_partitions(cur, table))
+    for month in _partition_months():
+        if _partition_name(table, month).split(".")[-1] not in existing:
+            _add_month_partition(cur, table, month)
+
+
+def _shadow_ddl(table, suffix=_SHADOW_SUFFIX):
+    """(CREATE TABLE, [CREATE INDEX]) для теневой копии table: те же колонки, индексы с суффиксом suffix."""
+    create, indexes = None, []
+    for stmt in _ddl_statements(_CACHE_DDL[table]):
+        stmt = re.sub(re.escape(table) + r"\b", _shadow_name(table, suffix), stmt)
+        stmt = re.sub(r"(INDEX IF NOT EXISTS )(\w+)", lambda m: m.group(1) + m.group(2) + suffix, stmt)
+        if stmt.upper().startswith("CREATE TABLE"):
+            create = stmt
+        else:
+            indexes.append(stmt)
+    return create, indexes
+
+
+def _create_shadow_tables(cur, tables, suffix=_SHADOW_SUFFIX):
+    for table in tables:
+        cur.execute(f"DROP TABLE IF EXISTS {_shadow_name(table, suffix)}")
+        cur.execute(_shadow_ddl(table, suffix)[0])
+        if table in _PARTITIONED_TABLES:
+            _create_month_partitions(cur, _shadow_name(table, suffix))
+
+
+def _finish_shadow_tables(cur, tables, suffix=_SHADOW_SUFFIX):
+    """Индексы и статистика строятся по уже залитым данным — быстрее, чем поддерживать их при INSERT."""
+    for table in tables:
+        for stmt in _shadow_ddl(table, suffix)[1]:
+            cur.execute(stmt)
+        cur.execute(f"ANALYZE {_shadow_name(table, suffix)}")
+
+
+def _swap_in_shadow_tables(cur, tables, suffix=_SHADOW_SUFFIX, lock_timeout="15s"):
+    """Атомарная подмена live-таблиц теневыми (в текущей транзакции; видна читателям после commit)."""
+    cur.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+    for table in tables:
+        bare = table.split(".")[-1]
+        cur.execute(f"DROP TABLE IF EXISTS {_old_name(table)}")
+        for idx in _index_names(table):
+            cur.execute(f"ALTER INDEX IF EXISTS public.{idx} RENAME TO {idx}{_OLD_SUFFIX}")
+        cur.execute(f"ALTER TABLE IF EXISTS {table} RENAME TO {bare}{_OLD_SUFFIX}")
+        cur.execute(f"ALTER TABLE {_shadow_name(table, suffix)} RENAME TO {bare}")
+        if table in _PARTITIONED_TABLES:
+            cur.execute("SELECT to_regclass(%s)", (_old_name(table),))
+            if cur.fetchone()[0] is not None:
+                _rename_partitions(cur, table, _old_name(table), bare, bare + _OLD_SUFFIX)
+            _rename_partitions(cur, table, table, bare + suffix, bare)
+        for idx in _index_names(table):
+            cur.execute(f"ALTER INDEX public.{idx}{suffix} RENAME TO {idx}")
+
+
+def _drop_tables(engine, tables):
+    """DROP TABLE IF EXISTS в отдельной транзакции. Ошибки не критичны (следующий запуск удалит сам)."""
+    try:
+        with _pooled_connection(engine) as conn:
+            with conn.cursor() as cur:
+                for table in tables:
+                    cur.execute(f"DROP TABLE IF EXISTS {table}")
             conn.commit()
-            conn.close()
-        for sql in INSERT_CACHE_LANDING_PARTS:
-            conn = _connect_once(engine)
+    except Exception as e:
+        print(f"[refresh] drop {', '.join(tables)} ERROR: {e}")
+
+
+def _drop_tables_async(engine, tables):
+    threading.Thread(target=_drop_tables, args=(engine, list(tables)), daemon=True).start()
+
+
+def _drop_old_generations(engine, tables=_SWAP_TABLES):
+    """Удаляет вытесненные поколения (__old). Следующий swap удалит их сам, если здесь не вышло."""
+    _drop_tables(engine, [_old_name(table) for table in tables])
+
+
+def _drop_old_generations_async(engine, tables=_SWAP_TABLES):
+    _drop_tables_async(engine, [_old_name(table) for table in tables])
+
+
+def _migrate_dimension_columns(conn):
+    """Кэш-таблицы старой схемы (текст измерений в строке): значения — в справочники, рядом колонка <dim>_id;
+    текст удаляется (кроме _KEEP_TEXT_DIMENSIONS). Вызывается до DDL кэш-таблиц — их индексам нужны колонки <dim>_id;
+    прежние индексы по тексту убирает _drop_unmanaged_indexes."""
+    tables = [
+        (t, dims)
+        for base, dims in _TABLE_DIMENSIONS.items()
+        for t in (base, *(_rollup_name(base, g) for g in ROLLUP_GRAINS if base in _ROLLUP_SPEC))
+    ] + [(CACHE_CUM, ("region",))]
+    with conn.cursor() as cur:
+        for table, dims in tables:
+            schema, name = table.split(".")
+            cur.execute(
+                "SELECT column_name FROM information_schema.columns WHERE table_schema = %s AND table_name = %s",
+                (schema, name),
+            )
+            existing = {r[0] for r in cur.fetchall()}
+            for dim in dims:
+                if dim not in existing or f"{dim}_id" in existing:
+                    continue
+                print(f"[ensure_cache_table] {table}.{dim} → {dim}_id")
+                cur.execute(
+                    f"INSERT INTO {_dim_table(dim)} (value) SELECT DISTINCT {dim} FROM {table} WHERE {dim} IS NOT NULL "
+                    "ON CONFLICT ((md5(value))) DO NOTHING"
+                )
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN {dim}_id INT")
+                cur.execute(f"UPDATE {table} t SET {dim}_id = d.id FROM {_dim_table(dim)} d WHERE md5(d.value) = md5(t.{dim})")
+                if dim not in _KEEP_TEXT_DIMENSIONS:
+                    cur.execute(f"ALTER TABLE {table} DROP COLUMN {dim}")
+
+
+def _migrate_to_partitioned(conn):
+    """Кэш-таблицы старой схемы (обычная таблица) → секционированные по месяцам: старая переименовывается
+    в <таблица>__unpartitioned, создаётся новая с секциями, строки переносятся, старая удаляется.
+    Недостроенные теневые копии старой схемы удаляются — помесячная пересборка начнётся заново."""
+    with conn.cursor() as cur:
+        for table in _PARTITIONED_TABLES:
+            schema, bare = table.split(".")
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+            row = cur.fetchone()
+            if row is None or row[0] != "r":
+                continue
+            print(f"[ensure_cache_table] {table} → PARTITION BY RANGE (day)")
+            legacy = f"{table}__unpartitioned"
+            cur.execute(f"DROP TABLE IF EXISTS {_shadow_name(table)}, {_shadow_name(table, _MONTHLY_SUFFIX)}, {legacy}")
+            cur.execute(f"ALTER TABLE {table} RENAME TO {bare}__unpartitioned")
+            cur.execute("SELECT indexname FROM pg_indexes WHERE schemaname = %s AND tablename = %s", (schema, f"{bare}__unpartitioned"))
+            for (index,) in cur.fetchall():
+                cur.execute(f"DROP INDEX {schema}.{index}")
+            _run_ddl(conn, _CACHE_DDL[table])
+            _create_month_partitions(cur, table)
+            for name in _partitions(cur, table):
+                _rename_partition_indexes(cur, table, f"{schema}.{name}")
+            cur.execute(
+                "SELECT n.column_name FROM information_schema.columns n JOIN information_schema.columns o "
+                "ON o.table_schema = n.table_schema AND o.column_name = n.column_name AND o.table_name = %s "
+                "WHERE n.table_schema = %s AND n.table_name = %s ORDER BY n.ordinal_position",
+                (f"{bare}__unpartitioned", schema, bare),
+            )
+            cols = ", ".join(r[0] for r in cur.fetchall())
+            cur.execute(f"INSERT INTO {table} ({cols}) SELECT {cols} FROM {legacy}")
+            cur.execute(f"DROP TABLE {legacy}")
+
+
+def _ensure_month_partitions(conn):
+    """Секции живых таблиц: у новой — все сразу; у существующей — недостающие месяцы (строки из DEFAULT переносятся)."""
+    with conn.cursor() as cur:
+        for table in _PARTITIONED_TABLES:
+            if _partitions(cur, table):
+                _extend_month_partitions(cur, table)
+            else:
+                _create_month_partitions(cur, table)
+                for name in _partitions(cur, table):
+                    _rename_partition_indexes(cur, table, f"{table.split('.')[0]}.{name}")
+
+
+def _drop_unmanaged_indexes(conn):
+    """Удаляет с кэш-таблиц индексы, которых нет в _CACHE_INDEXES (прежние (day)/(region, day) и т.п.)."""
+    with conn.cursor() as cur:
+        for table in _SWAP_TABLES:
+            schema, name = table.split(".")
+            cur.execute("SELECT indexname FROM pg_indexes WHERE schemaname = %s AND tablename = %s", (schema, name))
+            managed = set(_index_names(table))
+            for (index,) in cur.fetchall():
+                if index not in managed:
+                    print(f"[ensure_cache_table] drop index {schema}.{index}")
+                    cur.execute(f"DROP INDEX IF EXISTS {schema}.{index}")
+
+
+def _vacuum_cache_tables(engine, tables):
+    """VACUUM таблиц/секций, переписанных refresh ({таблица: статистика уже собрана}): карта видимости нужна
+    для Index Only Scan; ANALYZE — только где его не было. Отдельное соединение в autocommit
+    (VACUUM нельзя в транзакции); ошибки не критичны."""
+    if not tables:
+        return
+    try:
+        conn = _connect_once(engine)
+    except Exception as e:
+        print(f"[refresh] vacuum ERROR: {e}")
+        return
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            for table, analyzed in tables.items():
+                cur.execute(f"VACUUM {table}" if analyzed else f"VACUUM (ANALYZE) {table}")
+    except Exception as e:
+        print(f"[refresh] vacuum ERROR: {e}")
+    finally:
+        conn.close()
+
+
+def _vacuum_cache_tables_async(engine, tables):
+    threading.Thread(target=_vacuum_cache_tables, args=(engine, dict(tables)), daemon=True).start()
+
+
+def _apply_cache_ddl(conn):
+    for dim in DIMENSIONS:
+        _run_ddl(conn, _dim_ddl(dim))
+    _migrate_dimension_columns(conn)
+    _migrate_to_partitioned(conn)
+    for table in _SWAP_TABLES:
+        _run_ddl(conn, _CACHE_DDL[table])
+    _ensure_month_partitions(conn)
+    _drop_unmanaged_indexes(conn)
+    _run_ddl(conn, DDL_CACHE_META)
+    _run_ddl(conn, DDL_REFRESH_PROGRESS)
+    _run_ddl(conn, DDL_REFRESH_LOG)
+    _run_ddl(conn, DDL_SCHEMA_VERSION)
+    with conn.cursor() as cur:
+        cur.execute(
+            f"INSERT INTO {SCHEMA_VERSION_TABLE} (id, version) VALUES (1, %s) "
+            "ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version, applied_at = now()",
+            (CACHE_SCHEMA_VERSION,),
+        )
+
+
+def ensure_cache_table(engine):
+    """Создаёт все таблицы кэша и индексы (только DDL, без ANALYZE — он занимает ~57с) и записывает
+    CACHE_SCHEMA_VERSION. Применяет DDL безусловно; дашборд вызывает migrate_cache_schema() — только при смене версии."""
+    with _pooled_connection(engine) as conn:
+        _apply_cache_ddl(conn)
+        conn.commit()
+
+
+_SCHEMA_LOCK = threading.Lock()
+_SCHEMA_STATE = {"version": None}
+
+
+def _schema_version(cur):
+    cur.execute("SELECT to_regclass(%s)", (SCHEMA_VERSION_TABLE,))
+    if cur.fetchone()[0] is None:
+        return None
+    cur.execute(f"SELECT version FROM {SCHEMA_VERSION_TABLE} WHERE id = 1")
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def migrate_cache_schema(engine) -> bool:
+    """Приводит схему кэша к CACHE_SCHEMA_VERSION. Проверка — один раз на процесс: дальше вызов ничего не делает.
+    Если версия в kpi_schema_version уже актуальна — один SELECT без DDL и без блокировок каталога.
+    Иначе под pg_advisory_xact_lock(SCHEMA_LOCK_KEY) (реплики не применяют DDL одновременно) повторно читает версию,
+    применяет DDL ensure_cache_table (вместе с записью версии — одна транзакция). True — DDL применялся."""
+    with _SCHEMA_LOCK:
+        if _SCHEMA_STATE["version"] == CACHE_SCHEMA_VERSION:
+            return False
+        applied = False
+        with _pooled_connection(engine) as conn:
             with conn.cursor() as cur:
-                cur.execute(sql)
+                version = _schema_version(cur)
+                if version is None or version < CACHE_SCHEMA_VERSION:
+                    cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_KEY,))
+                    version = _schema_version(cur)
+                if version is None or version < CACHE_SCHEMA_VERSION:
+                    print(f"[migrate_cache_schema] {version} → {CACHE_SCHEMA_VERSION}")
+                    _apply_cache_ddl(conn)
+                    applied = True
             conn.commit()
-            conn.close()
+        _SCHEMA_STATE["version"] = CACHE_SCHEMA_VERSION
+        return applied
+
+
+def _is_connection_error(e):
+    """Обрыв соединения (EOF, timeout) — имеет смысл повторить."""
+    msg = str(e).lower()
+    return (
+        "eof detected" in msg
+        or "connection" in msg
+        or "ssl syscall" in msg
+        or "timed out" in msg
+        or "statement_timeout" in msg
+    )
+
+
+def _month_ranges(min_d, max_d):
+    """Итератор (d_from, d_to) по месяцам от min_d до max_d включительно."""
+    from datetime import date
+    from calendar import monthrange
+    if min_d is None or max_d is None or min_d > max_d:
+        return
+    y, m = min_d.year, min_d.month
+    end_y, end_m = max_d.year, max_d.month
+    while (y, m) <= (end_y, end_m):
+        start = date(y, m, 1)
+        last = monthrange(y, m)[1]
+        stop = date(y, m, last)
+        if start < min_d:
+            start = min_d
+        if stop > max_d:
+            stop = max_d
+        yield (start, stop)
+        if m == 12:
+            y, m = y + 1, 1
+        else:
+            m += 1
+
+
+def _source_has_column(cur, column: str) -> bool:
+    cur.execute(
+        "SELECT 1 FROM information_schema.columns WHERE table_schema = 'public' AND table_name = %s AND column_name = %s",
+        (TABLE.strip('"'), column),
+    )
+    return cur.fetchone() is not None
+
+
+def _source_watermark(cur):
+    """MAX(updated_at) источника; None, если колонки нет (тогда доступен только полный refresh)."""
+    if not _source_has_column(cur, SOURCE_UPDATED_COLUMN):
+        return None
+    cur.execute(f"SELECT MAX({SOURCE_UPDATED_COLUMN}) FROM public.{TABLE}")
+    return cur.fetchone()[0]
+
+
+def _read_meta_watermark(cur):
+    cur.execute(f"SELECT source_watermark FROM {CACHE_META} WHERE id = 1")
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def _write_meta(cur, watermark, mode: str, bump: bool = True):
+    """Пишет watermark и режим; bump — новое поколение кэша (UI сбрасывает свои кэши по cache_generation())."""
+    cur.execute(
+        f"""
+        INSERT INTO {CACHE_META} AS m (id, source_watermark, refresh_mode, refreshed_at, generation)
+        VALUES (1, %s, %s, now(), 1)
+        ON CONFLICT (id) DO UPDATE SET
+          source_watermark = EXCLUDED.source_watermark,
+          refresh_mode     = EXCLUDED.refresh_mode,
+          refreshed_at     = EXCLUDED.refreshed_at,
+          generation       = m.generation + CASE WHEN %s THEN 1 ELSE 0 END
+        """,
+        (watermark, mode, bump),
+    )
+    # То, что дашборд раньше считал агрегатами по kpi_daily_region на каждом rerun. Без полных сканов:
+    # min/max — по индексу day, регионы — skip scan по индексу (region_id, day), число строк — оценка
+    # pg_class.reltuples по секциям (refresh делает ANALYZE переписанного; для проверок «пусто/собрано» хватает)
+    cur.execute(
+        f"""
+        UPDATE {CACHE_META} SET
+          min_day    = (SELECT MIN(day) FROM {CACHE_TABLE}),
+          max_day    = (SELECT MAX(day) FROM {CACHE_TABLE}),
+          regions    = ARRAY(
+            WITH RECURSIVE r AS (
+              (SELECT region_id FROM {CACHE_TABLE} ORDER BY region_id LIMIT 1)
+              UNION ALL
+              SELECT (SELECT k.region_id FROM {CACHE_TABLE} k WHERE k.region_id > r.region_id ORDER BY k.region_id LIMIT 1)
+              FROM r WHERE r.region_id IS NOT NULL
+            )
+            SELECT d.value FROM r JOIN {_dim_table("region")} d ON d.id = r.region_id
+            WHERE TRIM(d.value) <> '' ORDER BY 1
+          ),
+          row_counts = (
+            SELECT jsonb_object_agg(split_part(t, '.', 2), (
+              SELECT COALESCE(SUM(GREATEST(c.reltuples, 0)), 0)::bigint FROM pg_class c
+              WHERE (c.oid = to_regclass(t) AND c.relkind = 'r')
+                 OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(t))
+            ))
+            FROM unnest(%s::text[]) t
+          )
+        WHERE id = 1
+        """,
+        (list(_SWAP_TABLES),),
+    )
+
+
+def _touched_days(cur, watermark) -> list:
+    """Дни (МСК) всех событий лидов, изменённых после watermark, + последние INCREMENTAL_LOOKBACK_DAYS дней.
+    UTM_FILTER здесь не применяется: лид, «выпавший» из фильтра, тоже должен пропасть из своих дней.
+    Перекрытие 5 мин — на транзакции ETL, закоммиченные позже, чем взят watermark."""
+    day_values = ", ".join(f"(s.{alias})" for alias, _ in _EVENT_DAY_EXPRS)
+    cur.execute(
+        f"""
+        SELECT v.day
+        FROM (SELECT {", ".join(f"{expr} AS {alias}" for alias, expr in _EVENT_DAY_EXPRS)}
+              FROM public.{TABLE} WHERE {SOURCE_UPDATED_COLUMN} > %s::timestamptz - interval '5 minutes') s
+        CROSS JOIN LATERAL (VALUES {day_values}) AS v(day)
+        WHERE v.day IS NOT NULL
+        UNION
+        SELECT (now() AT TIME ZONE 'Europe/Moscow')::date - g FROM generate_series(0, %s) g
+        """,
+        (watermark, max(INCREMENTAL_LOOKBACK_DAYS - 1, 0)),
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+class _RefreshLog:
+    """Журнал одного запуска refresh. Шаги копятся в памяти и пишутся в kpi_refresh_log отдельной
+    транзакцией в конце — откат refresh не стирает запись об ошибке. Потокобезопасен (параллельные задачи)."""
+
+    def __init__(self, mode: str):
+        self.run_id = uuid.uuid4().hex
+        self.mode = mode
+        self.attempt = 0
+        self.started_at = datetime.now(timezone.utc)
+        self._t0 = time.perf_counter()
+        self._entries = []
+        self._lock = threading.Lock()
+        # Переписанные таблицы/секции → статистика уже собрана (см. rewritten)
+        self.vacuum = {}
+
+    def _append(self, entry):
+        with self._lock:
+            self._entries.append(entry)
+
+    def rewritten(self, tables, analyzed=False):
+        """Отмечает таблицы, переписанные запуском: после успешного refresh их вакуумирует _vacuum_cache_tables."""
+        with self._lock:
+            for table in tables:
+                self.vacuum[table] = self.vacuum.get(table, True) and analyzed
+
+    @contextmanager
+    def step(self, name: str, retries=None):
+        entry = {
+            "step": name,
+            "started_at": datetime.now(timezone.utc),
+            "rows": None,
+            "retries": self.attempt if retries is None else retries,
+            "error": None,
+        }
+        t0 = time.perf_counter()
+        try:
+            yield entry
+        except Exception as e:
+            entry["error"] = str(e)[:2000]
+            raise
+        finally:
+            entry["finished_at"] = datetime.now(timezone.utc)
+            entry["duration_ms"] = int((time.perf_counter() - t0) * 1000)
+            self._append(entry)
+
+    def execute(self, cur, name: str, sql: str, params=None):
+        with self.step(name) as entry:
+            cur.execute(sql, params)
+            entry["rows"] = cur.rowcount if cur.rowcount >= 0 else None
+
+    def single_pass(self, cur, sql: str, label: str = ""):
+        """Один statement заливает несколько таблиц: запись на statement + по записи на таблицу
+        (время общее, строки — свои)."""
+        suffix = f" {label}" if label else ""
+        with self.step("single_pass" + suffix) as entry:
+            cur.execute(sql)
+            counts = dict(zip([d[0] for d in cur.description], cur.fetchone()))
+            entry["rows"] = sum(counts.values())
+        for table, rows in counts.items():
+            self._append(dict(entry, step=f"insert:{table}{suffix}", rows=rows))
+
+    def flush(self, engine, ok: bool, error):
+        with self._lock:
+            entries = list(self._entries)
+        entries.append({
+            "step": "run",
+            "started_at": self.started_at,
+            "finished_at": datetime.now(timezone.utc),
+            "duration_ms": int((time.perf_counter() - self._t0) * 1000),
+            "rows": sum(e["rows"] or 0 for e in entries if e["step"].startswith("insert:")),
+            "retries": self.attempt,
+            "error": None if ok else str(error)[:2000],
+        })
+        try:
+            with _pooled_connection(engine) as conn:
+                with conn.cursor() as cur:
+                    cur.executemany(
+                        f"""
+                        INSERT INTO {REFRESH_LOG}
+                          (run_id, mode, step, started_at, finished_at, duration_ms, rows, retries, error)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        """,
+                        [
+                            (self.run_id, self.mode, e["step"], e["started_at"], e["finished_at"],
+                             e["duration_ms"], e["rows"], e["retries"], e["error"])
+                            for e in entries
+                        ],
+                    )
+                    cur.execute(
+                        f"DELETE FROM {REFRESH_LOG} WHERE started_at < now() - %s * interval '1 day'",
+                        (REFRESH_LOG_RETENTION_DAYS,),
+                    )
+                conn.commit()
+        except Exception as e:
+            print(f"[refresh] log write ERROR: {e}")
+
+
+@contextmanager
+def _refresh_lock(engine):
+    """pg_try_advisory_lock(REFRESH_LOCK_KEY) на отдельном autocommit-соединении; yield — взята ли блокировка.
+    Все режимы refresh пишут в одни и те же __next/__old/__monthly, поэтому одновременно идёт только один."""
+    conn = _connect_once(engine)
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (REFRESH_LOCK_KEY,))
+            yield cur.fetchone()[0]
+    finally:
+        # Закрытие соединения снимает сессионную блокировку даже при сбое unlock
+        conn.close()
+
+
+def _run_logged(engine, mode: str, body):
+    """body(log) -> (ok, error); исключение — (False, str(e)). Запуск записывается в kpi_refresh_log.
+    Под _refresh_lock: если refresh уже идёт (в этом или другом процессе) — (False, REFRESH_BUSY) без запуска и записи."""
+    with _refresh_lock(engine) as acquired:
+        if not acquired:
+            print(f"[refresh] {mode}: {REFRESH_BUSY}")
+            return (False, REFRESH_BUSY)
+        log = _RefreshLog(mode)
+        try:
+            result = body(log)
+        except Exception as e:
+            result = (False, str(e))
+        if result[0]:
+            _invalidate_cache_state()
+            # Читатели уже видят новое поколение; VACUUM — в фоне, не задерживая возврат refresh
+            _vacuum_cache_tables_async(engine, log.vacuum)
+        log.flush(engine, *result)
+    return result
+
+
+_CUM_METRICS = ("leads", "prequals", "quals", "pokaz_naznachen", "shows", "passports", "broni", "deals", "commission", "summa")
+
+
+def _build_cum(cur, source: str, target: str):
+    """Перестраивает target (накопительные итоги) по source (kpi_daily_region, его теневая копия или подзапрос).
+    Таблица маленькая (регионы × дни), поэтому всегда целиком — в том числе при инкрементальном refresh."""
+    running = ",\n          ".join(f"SUM(COALESCE(k.{m}, 0)) OVER w AS {m}" for m in _CUM_METRICS) + ",\n          COUNT(k.day) OVER w AS n_rows"
+    cur.execute(f"DELETE FROM {target}")
+    cur.execute(
+        f"""
+        INSERT INTO {target} (region, region_id, day, {", ".join(_CUM_METRICS)}, n_rows)
+        WITH b AS (SELECT MIN(day) - 1 AS d0, MAX(day) AS d1 FROM {source} s),
+        grid AS (
+          SELECT r.region, r.region_id, g::date AS day
+          FROM (SELECT DISTINCT region, region_id FROM {source} s) r
+          CROSS JOIN b
+          CROSS JOIN generate_series(b.d0, b.d1, interval '1 day') g
+        )
+        SELECT grid.region, grid.region_id, grid.day,
+          {running}
+        FROM grid
+        LEFT JOIN {source} k ON k.region_id IS NOT DISTINCT FROM grid.region_id AND k.day = grid.day
+        WINDOW w AS (PARTITION BY grid.region_id ORDER BY grid.day)
+        """
+    )
+
+
+def _build_cum_shadow(cur, log, suffix=_SHADOW_SUFFIX):
+    with log.step("cum"):
+        _create_shadow_tables(cur, [CACHE_CUM], suffix)
+        _build_cum(cur, _shadow_name(CACHE_TABLE, suffix), _shadow_name(CACHE_CUM, suffix))
+
+
+def _rollup_insert_sql(table: str, grain: str, source: str, target: str, source_pred: str = "TRUE") -> str:
+    dims, metrics = _ROLLUP_SPEC[table]
+    bucket = f"date_trunc('{grain}', day)::date"
+    cols = ("region", "region_id", "day", *dims, *metrics)
+    select = ("region", "region_id", f"{bucket} AS day", *dims, *(f"SUM({m}) AS {m}" for m in metrics))
+    return (
+        f"INSERT INTO {target} ({', '.join(cols)}) "
+        f"SELECT {', '.join(select)} FROM {source} s WHERE {source_pred} "
+        f"GROUP BY region, region_id, {bucket}{''.join(', ' + d for d in dims)}"
+    )
+
+
+def _build_rollup_shadows(cur, log, tables=tuple(_ROLLUP_SPEC), suffix=_SHADOW_SUFFIX):
+    """Свёртки в теневые таблицы из теневых дневных (полная пересборка)."""
+    for table in tables:
+        with log.step(f"rollup:{table.split('.')[-1]}"):
+            _create_shadow_tables(cur, [_rollup_name(table, g) for g in ROLLUP_GRAINS], suffix)
+            for grain in ROLLUP_GRAINS:
+                cur.execute(
+                    _rollup_insert_sql(table, grain, _shadow_name(table, suffix), _shadow_name(_rollup_name(table, grain), suffix))
+                )
+
+
+def _period_start(day, grain: str):
+    return day.replace(day=1) if grain == "month" else day - timedelta(days=day.weekday())
+
+
+def _period_end(start, grain: str):
+    if grain == "week":
+        return start + timedelta(days=6)
+    return (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+
+def _future_source(table: str, arr: str) -> str:
+    """Дневная таблица «после инкремента» (подзапрос): live без пересчитанных дней + их новые строки из delta."""
+    return f"(SELECT * FROM {table} WHERE NOT day = ANY({arr}) UNION ALL SELECT * FROM {_delta_name(table)})"
+
+
+def _build_incremental_shadows(cur, log, days):
+    """Инкремент: накопительная и свёртки в теневые таблицы по дневным данным «после инкремента» (_future_source).
+    Свёртки копируют нетронутые недели/месяцы из live и пересобирают только те, куда попали пересчитанные дни."""
+    arr = _date_array_sql(days)
+    with log.step("cum"):
+        _create_shadow_tables(cur, [CACHE_CUM])
+        _build_cum(cur, _future_source(CACHE_TABLE, arr), _shadow_name(CACHE_CUM))
+    for grain in ROLLUP_GRAINS:
+        starts = sorted({_period_start(d, grain) for d in days})
+        pred = " OR ".join(_day_between_pred(p, _period_end(p, grain))("day") for p in starts)
+        for table, (dims, metrics) in _ROLLUP_SPEC.items():
+            target = _rollup_name(table, grain)
+            cols = ", ".join(("region", "region_id", "day", *dims, *metrics))
+            with log.step(f"rollup:{target.split('.')[-1]}") as entry:
+                _create_shadow_tables(cur, [target])
+                cur.execute(
+                    f"INSERT INTO {_shadow_name(target)} ({cols}) "
+                    f"SELECT {cols} FROM {target} WHERE NOT day = ANY({_date_array_sql(starts)})"
+                )
+                cur.execute(_rollup_insert_sql(table, grain, _future_source(table, arr), _shadow_name(target), f"({pred})"))
+                entry["rows"] = cur.rowcount
+    with log.step("finish_shadow"):
+        _finish_shadow_tables(cur, _DERIVED_CACHE_TABLES)
+
+
+def _refresh_full(cur, log):
+    """Полная пересборка в теневые таблицы + swap. Live-таблицы не блокируются до самого swap."""
+    watermark = _source_watermark(cur)
+    with log.step("create_shadow"):
+        _create_shadow_tables(cur, _ALL_CACHE_TABLES)
+    # Один скан «For dash» на все кэш-таблицы
+    log.single_pass(cur, _single_pass_refresh_sql(targets={t: _shadow_name(t) for t in _ALL_CACHE_TABLES}))
+    _build_cum_shadow(cur, log)
+    _build_rollup_shadows(cur, log)
+    with log.step("finish_shadow"):
+        _finish_shadow_tables(cur, _SWAP_TABLES)
+    with log.step("swap"):
+        _swap_in_shadow_tables(cur, _SWAP_TABLES)
+    log.rewritten(_SWAP_TABLES, analyzed=True)
+    _write_meta(cur, watermark, "full")
+
+
+def _delta_name(table: str) -> str:
+    return f"pg_temp.{table.split('.')[-1]}__delta"
+
+
+def _default_next_name(table: str) -> str:
+    return f"{table}_default{_SHADOW_SUFFIX}"
+
+
+def _rebuild_touched_partitions(cur, log, days) -> tuple:
+    """Пересчёт затронутых дней помесячными секциями: single pass пишет новые строки во временные delta-таблицы,
+    для каждого затронутого месяца собирается <секция>__next (нетронутые дни секции + delta) — с индексами,
+    статистикой и CHECK по границам месяца, чтобы ATTACH не сканировал её под блокировкой. Для дней в DEFAULT-секции
+    новые строки откладываются в <table>_default__next. Живые таблицы не трогаются: возвращает
+    ([(table, month)], [table с DEFAULT-днями]) для _swap_incremental."""
+    arr = _date_array_sql(days)
+    months = sorted({_period_start(day, "month") for day in days})
+    for table in _ALL_CACHE_TABLES:
+        cur.execute(f"CREATE TEMP TABLE {_delta_name(table).split('.')[-1]} (LIKE {table}) ON COMMIT DROP")
+    log.single_pass(
+        cur,
+        _single_pass_refresh_sql(day_pred=_day_in_pred(days), targets={t: _delta_name(t) for t in _ALL_CACHE_TABLES}),
+    )
+    swaps, defaults = [], []
+    for table in _ALL_CACHE_TABLES:
+        existing = set(_partitions(cur, table))
+        cur.execute(f"DROP TABLE IF EXISTS {_default_next_name(table)}")
+        for month in months:
+            part = _partition_name(table, month)
+            next_month = _period_start(month + timedelta(days=32), "month")
+            in_month = f"day >= DATE '{month.isoformat()}' AND day < DATE '{next_month.isoformat()}'"
+            bare = part.split(".")[-1]
+            if bare not in existing:
+                if table not in defaults:
+                    cur.execute(f"CREATE TABLE {_default_next_name(table)} (LIKE {table})")
+                    defaults.append(table)
+                cur.execute(f"INSERT INTO {_default_next_name(table)} SELECT * FROM {_delta_name(table)} WHERE {in_month}")
+                continue
+            with log.step(f"partition:{bare}") as entry:
+                shadow = f"{part}{_SHADOW_SUFFIX}"
+                cur.execute(f"DROP TABLE IF EXISTS {shadow}")
+                cur.execute(f"CREATE TABLE {shadow} (LIKE {table} INCLUDING DEFAULTS INCLUDING INDEXES)")
+                cur.execute(f"INSERT INTO {shadow} SELECT * FROM {part} WHERE NOT day = ANY({arr})")
+                cur.execute(f"INSERT INTO {shadow} SELECT * FROM {_delta_name(table)} WHERE {in_month}")
+                entry["rows"] = cur.rowcount
+                cur.execute(f"ALTER TABLE {shadow} ADD CONSTRAINT {bare}_bounds CHECK (day IS NOT NULL AND {in_month})")
+                cur.execute(f"ANALYZE {shadow}")
+            swaps.append((table, month))
+    return swaps, defaults
+
+
+def _swap_partition(cur, table, month):
+    """DETACH старой секции и ATTACH собранной <секция>__next (DETACH CONCURRENTLY недоступен при DEFAULT-секции
+    и не работает в транзакции)."""
+    schema = table.split(".")[0]
+    part = _partition_name(table, month)
+    bare = part.split(".")[-1]
+    cur.execute(f"ALTER TABLE {table} DETACH PARTITION {part}")
+    cur.execute(f"DROP TABLE {part}")
+    cur.execute(f"ALTER TABLE {part}{_SHADOW_SUFFIX} RENAME TO {bare}")
+    cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {schema}.{bare} {_month_partition_bounds(month)}")
+    cur.execute(f"ALTER TABLE {part} DROP CONSTRAINT {bare}_bounds")
+    _rename_partition_indexes(cur, table, part)
+
+
+def _refresh_incremental(cur, log):
+    """Первая (длинная) транзакция инкремента: затронутые дни, секции __next, теневые накопительная и свёртки.
+    None — нет watermark, нужен полный refresh; иначе (watermark, old_watermark, days, swaps, defaults)."""
+    old_watermark = _read_meta_watermark(cur)
+    watermark = _source_watermark(cur)
+    if old_watermark is None or watermark is None:
+        return None
+    with log.step("touched_days") as entry:
+        days = _touched_days(cur, old_watermark)
+        entry["rows"] = len(days)
+    with log.step("extend_partitions"):
+        for table in _ALL_CACHE_TABLES:
+            _extend_month_partitions(cur, table)
+    swaps, defaults = [], []
+    if days:
+        swaps, defaults = _rebuild_touched_partitions(cur, log, days)
+        _build_incremental_shadows(cur, log, days)
+    return watermark, old_watermark, days, swaps, defaults
+
+
+def _swap_incremental(cur, watermark, old_watermark, days, swaps, defaults):
+    """Последняя короткая транзакция инкремента: подмена всех секций, строки DEFAULT-секций, swap накопительной
+    и свёрток, meta. Всё собрано заранее — здесь только DDL и мелкий DML, поэтому читатели видят либо старое
+    поколение целиком, либо новое. Watermark двигается только здесь: если подмена сорвалась, следующий инкремент
+    пересчитает те же дни."""
+    cur.execute("SET LOCAL lock_timeout = '5s'")
+    for table, month in swaps:
+        _swap_partition(cur, table, month)
+    if days:
+        for table in defaults:
+            cur.execute(f"DELETE FROM {table}_default WHERE day = ANY({_date_array_sql(days)})")
+            cur.execute(f"INSERT INTO {table} SELECT * FROM {_default_next_name(table)}")
+            cur.execute(f"DROP TABLE {_default_next_name(table)}")
+        _swap_in_shadow_tables(cur, _DERIVED_CACHE_TABLES, lock_timeout="5s")
+    # Источник не менялся (watermark тот же) — пересчёт lookback дал те же строки, поколение не трогаем
+    _write_meta(cur, watermark, "incremental", bump=watermark != old_watermark)
+
+
+def _finish_incremental(engine, log, incremental):
+    """_swap_incremental отдельной транзакцией; при занятой блокировке (lock_timeout) — повтор."""
+    watermark, old_watermark, days, swaps, defaults = incremental
+    for attempt in range(5):
+        try:
+            with log.step("swap", retries=attempt):
+                with _pooled_connection(engine) as conn:
+                    with conn.cursor() as cur:
+                        _swap_incremental(cur, watermark, old_watermark, days, swaps, defaults)
+                    conn.commit()
+            break
+        except psycopg2.errors.LockNotAvailable:
+            if attempt == 4:
+                raise
+            time.sleep(1 + attempt)
+    log.rewritten([_partition_name(table, month) for table, month in swaps], analyzed=True)
+    log.rewritten([f"{table}_default" for table in defaults])
+    if days:
+        log.rewritten(_DERIVED_CACHE_TABLES, analyzed=True)
+        _drop_old_generations_async(engine, _DERIVED_CACHE_TABLES)
+
+
+def _prefill_dimensions(cur, log, mode: str):
+    """Справочники до снимка refresh (см. _fill_dimensions): инкремент — по лидам с событиями в затронутые дни,
+    полный — по всему источнику. Лиды, изменённые уже после этого шага, могут дать значение без id —
+    refresh тогда падает с _MISSING_DIM_ERROR и повторяется (refresh_kpi_daily_region)."""
+    if mode == "incremental":
+        old_watermark = _read_meta_watermark(cur)
+        if old_watermark is not None:
+            days = _touched_days(cur, old_watermark)
+            if days:
+                _fill_dimensions(cur, log, day_pred=_day_in_pred(days))
+            return
+    _fill_dimensions(cur, log)
+
+
+def refresh_kpi_daily_region(engine, mode="full"):
+    """Перезаливка кэш-таблиц из 'For dash'.
+
+    mode="full" — полный пересчёт в теневые таблицы + swap; mode="incremental" — пересборка месячных секций
+    с днями, затронутыми лидами с updated_at > watermark из kpi_cache_meta (нет watermark → полный пересчёт).
+    Инкремент — два шага: сборка секций __next, теневых накопительной и свёрток (один снимок), затем одна короткая
+    транзакция подменяет всё сразу и пишет meta (_swap_incremental). Инкремент не видит удалённые лиды и старые значения сдвинутых дат
+    старше lookback — для этого full. Каждый запуск пишется в kpi_refresh_log (см. refresh_runs()).
+    """
+
+    def body(log):
+        max_attempts = 3
+        last_error = None
+        for attempt in range(max_attempts):
+            log.attempt = attempt
+            try:
+                incremental = None
+                with _pooled_connection(engine) as conn:
+                    with conn.cursor() as cur:
+                        cur.execute("SET LOCAL statement_timeout = '600000'")
+                        _prefill_dimensions(cur, log, mode)
+                    conn.commit()
+                    with conn.cursor() as cur:
+                        # Один снимок на весь пересчёт: watermark и пересчёт видят одни и те же данные
+                        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                        # SET LOCAL — таймаут не «утекает» в пул вместе с соединением
+                        cur.execute("SET LOCAL statement_timeout = '600000'")
+                        if mode == "incremental":
+                            incremental = _refresh_incremental(cur, log)
+                        if incremental is None:
+                            log.mode = "full"
+                            _refresh_full(cur, log)
+                    conn.commit()
+                if incremental is None:
+                    _drop_old_generations_async(engine)
+                    return (True, None)
+                _finish_incremental(engine, log, incremental)
+                return (True, None)
+            except Exception as e:
+                last_error = e
+                if attempt < max_attempts - 1 and _MISSING_DIM_ERROR in str(e):
+                    # Источник успел получить новое значение измерения — дозаполнить справочник и повторить
+                    continue
+                if attempt < max_attempts - 1 and _is_connection_error(e):
+                    time.sleep(5 * (attempt + 1))
+                    continue
+                return (False, str(e))
+        return (False, str(last_error) if last_error else "неизвестная ошибка")
+
+    return _run_logged(engine, mode, body)
+
+
+def _run_refresh_tasks(engine, tasks, max_workers, log, snapshot_id=None, statement_timeout_ms=600000) -> dict:
+    """Исполнитель refresh: tasks = {имя: (fn(cur, log), зависимости)}.
+
+    Каждая задача — отдельная транзакция на своём соединении пула (commit атомарен по задаче);
+    стартует, когда все зависимости завершились успешно; при упавшей зависимости — пропускается.
+    snapshot_id — общий экспортированный снимок (pg_export_snapshot), чтобы все таблицы видели одни данные.
+    Задачи с зависимостями идут в свежем снимке: им нужны строки, закоммиченные предшественниками.
+    Возвращает {имя: None | текст ошибки}.
+    """
+
+    def _run(name, fn, snapshot_id):
+        for attempt in range(3):
+            try:
+                with log.step(f"task:{name.split('.')[-1]}", retries=attempt):
+                    with _pooled_connection(engine) as conn:
+                        with conn.cursor() as cur:
+                            if snapshot_id:
+                                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                                cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+                            cur.execute(f"SET LOCAL statement_timeout = '{int(statement_timeout_ms)}'")
+                            fn(cur, log)
+                        conn.commit()
+                return
+            except Exception as e:
+                if attempt < 2 and _is_connection_error(e):
+                    time.sleep(5 * (attempt + 1))
+                    continue
+                raise
+
+    results = {}
+    pending = dict(tasks)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as ex:
+        while pending or running:
+            for name, (fn, deps) in list(pending.items()):
+                if any(results.get(dep) is not None for dep in deps if dep in results):
+                    results[name] = "пропущено: упала зависимость"
+                    del pending[name]
+                elif all(dep in results for dep in deps):
+                    running[ex.submit(_run, name, fn, None if deps else snapshot_id)] = name
+                    del pending[name]
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                name = running.pop(fut)
+                exc = fut.exception()
+                results[name] = None if exc is None else str(exc)
+    for name in pending:
+        results[name] = "неразрешимые зависимости"
+    return results
+
+
+def _stage_source(cur, log, source: str):
+    """Один скан «For dash»: строки src single-pass (уже с UTM_FILTER и вычисленными днями) → UNLOGGED-таблица source."""
+    with log.step("stage_source") as entry:
+        cur.execute(f"DROP TABLE IF EXISTS {source}")
+        cur.execute(f"CREATE UNLOGGED TABLE {source} AS {_SINGLE_PASS_SRC_SQL}")
+        entry["rows"] = cur.rowcount
+
+
+def _shadow_rebuild_task(table, source):
+    def run(cur, log):
+        bare = table.split(".")[-1]
+        with log.step(f"create_shadow:{bare}"):
+            _create_shadow_tables(cur, [table])
+        log.single_pass(
+            cur, _single_pass_refresh_sql([table], targets={table: _shadow_name(table)}, source=source)
+        )
+        with log.step(f"finish_shadow:{bare}"):
+            _finish_shadow_tables(cur, [table])
+    return run
+
+
+def _cum_task(cur, log):
+    _build_cum_shadow(cur, log)
+    with log.step("finish_shadow:kpi_daily_region_cum"):
+        _finish_shadow_tables(cur, [CACHE_CUM])
+
+
+def _rollup_task(table):
+    def run(cur, log):
+        _build_rollup_shadows(cur, log, [table])
+        with log.step(f"finish_shadow:{table.split('.')[-1]}_rollups"):
+            _finish_shadow_tables(cur, [_rollup_name(table, g) for g in ROLLUP_GRAINS])
+    return run
+
+
+def _full_refresh_tasks(source) -> dict:
+    """Граф задач полной пересборки. Кэш-таблицы независимы: каждая читает срез source (один скан «For dash»
+    уже сделан _stage_source) в свою теневую копию; накопительная таблица и свёртки — из готовых теневых дневных."""
+    tasks = {table: (_shadow_rebuild_task(table, source), ()) for table in _ALL_CACHE_TABLES}
+    tasks[CACHE_CUM] = (_cum_task, (CACHE_TABLE,))
+    for table in _ROLLUP_SPEC:
+        tasks[f"rollup:{table}"] = (_rollup_task(table), (table,))
+    return tasks
+
+
+def _run_in_shared_snapshot(engine, build, max_workers, statement_timeout_ms, log, prepare=None):
+    """build(cur) -> (tasks, extra) выполняется в REPEATABLE READ транзакции-координаторе; задачи
+    исполняются в её экспортированном снимке, если в пуле есть слот под координатор. Возвращает (extra, results).
+    prepare(cur) — шаг на том же соединении отдельной закоммиченной транзакцией до снимка (заполнение справочников):
+    его строки видны всем задачам."""
+    pool = engine.get("pool") if isinstance(engine, dict) else None
+    workers = max(1, max_workers or REFRESH_PARALLELISM)
+    if pool is not None:
+        workers = max(1, min(workers, pool.maxconn - 1 if pool.maxconn > 1 else 1))
+    use_snapshot = pool is None or pool.maxconn > workers
+    with _pooled_connection(engine) as coord:
+        if prepare is not None:
+            with coord.cursor() as cur:
+                cur.execute(f"SET LOCAL statement_timeout = '{int(statement_timeout_ms)}'")
+                prepare(cur)
+            coord.commit()
+        with coord.cursor() as cur:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            tasks, extra = build(cur)
+            snapshot_id = None
+            if use_snapshot:
+                cur.execute("SELECT pg_export_snapshot()")
+                snapshot_id = cur.fetchone()[0]
+        if snapshot_id is not None:
+            # Снимок жив, пока открыта транзакция coord
+            results = _run_refresh_tasks(engine, tasks, workers, log, snapshot_id, statement_timeout_ms)
+        coord.rollback()
+    if snapshot_id is None:
+        results = _run_refresh_tasks(engine, tasks, workers, log, None, statement_timeout_ms)
+    return extra, results
+
+
+def _task_errors(results) -> str:
+    return "; ".join(f"{name}: {err}" for name, err in results.items() if err)
+
+
+def refresh_kpi_daily_region_parallel(engine, max_workers=None, statement_timeout_ms=600000):
+    """Полная пересборка параллельно на N соединениях (KPI_REFRESH_PARALLELISM): «For dash» сканируется
+    один раз в UNLOGGED-срез (вместе с watermark и справочниками — одна транзакция), затем каждая таблица
+    заливается из среза в свою теневую копию и коммитится; в конце все подменяются одним swap.
+
+    Срез неизменен, поэтому все таблицы считаются по одному состоянию источника без общего снимка.
+    """
+
+    def body(log):
+        source = REFRESH_SOURCE_PREFIX + log.run_id[:12]
+        pool = engine.get("pool") if isinstance(engine, dict) else None
+        workers = max(1, max_workers or REFRESH_PARALLELISM)
+        if pool is not None:
+            workers = max(1, min(workers, pool.maxconn))
+        try:
+            with _pooled_connection(engine) as conn:
+                with conn.cursor() as cur:
+                    # Срез и watermark — из одного снимка
+                    cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                    cur.execute(f"SET LOCAL statement_timeout = '{int(statement_timeout_ms)}'")
+                    watermark = _source_watermark(cur)
+                    _stage_source(cur, log, source)
+                    _fill_dimensions(cur, log, source=source)
+                conn.commit()
+            results = _run_refresh_tasks(engine, _full_refresh_tasks(source), workers, log, None, statement_timeout_ms)
+            errors = _task_errors(results)
+            if errors:
+                return (False, errors)
+            with _pooled_connection(engine) as conn:
+                with conn.cursor() as cur:
+                    with log.step("swap"):
+                        _swap_in_shadow_tables(cur, _SWAP_TABLES)
+                    log.rewritten(_SWAP_TABLES, analyzed=True)
+                    _write_meta(cur, watermark, "full")
+                conn.commit()
+        finally:
+            _drop_tables_async(engine, [source])
+        _drop_old_generations_async(engine)
         return (True, None)
-    except Exception as e:
+
+    return _run_logged(engine, "parallel" if max_workers != 1 else "chunked", body)
+
+
+def _source_day_bounds(cur):
+    """(min, max) МСК-дат событий в источнике (с UTM_FILTER) — диапазон месяцев для помесячной пересборки."""
+    aliases = ", ".join(alias for alias, _ in _EVENT_DAY_EXPRS)
+    cur.execute(f"SELECT MIN(LEAST({aliases})), MAX(GREATEST({aliases})) FROM ({_SINGLE_PASS_SRC_SQL}) s")
+    return cur.fetchone()
+
+
+def _prepare_monthly_run(cur, resume: bool, run_id: str):
+    """Начинает новую помесячную пересборку или продолжает прерванную. Возвращает (run_id, month_start залитых месяцев).
+
+    Продолжается только свой запуск: run_id в комментариях всех теневых копий __monthly совпадает с run_id
+    каждой строки kpi_refresh_progress, и первый месяц залит не раньше REFRESH_RESUME_MAX_AGE_H часов назад.
+    Иначе (чужие/старые строки, недостроенные копии) — всё заново под новым run_id."""
+    if resume:
+        shadows = ", ".join(f"obj_description(to_regclass('{_shadow_name(t, _MONTHLY_SUFFIX)}'), 'pg_class')" for t in _ALL_CACHE_TABLES)
+        cur.execute(f"SELECT ARRAY[{shadows}]")
+        owners = set(cur.fetchone()[0])
+        cur.execute(
+            f"SELECT array_agg(DISTINCT run_id), bool_and(run_id IS NOT NULL), "
+            f"MIN(done_at) > now() - make_interval(hours => %s) FROM {REFRESH_PROGRESS}",
+            (REFRESH_RESUME_MAX_AGE_H,),
+        )
+        runs, all_tagged, fresh = cur.fetchone()
+        if len(owners) == 1 and None not in owners and all_tagged and fresh and runs == list(owners):
+            resumed = owners.pop()
+            cur.execute(f"SELECT month_start FROM {REFRESH_PROGRESS}")
+            return resumed, {row[0] for row in cur.fetchall()}
+    _create_shadow_tables(cur, _ALL_CACHE_TABLES, _MONTHLY_SUFFIX)
+    for table in _ALL_CACHE_TABLES:
+        cur.execute(f"COMMENT ON TABLE {_shadow_name(table, _MONTHLY_SUFFIX)} IS %s", (run_id,))
+    cur.execute(f"TRUNCATE {REFRESH_PROGRESS}")
+    return run_id, set()
+
+
+def _month_rebuild_task(d_from, d_to, watermark, run_id):
+    def run(cur, log):
+        label = f"{d_from:%Y-%m}"
+        # Месяц целиком в одной транзакции: срез в теневых таблицах + отметка о готовности
+        for table in _ALL_CACHE_TABLES:
+            log.execute(
+                cur,
+                f"delete:{table.split('.')[-1]} {label}",
+                f"DELETE FROM {_shadow_name(table, _MONTHLY_SUFFIX)} WHERE day BETWEEN %s AND %s",
+                (d_from, d_to),
+            )
+        log.single_pass(
+            cur,
+            _single_pass_refresh_sql(
+                day_pred=_day_between_pred(d_from, d_to),
+                targets={t: _shadow_name(t, _MONTHLY_SUFFIX) for t in _ALL_CACHE_TABLES},
+            ),
+            label,
+        )
+        cur.execute(
+            f"""
+            INSERT INTO {REFRESH_PROGRESS} (month_start, month_end, source_watermark, run_id)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (month_start) DO UPDATE SET
+              month_end = EXCLUDED.month_end, source_watermark = EXCLUDED.source_watermark,
+              run_id = EXCLUDED.run_id, done_at = now()
+            """,
+            (d_from.replace(day=1), d_to, watermark, run_id),
+        )
+    return run
+
+
+def refresh_kpi_daily_region_monthly(engine, max_workers=None, resume=True, statement_timeout_ms=300000):
+    """Полная пересборка по месяцам (_month_ranges): каждый месяц — отдельная транзакция на своём
+    соединении, месяцы идут параллельно. Готовые месяцы пишутся в kpi_refresh_progress; после сбоя
+    повторный вызов (resume=True) досчитывает только оставшиеся (см. _prepare_monthly_run).
+    Теневые копии — свои (<table>__monthly), в конце — индексы, ANALYZE и один swap.
+
+    Каждый месяц сканирует «For dash» заново: дольше по CPU, чем один проход, зато обрыв стоит
+    не больше одного месяца. Watermark в meta — самый ранний из месяцев (инкремент догонит остальное).
+    """
+
+    def body(log):
+        with _pooled_connection(engine) as conn:
+            with conn.cursor() as cur:
+                with log.step("prepare") as entry:
+                    run_id, done = _prepare_monthly_run(cur, resume, log.run_id)
+                    entry["rows"] = len(done)
+            conn.commit()
+
+        def build(cur):
+            watermark = _source_watermark(cur)
+            min_d, max_d = _source_day_bounds(cur)
+            tasks = {
+                f"{d_from:%Y-%m}": (_month_rebuild_task(d_from, d_to, watermark, run_id), ())
+                for d_from, d_to in _month_ranges(min_d, max_d)
+                if d_from.replace(day=1) not in done
+            }
+            return tasks, None
+
+        _, results = _run_in_shared_snapshot(
+            engine, build, max_workers, statement_timeout_ms, log, prepare=lambda cur: _fill_dimensions(cur, log)
+        )
+        errors = _task_errors(results)
+        if errors:
+            return (False, f"{errors} (повторный вызов продолжит с незавершённых месяцев)")
+        with _pooled_connection(engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SET LOCAL statement_timeout = '{int(statement_timeout_ms)}'")
+                _build_cum_shadow(cur, log, _MONTHLY_SUFFIX)
+                _build_rollup_shadows(cur, log, suffix=_MONTHLY_SUFFIX)
+                with log.step("finish_shadow"):
+                    _finish_shadow_tables(cur, _SWAP_TABLES, _MONTHLY_SUFFIX)
+            conn.commit()
+        with _pooled_connection(engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT MIN(source_watermark) FROM {REFRESH_PROGRESS} WHERE run_id = %s", (run_id,))
+                watermark = cur.fetchone()[0]
+                with log.step("swap"):
+                    _swap_in_shadow_tables(cur, _SWAP_TABLES, _MONTHLY_SUFFIX)
+                log.rewritten(_SWAP_TABLES, analyzed=True)
+                _write_meta(cur, watermark, "full")
+                cur.execute(f"TRUNCATE {REFRESH_PROGRESS}")
+            conn.commit()
+        _drop_old_generations_async(engine)
+        return (True, None)
+
+    return _run_logged(engine, "monthly", body)
+
+
+def refresh_kpi_daily_region_chunked(engine):
+    """Заполняет кэш по шагам с commit после каждого — меньше шанс таймаута/обрыва.
+    Шаги пишут в теневые таблицы, live подменяются одним swap в конце."""
+    return refresh_kpi_daily_region_parallel(engine, max_workers=1, statement_timeout_ms=300000)
+
+
+def refresh_runs(engine, limit=20) -> pd.DataFrame:
+    """Последние запуски refresh из kpi_refresh_log: run_id, mode, started_at, duration_ms, rows, retries, error."""
+    return run_sql(
+        engine,
+        f"""
+        SELECT run_id, mode, started_at, duration_ms, rows, retries, error
+        FROM {REFRESH_LOG}
+        WHERE step = 'run'
+        ORDER BY started_at DESC
+        LIMIT :limit
+        """,
+        {"limit": int(limit)},
+    )
+
+
+def refresh_run_steps(engine, run_id: str) -> pd.DataFrame:
+    """Шаги одного запуска (statement / задача / таблица) с временем, строками, повторами и ошибкой."""
+    return run_sql(
+        engine,
+        f"""
+        SELECT step, started_at, finished_at, duration_ms, rows, retries, error
+        FROM {REFRESH_LOG}
+        WHERE run_id = :run_id AND step <> 'run'
+        ORDER BY started_at, id
+        """,
+        {"run_id": run_id},
+    )
+
+
+def _plan_scans(node):
+    """Узлы сканирования из JSON-плана EXPLAIN (рекурсивно)."""
+    if "Relation Name" in node:
+        yield node
+    for child in node.get("Plans", ()):
+        yield from _plan_scans(child)
+
+
+def explain_cache_indexes(engine) -> pd.DataFrame:
+    """Проверка покрывающих индексов: для каждого индекса _CACHE_INDEXES (и свёрток) — EXPLAIN ANALYZE
+    типового чтения дашборда по его ключу (диапазон day; region_id = ANY(все регионы) + диапазон day).
+    Seq/bitmap scan запрещены на время проверки: смотрим, может ли запрос идти Index Only Scan без heap.
+    ok — Index Only Scan по покрывающему индексу таблицы (планировщик волен выбрать любой из них) и Heap Fetches = 0
+    (после VACUUM, см. _vacuum_cache_tables). У секционированных таблиц — по каждой непрунённой секции
+    (индексы секций наследуют покрывающие индексы родителя под своими именами)."""
+    meta = _meta_with_stats(engine)
+    if meta is None or pd.isna(meta["min_day"]):
+        return pd.DataFrame(columns=["table", "index", "node", "heap_fetches", "ok"])
+    d_from, d_to = meta["min_day"], meta["max_day"]
+    region_ids = sorted(_region_ids(engine).values())
+    checks = []
+    for base, (keys, include, _unique) in _CACHE_INDEXES.items():
+        tables = [base] + ([_rollup_name(base, g) for g in ROLLUP_GRAINS] if base in _ROLLUP_SPEC else [])
+        for table in tables:
+            for key in keys:
+                region_pred = "region_id = ANY(%(ids)s) AND " if key[0] == "region_id" else ""
+                sql = f"SELECT {', '.join(include)} FROM {table} WHERE {region_pred}day BETWEEN %(d_from)s AND %(d_to)s"
+                checks.append((table, sql))
+    rows = []
+    with _pooled_connection(engine) as conn:
         try:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL enable_seqscan = off")
+                cur.execute("SET LOCAL enable_bitmapscan = off")
+                for table, sql in checks:
+                    cur.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql, {"ids": region_ids, "d_from": d_from, "d_to": d_to})
+                    plan = cur.fetchone()[0]
+                    plan = json.loads(plan) if isinstance(plan, str) else plan
+                    scans = list(_plan_scans(plan[0]["Plan"])) or [{}]
+                    nodes = sorted({scan.get("Node Type") for scan in scans}, key=str)
+                    fetches = sum(scan.get("Heap Fetches") or 0 for scan in scans)
+                    covering = table in _PARTITIONED_TABLES or all(scan.get("Index Name") in _index_names(table) for scan in scans)
+                    rows.append({
+                        "table": table.split(".")[-1],
+                        "index": scans[0].get("Index Name"),
+                        "node": ", ".join(map(str, nodes)),
+                        "heap_fetches": fetches,
+                        "ok": nodes == ["Index Only Scan"] and covering and not fetches,
+                    })
+        finally:
             conn.rollback()
-        except Exception:
-            pass
+    return pd.DataFrame(rows, columns=["table", "index", "node", "heap_fetches", "ok"])
+
+
+class RefreshScheduler:
+    """Фоновый refresh кэша раз в interval_s + random(0, jitter_s) секунд.
+
+    Блокировку pg_try_advisory_lock(REFRESH_LOCK_KEY) берёт сам refresh (_run_logged): из нескольких
+    реплик Streamlit refresh выполняет только та, что её взяла, остальные получают REFRESH_BUSY и пропускают тик.
+    Блокировка сессионная — нужен session pooler (5432) или direct, не transaction pooler (6543).
+    """
+
+    def __init__(self, engine, interval_s=REFRESH_INTERVAL_S, jitter_s=REFRESH_JITTER_S, full_interval_s=REFRESH_FULL_INTERVAL_S):
+        self.engine = engine
+        self.interval_s = interval_s
+        self.jitter_s = jitter_s
+        self.full_interval_s = full_interval_s
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._status = {
+            "running": False,
+            "runs": 0,
+            "skipped_not_leader": 0,
+            "last_started": None,
+            "last_finished": None,
+            "last_mode": None,
+            "last_ok": None,
+            "last_error": None,
+            "last_duration_s": None,
+            "next_run_at": None,
+        }
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="kpi-refresh-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self) -> dict:
+        with self._lock:
+            return dict(self._status)
+
+    def _set(self, **kw):
+        with self._lock:
+            self._status.update(kw)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            delay = self.interval_s + random.uniform(0, max(self.jitter_s, 0))
+            self._set(next_run_at=time.time() + delay)
+            if self._stop.wait(delay):
+                break
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"[refresh] scheduler ERROR: {e}")
+
+    def _full_due(self, cur) -> bool:
+        """Пора ли полный refresh: последний успешный полный (любой реплики, по kpi_refresh_log) старше full_interval_s."""
+        if self.full_interval_s <= 0:
+            return False
+        cur.execute(
+            f"SELECT MAX(started_at) FROM {REFRESH_LOG} WHERE step = 'run' AND mode <> 'incremental' AND error IS NULL"
+        )
+        last = cur.fetchone()[0]
+        return last is None or (datetime.now(timezone.utc) - last).total_seconds() >= self.full_interval_s
+
+    def run_once(self):
+        """Один тик: refresh, если удалось стать лидером. Возвращает (ok, error) или None, если лидер — другой процесс."""
+        heavy = _engine_for_heavy(self.engine)
+        with _pooled_connection(heavy) as conn:
+            with conn.cursor() as cur:
+                mode = "full" if self._full_due(cur) else "incremental"
+            conn.rollback()
+        runs = self.status()["runs"]
+        t0 = time.time()
+        self._set(running=True, last_started=t0, last_mode=mode)
+        ok, err = False, None
         try:
-            conn.close()
-        except Exception:
-            pass
-        return (False, str(e))
+            ok, err = refresh_kpi_daily_region(heavy, mode=mode)
+        finally:
+            if err == REFRESH_BUSY:
+                self._set(running=False)
+            else:
+                self._set(
+                    running=False,
+                    runs=runs + 1,
+                    last_finished=time.time(),
+                    last_ok=ok,
+                    last_error=err,
+                    last_duration_s=round(time.time() - t0, 2),
+                )
+        if err == REFRESH_BUSY:
+            with self._lock:
+                self._status["skipped_not_leader"] += 1
+            return None
+        print(f"[refresh] scheduler {mode}: ok={ok} {time.time() - t0:.1f}s" + (f" error={err}" if err else ""))
+        return (ok, err)
+
+
+_SCHEDULER = None
+_SCHEDULER_LOCK = threading.Lock()
+
+
+def start_refresh_scheduler(engine=None):
+    """Запускает (один раз на процесс) фоновый RefreshScheduler. None — не включён KPI_REFRESH_SCHEDULER=1,
+    нет БД или KPI_REFRESH_INTERVAL_S=0."""
+    global _SCHEDULER
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER is not None:
+            return _SCHEDULER
+        if not REFRESH_SCHEDULER_ENABLED or REFRESH_INTERVAL_S <= 0:
+            return None
+        engine = engine or get_engine()
+        if engine is None:
+            return None
+        _SCHEDULER = RefreshScheduler(engine).start()
+        return _SCHEDULER
 
 
 _CACHE_EMPTY_LOCK = threading.Lock()
@@ -1014,9 +2882,12 @@ _CACHE_EMPTY_TTL = 60
 
 
 def cache_is_empty(engine) -> bool:
-    """Проверяет, пуст ли kpi_daily_region. Результат кэшируется на _CACHE_EMPTY_TTL сек.
-    При ошибке COUNT не кэшируем — следующий вызов повторит запрос."""
+    """Проверяет, пуст ли kpi_daily_region — по row_counts из kpi_cache_meta; без них COUNT(*),
+    кэшируемый на _CACHE_EMPTY_TTL сек. При ошибке COUNT не кэшируем — следующий вызов повторит запрос."""
     global _CACHE_EMPTY_RESULT, _CACHE_EMPTY_TS
+    meta = _meta_with_stats(engine)
+    if meta is not None:
+        return not meta["row_counts"].get(CACHE_TABLE.split(".")[-1])
     now = time.time()
     with _CACHE_EMPTY_LOCK:
         if _CACHE_EMPTY_TS and (now - _CACHE_EMPTY_TS) < _CACHE_EMPTY_TTL and _CACHE_EMPTY_RESULT is not None:
@@ -1031,30 +2902,67 @@ def cache_is_empty(engine) -> bool:
     return empty
 
 
+_META_LOCK = threading.Lock()
+_META_RESULT = None
+_META_TS = 0.0
+_META_TTL = 5
+
+
+def cache_meta(engine):
+    """Строка kpi_cache_meta (generation, min/max day, regions, row_counts, refreshed_at) — один PK-lookup
+    не чаще раза в _META_TTL сек на процесс. None — meta недоступна (не кэшируем, следующий вызов повторит)."""
+    global _META_RESULT, _META_TS
+    now = time.time()
+    with _META_LOCK:
+        if _META_TS and (now - _META_TS) < _META_TTL:
+            return _META_RESULT
+    try:
+        df = run_sql(
+            engine,
+            f"SELECT generation, min_day, max_day, regions, row_counts, refreshed_at FROM {CACHE_META} WHERE id = 1",
+        )
+        meta = df.iloc[0].to_dict() if not df.empty else {"generation": 0, "row_counts": None}
+    except Exception:
+        return None
+    with _META_LOCK:
+        _META_RESULT, _META_TS = meta, time.time()
+    return meta
+
+
+def cache_generation(engine):
+    """Номер поколения кэша (растёт при каждом refresh, изменившем данные); None — meta недоступна."""
+    meta = cache_meta(engine)
+    return int(meta["generation"]) if meta is not None else None
+
+
+def _meta_with_stats(engine):
+    """Meta, в которой refresh уже записал статистику кэша; None — читать по-старому, агрегатами."""
+    meta = cache_meta(engine)
+    return meta if meta is not None and isinstance(meta.get("row_counts"), dict) else None
+
+
+def _invalidate_cache_state():
+    """После refresh в этом процессе: не ждать TTL у cache_meta()/cache_is_empty()."""
+    global _META_TS, _CACHE_EMPTY_TS
+    with _META_LOCK:
+        _META_TS = 0.0
+    with _CACHE_EMPTY_LOCK:
+        _CACHE_EMPTY_TS = 0.0
+
+
 def _engine_for_heavy(engine):
     """Опционально прямое подключение для тяжёлого ETL (refresh). Для дашборда не используется."""
     direct = get_direct_engine()
     if direct is None:
         return engine
-    conn = None
     try:
-        conn = _connect_once(direct)
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1")
-            cur.fetchone()
-        conn.rollback()
-        conn.close()
+        with _pooled_connection(direct) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            conn.rollback()
         return direct
     except Exception:
-        if conn is not None:
-            try:
-                conn.rollback()
-            except Exception:
-                pass
-            try:
-                conn.close()
-            except Exception:
-                pass
         return engine
 
 
@@ -1104,44 +3012,269 @@ def _by_region_from_view(engine):
         return pd.DataFrame(columns=["region", "leads", "quals", "prequals", "pokaz"])
 
 
+# ══════════════════════════════════════════════════════════════════════════════
+# КУБ KPI В ПАМЯТИ — kpi_daily_region целиком (регион × день × метрика) + префиксные суммы по дням.
+# Грузится один раз на поколение кэша (cache_generation); фаза 1 дашборда считается без запросов к БД.
+# KPI_CUBE=0 — выключить (все функции идут в SQL, как раньше).
+# ══════════════════════════════════════════════════════════════════════════════
+
+KPI_CUBE_ENABLED = os.environ.get("KPI_CUBE", "1") != "0"
+# Метрики куба в порядке колонок kpi_daily_region; (имя в ответе, колонка) — для kpi_extended/kpi_by_region
+_CUBE_METRICS = ("leads", "prequals", "quals", "pokaz_naznachen", "shows", "passports", "broni", "deals", "commission", "summa")
+_CUBE_MONEY = ("commission", "summa")
+_KPI_OUTPUT = (
+    ("leads", "leads"),
+    ("prequals", "prequals"),
+    ("quals", "quals"),
+    ("pokaz_naznachen", "pokaz_naznachen"),
+    ("pokaz", "shows"),
+    ("passports", "passports"),
+    ("broni", "broni"),
+    ("sdelki", "deals"),
+    ("komissi", "commission"),
+    ("summa", "summa"),
+)
+_DAILY_OUTPUT = (("leads", "leads"), ("quals", "quals"), ("prequals", "prequals"), ("pokaz_naznachen", "pokaz_naznachen"), ("pokaz", "shows"))
+_FUNNEL_OUTPUT = (
+    ("lead_created_at", "leads"),
+    ("pre_qual_date", "prequals"),
+    ("kval_provedena", "quals"),
+    ("pokaz_naznachen", "pokaz_naznachen"),
+    ("pokaz_proveden", "shows"),
+    ("pasport_poluchen", "passports"),
+    ("objekt_zabronirovan", "broni"),
+    ("komissiya_poluchena", "commission"),
+)
+
+
+def _as_day(value) -> np.datetime64:
+    return np.datetime64(pd.Timestamp(value).date(), "D")
+
+
+class _KpiCube:
+    """kpi_daily_region как массив [регион, день, метрика] (+ канал «есть строка»).
+    cum[:, j] — сумма дней [0, j): сумма за любой диапазон — две строки cum и вычитание."""
+
+    def __init__(self, df: pd.DataFrame):
+        regions = df["region"].astype(object).where(df["region"].notna(), None)
+        self.regions = list(dict.fromkeys(regions.tolist()))
+        self._region_idx = {r: i for i, r in enumerate(self.regions)}
+        days = df["day"].to_numpy().astype("datetime64[D]")
+        self.day0 = days.min() if len(days) else np.datetime64("today", "D")
+        n_days = int((days.max() - self.day0).astype(int)) + 1 if len(days) else 0
+        n_metrics = len(_CUBE_METRICS) + 1
+        grid = np.zeros((len(self.regions), n_days, n_metrics), dtype=np.float64)
+        r_idx = np.fromiter((self._region_idx[r] for r in regions), dtype=np.int64, count=len(df))
+        d_idx = (days - self.day0).astype(np.int64)
+        for m, col in enumerate(_CUBE_METRICS):
+            np.add.at(grid[:, :, m], (r_idx, d_idx), pd.to_numeric(df[col], errors="coerce").fillna(0).to_numpy(np.float64))
+        np.add.at(grid[:, :, -1], (r_idx, d_idx), 1.0)
+        self.grid = grid
+        self.cum = np.zeros((len(self.regions), n_days + 1, n_metrics), dtype=np.float64)
+        np.cumsum(grid, axis=1, out=self.cum[:, 1:, :])
+        self.n_days = n_days
+
+    def select(self, region=None, region_list=None) -> list:
+        """Индексы регионов: region_list — точное совпадение (IN), region — как ILIKE '%x%'."""
+        if isinstance(region_list, (list, tuple)) and len(region_list) > 0:
+            return [self._region_idx[r] for r in dict.fromkeys(region_list) if r in self._region_idx]
+        if region and region != "Все":
+            needle = str(region).lower()
+            return [i for i, r in enumerate(self.regions) if r is not None and needle in r.lower()]
+        return list(range(len(self.regions)))
+
+    def _bounds(self, date_from, date_to):
+        i = int((_as_day(date_from) - self.day0).astype(int))
+        j = int((_as_day(date_to) - self.day0).astype(int)) + 1
+        return min(max(i, 0), self.n_days), min(max(j, 0), self.n_days)
+
+    def range_sums(self, idx, date_from, date_to) -> np.ndarray:
+        """[len(idx), метрика+1] — суммы за [date_from, date_to] по каждому региону."""
+        i, j = self._bounds(date_from, date_to)
+        if j <= i:
+            return np.zeros((len(idx), len(_CUBE_METRICS) + 1))
+        return self.cum[idx, j, :] - self.cum[idx, i, :]
+
+    def daily(self, idx, date_from, date_to) -> tuple:
+        """(даты, [len(idx), дни, метрика]) за [date_from, date_to]; дни вне данных — нули."""
+        dates = np.arange(_as_day(date_from), _as_day(date_to) + 1, dtype="datetime64[D]")
+        out = np.zeros((len(idx), len(dates), len(_CUBE_METRICS) + 1))
+        i, j = self._bounds(date_from, date_to)
+        if j > i:
+            offset = int((self.day0 - _as_day(date_from)).astype(int))
+            out[:, i + offset:j + offset, :] = self.grid[idx, i:j, :]
+        return dates, out
+
+
+def _cube_frame(values: np.ndarray, output, **leading) -> pd.DataFrame:
+    """Метрики куба → DataFrame с именами и типами как у SQL-версии (счётчики int64, деньги float64)."""
+    data = dict(leading)
+    for name, col in output:
+        v = values[..., _CUBE_METRICS.index(col)]
+        data[name] = np.round(v, 2) if col in _CUBE_MONEY else np.rint(v).astype(np.int64)
+    return pd.DataFrame(data)
+
+
+_CUBE_LOCK = threading.Lock()
+# (generation, cube) — неизменяемая пара, заменяется одним присваиванием под _CUBE_LOCK: читатель без
+# блокировки не увидит новое поколение со старым кубом
+_CUBE_STATE = (None, None)
+
+
+def _kpi_cube(engine):
+    """Куб текущего поколения; None — куб выключен или поколение неизвестно (тогда SQL)."""
+    if not KPI_CUBE_ENABLED:
+        return None
+    generation = cache_generation(engine)
+    if generation is None:
+        return None
+    global _CUBE_STATE
+    loaded_generation, cube = _CUBE_STATE
+    if loaded_generation == generation:
+        return cube
+    with _CUBE_LOCK:
+        # Один поток грузит, остальные ждут и берут готовый куб
+        loaded_generation, cube = _CUBE_STATE
+        if loaded_generation == generation:
+            return cube
+        try:
+            df = run_sql(engine, f"SELECT region, day, {', '.join(_CUBE_METRICS)} FROM {CACHE_TABLE} WHERE day IS NOT NULL")
+            cube = _KpiCube(df)
+        except Exception as e:
+            print(f"[cube] load ERROR: {e}")
+            return None
+        _CUBE_STATE = (generation, cube)
+        return cube
+
+
+class _SqlPlan:
+    """Запрос функции чтения, ещё не отправленный в БД: выполняется сам (_execute_plan) или вместе
+    с другими одним statement (load_bundle). post — обработка результата (DataFrame → DataFrame)."""
+
+    __slots__ = ("sql", "params", "post")
+
+    def __init__(self, sql: str, params=None, post=None):
+        self.sql = sql
+        self.params = params or {}
+        self.post = post
+
+
+def _execute_plan(engine, plan) -> pd.DataFrame:
+    """План функции чтения → DataFrame: готовый результат (куб, пустой кэш) — как есть, _SqlPlan — через run_sql."""
+    if not isinstance(plan, _SqlPlan):
+        return plan
+    df = run_sql(engine, plan.sql, plan.params)
+    return plan.post(df) if plan.post is not None else df
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # KPI — только из kpi_daily_region. Пустой кэш → нули (без «For dash»).
 # ══════════════════════════════════════════════════════════════════════════════
 
-def kpi_extended(engine, date_from, date_to, region=None, region_list=None):
+_REGION_IDS_LOCK = threading.Lock()
+_REGION_IDS_STATE = {"generation": None, "ids": None}
+
+
+def _region_ids(engine) -> dict:
+    """Справочник регионов {имя: id} (kpi_dim_region) — в памяти до следующего поколения кэша."""
+    generation = cache_generation(engine)
+    with _REGION_IDS_LOCK:
+        if _REGION_IDS_STATE["ids"] is not None and _REGION_IDS_STATE["generation"] == generation:
+            return _REGION_IDS_STATE["ids"]
+    df = run_sql(engine, f"SELECT id, value FROM {_dim_table('region')}")
+    ids = {str(v): int(i) for i, v in zip(df["id"], df["value"])}
+    with _REGION_IDS_LOCK:
+        _REGION_IDS_STATE.update(generation=generation, ids=ids)
+    return ids
+
+
+def _resolve_region_ids(engine, region=None, region_list=None):
+    """id регионов фильтра: region_list — точное совпадение имён, region — подстрока без учёта регистра
+    (как прежний ILIKE '%x%'). None — фильтра нет."""
+    if isinstance(region_list, (list, tuple)) and len(region_list) > 0:
+        ids = _region_ids(engine)
+        return sorted({ids[r] for r in region_list if r in ids})
+    if region and region != "Все":
+        needle = str(region).lower()
+        return sorted(i for name, i in _region_ids(engine).items() if needle in name.lower())
+    return None
+
+
+def _cache_region_filter(engine, region=None, region_list=None, col="region_id"):
+    """Фильтр по региону для кэш-таблиц: имена → id в Python, в SQL — равенство по region_id (индексы (region_id, day))."""
+    ids = _resolve_region_ids(engine, region=region, region_list=region_list)
+    if ids is None:
+        return "", {}
+    return f"AND {col} = ANY(:region_ids)", {"region_ids": ids}
+
+
+def _cum_ready(engine) -> bool:
+    """Накопительная таблица собрана текущим refresh (по row_counts в kpi_cache_meta)."""
+    meta = _meta_with_stats(engine)
+    return meta is not None and bool(meta["row_counts"].get(CACHE_CUM.split(".")[-1]))
+
+
+def _cum_range_sql(select_list: str, reg_filter: str, tail: str = "") -> str:
+    """Сумма за [d_from, d_to] по kpi_daily_region_cum: строка hi = min(d_to, MAX(day)),
+    строка lo = max(d_from − 1, MIN(day)); метрика = hi.x − lo.x. Не зависит от длины диапазона."""
+    return f"""
+    WITH b AS (SELECT MIN(day) AS d0, MAX(day) AS d1 FROM {CACHE_CUM}),
+    r AS (SELECT GREATEST(CAST(:d_from AS date) - 1, b.d0) AS lo, LEAST(CAST(:d_to AS date), b.d1) AS hi FROM b)
+    SELECT {select_list}
+    FROM r
+    JOIN {CACHE_CUM} hi ON hi.day = r.hi AND r.hi > r.lo
+    JOIN {CACHE_CUM} lo ON lo.day = r.lo AND lo.region_id IS NOT DISTINCT FROM hi.region_id
+    WHERE TRUE {reg_filter}
+    {tail}
+    """
+
+
+def _cum_kpi_columns(aggregate: bool) -> str:
+    cols = []
+    for name, col in _KPI_OUTPUT:
+        diff = f"hi.{col} - lo.{col}"
+        cast = "" if col in _CUBE_MONEY else "::bigint"
+        cols.append(f"COALESCE(SUM({diff}), 0){cast} AS {name}" if aggregate else f"({diff}){cast} AS {name}")
+    return ",\n      ".join(cols)
+
+
+def _kpi_extended_plan(engine, date_from, date_to, region=None, region_list=None):
     if cache_is_empty(engine):
         return _empty_kpi_extended_row()
-    if isinstance(region_list, (list, tuple)) and len(region_list) > 0:
-        placeholders = ", ".join(f":reg{i}" for i in range(len(region_list)))
-        reg_filter = f"AND region IN ({placeholders})"
-        reg_params = {f"reg{i}": r for i, r in enumerate(region_list)}
-    elif region and region != "Все":
-        reg_filter = "AND region ILIKE :region"
-        reg_params = {"region": f"%{region}%"}
-    else:
-        reg_filter = ""
-        reg_params = {}
+    cube = _kpi_cube(engine)
+    if cube is not None:
+        idx = cube.select(region=region, region_list=region_list)
+        return _cube_frame(cube.range_sums(idx, date_from, date_to).sum(axis=0, keepdims=True), _KPI_OUTPUT)
+    if _cum_ready(engine):
+        reg_filter, reg_params = _cache_region_filter(engine, region, region_list, col="hi.region_id")
+        sql = _cum_range_sql(_cum_kpi_columns(aggregate=True), reg_filter)
+        return _SqlPlan(sql, {"d_from": date_from, "d_to": date_to, **reg_params})
+    reg_filter, reg_params = _cache_region_filter(engine, region, region_list)
     sql = f"""
     SELECT
-      SUM(leads)           AS leads,
-      SUM(prequals)        AS prequals,
-      SUM(quals)           AS quals,
-      SUM(pokaz_naznachen) AS pokaz_naznachen,
-      SUM(shows)           AS pokaz,
-      SUM(passports)       AS passports,
-      SUM(broni)           AS broni,
-      SUM(deals)           AS sdelki,
-      SUM(commission)      AS komissi,
-      SUM(summa)           AS summa
+      COALESCE(SUM(leads), 0)           AS leads,
+      COALESCE(SUM(prequals), 0)        AS prequals,
+      COALESCE(SUM(quals), 0)           AS quals,
+      COALESCE(SUM(pokaz_naznachen), 0) AS pokaz_naznachen,
+      COALESCE(SUM(shows), 0)           AS pokaz,
+      COALESCE(SUM(passports), 0)       AS passports,
+      COALESCE(SUM(broni), 0)           AS broni,
+      COALESCE(SUM(deals), 0)           AS sdelki,
+      COALESCE(SUM(commission), 0)      AS komissi,
+      COALESCE(SUM(summa), 0)           AS summa
     FROM {CACHE_TABLE}
     WHERE day BETWEEN :d_from AND :d_to
       {reg_filter}
     """
     params = {"d_from": date_from, "d_to": date_to, **reg_params}
-    return run_sql(engine, sql, params)
+    return _SqlPlan(sql, params)
 
 
-def kpi_by_region(engine, date_from, date_to, region_list):
+def kpi_extended(engine, date_from, date_to, region=None, region_list=None):
+    return _execute_plan(engine, _kpi_extended_plan(engine, date_from, date_to, region=region, region_list=region_list))
+
+
+def _kpi_by_region_plan(engine, date_from, date_to, region_list):
     if not (isinstance(region_list, (list, tuple)) and len(region_list) > 0):
         return pd.DataFrame()
     if cache_is_empty(engine):
@@ -1160,8 +3293,22 @@ def kpi_by_region(engine, date_from, date_to, region_list):
                 "summa",
             ]
         )
-    placeholders = ", ".join(f":reg{i}" for i in range(len(region_list)))
-    reg_params = {f"reg{i}": r for i, r in enumerate(region_list)}
+    cube = _kpi_cube(engine)
+    if cube is not None:
+        idx = cube.select(region_list=region_list)
+        sums = cube.range_sums(idx, date_from, date_to)
+        present = sums[:, -1] > 0
+        df = _cube_frame(sums[present], _KPI_OUTPUT, region=[cube.regions[i] for i, p in zip(idx, present) if p])
+        return df.sort_values("leads", ascending=False, kind="stable").reset_index(drop=True)
+    if _cum_ready(engine):
+        reg_filter, reg_params = _cache_region_filter(engine, region_list=region_list, col="hi.region_id")
+        sql = _cum_range_sql(
+            "hi.region,\n      " + _cum_kpi_columns(aggregate=False),
+            reg_filter + " AND hi.n_rows > lo.n_rows",
+            "ORDER BY leads DESC",
+        )
+        return _SqlPlan(sql, {"d_from": date_from, "d_to": date_to, **reg_params})
+    reg_filter, reg_params = _cache_region_filter(engine, region_list=region_list)
     sql = f"""
     SELECT
       region,
@@ -1177,12 +3324,16 @@ def kpi_by_region(engine, date_from, date_to, region_list):
       SUM(summa)           AS summa
     FROM {CACHE_TABLE}
     WHERE day BETWEEN :d_from AND :d_to
-      AND region IN ({placeholders})
+      {reg_filter}
     GROUP BY region
     ORDER BY leads DESC
     """
     params = {"d_from": date_from, "d_to": date_to, **reg_params}
-    return run_sql(engine, sql, params)
+    return _SqlPlan(sql, params)
+
+
+def kpi_by_region(engine, date_from, date_to, region_list):
+    return _execute_plan(engine, _kpi_by_region_plan(engine, date_from, date_to, region_list))
 
 
 def funnel_data(engine, date_from, date_to, region=None, region_list=None):
@@ -1193,19 +3344,17 @@ def funnel_by_region(engine, date_from, date_to, region_list):
     return kpi_by_region(engine, date_from, date_to, region_list)
 
 
-def daily_series(engine, date_from, date_to, region=None, region_list=None):
+def _daily_series_plan(engine, date_from, date_to, region=None, region_list=None):
     if cache_is_empty(engine):
         return pd.DataFrame(columns=["date", "leads", "quals", "prequals", "pokaz_naznachen", "pokaz"])
-    if isinstance(region_list, (list, tuple)) and len(region_list) > 0:
-        placeholders = ", ".join(f":reg{i}" for i in range(len(region_list)))
-        reg_filter = f"AND k.region IN ({placeholders})"
-        reg_params = {f"reg{i}": r for i, r in enumerate(region_list)}
-    elif region and region != "Все":
-        reg_filter = "AND k.region ILIKE :region"
-        reg_params = {"region": f"%{region}%"}
-    else:
-        reg_filter = ""
-        reg_params = {}
+    cube = _kpi_cube(engine)
+    if cube is not None:
+        dates, values = cube.daily(cube.select(region=region, region_list=region_list), date_from, date_to)
+        return _cube_frame(values.sum(axis=0), _DAILY_OUTPUT, date=dates.astype("datetime64[ns]"))
+    plan = _segment_plan(engine, daily_series, date_from, date_to, region=region, region_list=region_list)
+    if plan is not None:
+        return plan
+    reg_filter, reg_params = _cache_region_filter(engine, region, region_list, col="k.region_id")
     sql = f"""
     WITH days AS (
       SELECT generate_series(CAST(:d_from AS date), CAST(:d_to AS date), '1 day'::interval)::date AS d
@@ -1223,23 +3372,48 @@ def daily_series(engine, date_from, date_to, region=None, region_list=None):
     ORDER BY days.d
     """
     params = {"d_from": date_from, "d_to": date_to, **reg_params}
-    return run_sql(engine, sql, params)
+    return _SqlPlan(sql, params)
 
 
-def daily_series_by_region(engine, date_from, date_to, region_list):
+def daily_series(engine, date_from, date_to, region=None, region_list=None):
+    return _execute_plan(engine, _daily_series_plan(engine, date_from, date_to, region=region, region_list=region_list))
+
+
+def _daily_series_by_region_plan(engine, date_from, date_to, region_list):
     if not (isinstance(region_list, (list, tuple)) and len(region_list) > 0):
         return pd.DataFrame()
     if cache_is_empty(engine):
         return pd.DataFrame(columns=["date", "region", "leads", "quals", "prequals", "pokaz_naznachen", "pokaz"])
-    placeholders = ", ".join(f":reg{i}" for i in range(len(region_list)))
+    cube = _kpi_cube(engine)
+    if cube is not None:
+        names = sorted(dict.fromkeys(region_list))
+        idx = [cube.select(region_list=[r]) for r in names]
+        dates, values = cube.daily([i for sel in idx for i in sel], date_from, date_to)
+        # Регион без данных в кубе — нулевая строка на каждый день (как CROSS JOIN regions в SQL)
+        per_region = np.zeros((len(names), len(dates), values.shape[-1]))
+        k = 0
+        for n, sel in enumerate(idx):
+            per_region[n] = values[k:k + len(sel)].sum(axis=0)
+            k += len(sel)
+        return _cube_frame(
+            per_region.transpose(1, 0, 2).reshape(len(dates) * len(names), values.shape[-1]),
+            _DAILY_OUTPUT,
+            date=np.repeat(dates.astype("datetime64[ns]"), len(names)),
+            region=names * len(dates),
+        )
+    plan = _segment_plan(engine, daily_series_by_region, date_from, date_to, region_list=region_list)
+    if plan is not None:
+        return plan
+    ids = _region_ids(engine)
     reg_params = {f"reg{i}": r for i, r in enumerate(region_list)}
-    regions_values = ", ".join(f"(:reg{i})" for i in range(len(region_list)))
+    reg_params.update({f"rid{i}": ids.get(r) for i, r in enumerate(region_list)})
+    regions_values = ", ".join(f"(:reg{i}, CAST(:rid{i} AS int))" for i in range(len(region_list)))
     sql = f"""
     WITH days AS (
       SELECT generate_series(CAST(:d_from AS date), CAST(:d_to AS date), '1 day'::interval)::date AS d
     ),
     regions AS (
-      SELECT * FROM (VALUES {regions_values}) AS v(region)
+      SELECT * FROM (VALUES {regions_values}) AS v(region, region_id)
     )
     SELECT
       days.d AS date,
@@ -1251,17 +3425,29 @@ def daily_series_by_region(engine, date_from, date_to, region_list):
       COALESCE(SUM(k.shows),           0) AS pokaz
     FROM days
     CROSS JOIN regions
-    LEFT JOIN {CACHE_TABLE} k ON k.day = days.d AND k.region = regions.region
+    LEFT JOIN {CACHE_TABLE} k ON k.day = days.d AND k.region_id = regions.region_id
     GROUP BY days.d, regions.region
     ORDER BY days.d, regions.region
     """
     params = {"d_from": date_from, "d_to": date_to, **reg_params}
-    return run_sql(engine, sql, params)
+    return _SqlPlan(sql, params)
 
 
-def by_region(engine, date_from, date_to):
+def daily_series_by_region(engine, date_from, date_to, region_list):
+    return _execute_plan(engine, _daily_series_by_region_plan(engine, date_from, date_to, region_list))
+
+
+def _by_region_plan(engine, date_from, date_to):
     if cache_is_empty(engine):
         return pd.DataFrame(columns=["region", "leads", "quals", "prequals", "pokaz_naznachen", "pokaz"])
+    cube = _kpi_cube(engine)
+    if cube is not None:
+        idx = cube.select()
+        sums = cube.range_sums(idx, date_from, date_to)
+        present = sums[:, -1] > 0
+        regions = [cube.regions[i] if cube.regions[i] is not None else "(не указан)" for i, p in zip(idx, present) if p]
+        df = _cube_frame(sums[present], _DAILY_OUTPUT, region=regions)
+        return df.sort_values("leads", ascending=False, kind="stable").reset_index(drop=True)
     sql = f"""
     SELECT
       COALESCE(region, '(не указан)') AS region,
@@ -1275,7 +3461,11 @@ def by_region(engine, date_from, date_to):
     GROUP BY region
     ORDER BY leads DESC
     """
-    return run_sql(engine, sql, {"d_from": date_from, "d_to": date_to})
+    return _SqlPlan(sql, {"d_from": date_from, "d_to": date_to})
+
+
+def by_region(engine, date_from, date_to):
+    return _execute_plan(engine, _by_region_plan(engine, date_from, date_to))
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -1283,62 +3473,125 @@ def by_region(engine, date_from, date_to):
 # Пустой kpi_daily_region → см. _empty_* / пустые DataFrame; «For dash» дашборд не трогает.
 # ══════════════════════════════════════════════════════════════════════════════
 
-def by_utm(engine, date_from, date_to, region=None, region_list=None, limit=20):
-    if not cache_is_empty(engine):
-        if isinstance(region_list, (list, tuple)) and len(region_list) > 0:
-            placeholders = ", ".join(f":reg{i}" for i in range(len(region_list)))
-            reg_filter = f"AND u.region IN ({placeholders})"
-            reg_params = {f"reg{i}": r for i, r in enumerate(region_list)}
-        elif region and region != "Все":
-            reg_filter = "AND u.region ILIKE :region"
-            reg_params = {"region": f"%{region}%"}
+def _grain_segments(date_from, date_to) -> list:
+    """[(grain, from, to)] — покрытие [date_from, date_to] самыми крупными целыми периодами:
+    полные месяцы → 'month', полные недели (пн–вс) по краям → 'week', остаток → 'day'.
+    Для 'week'/'month' from/to — начала первого и последнего периода (day в свёртке)."""
+    a, b = pd.Timestamp(date_from).date(), pd.Timestamp(date_to).date()
+    if a > b:
+        return [("day", a, b)]
+    segments = []
+    first_month = a if a.day == 1 else _period_start(a, "month") + timedelta(days=32)
+    first_month = first_month.replace(day=1)
+    last_month = _period_start(b + timedelta(days=1), "month") - timedelta(days=1)
+    last_month = last_month.replace(day=1)
+    if first_month <= last_month:
+        segments.append(("month", first_month, last_month))
+        edges = [(a, first_month - timedelta(days=1)), (_period_end(last_month, "month") + timedelta(days=1), b)]
+    else:
+        edges = [(a, b)]
+    for x, y in edges:
+        if x > y:
+            continue
+        first_week = x + timedelta(days=(7 - x.weekday()) % 7)
+        last_week = y - timedelta(days=(y.weekday() + 1) % 7) - timedelta(days=6)
+        if first_week <= last_week:
+            segments.append(("week", first_week, last_week))
+            days = [(x, first_week - timedelta(days=1)), (last_week + timedelta(days=7), y)]
         else:
-            reg_filter = ""
-            reg_params = {}
+            days = [(x, y)]
+        segments.extend(("day", d0, d1) for d0, d1 in days if d0 <= d1)
+    return segments
+
+
+def _rollups_ready(engine) -> bool:
+    """Свёртки собраны refresh'ем (есть в row_counts kpi_cache_meta)."""
+    meta = _meta_with_stats(engine)
+    return meta is not None and all(t.split(".")[-1] in meta["row_counts"] for t in _ROLLUP_TABLES)
+
+
+def _grained_source(engine, table: str, date_from, date_to):
+    """(SQL-подзапрос строк table за [date_from, date_to], параметры): месяцы/недели — из свёрток, края — из дневной."""
+    dims, metrics = _ROLLUP_SPEC[table]
+    # без region (текста): запросы фильтруют по region_id, и подзапрос остаётся в покрывающем индексе
+    cols = ", ".join(("region_id", "day", *dims, *metrics))
+    if not _rollups_ready(engine):
+        return f"SELECT {cols} FROM {table} WHERE day BETWEEN :d_from AND :d_to", {}
+    parts, params = [], {}
+    for i, (grain, d0, d1) in enumerate(_grain_segments(date_from, date_to)):
+        source = table if grain == "day" else _rollup_name(table, grain)
+        parts.append(f"SELECT {cols} FROM {source} WHERE day BETWEEN :g{i}_from AND :g{i}_to")
+        params.update({f"g{i}_from": d0, f"g{i}_to": d1})
+    return "\n        UNION ALL ".join(parts), params
+
+
+def _dim_names_sql(dim: str, columns: str, order_by: str) -> str:
+    """Хвост запроса по CTE top (группы по <dim>_id, уже обрезанные LIMIT): имена из справочника только для них."""
+    cols = ", ".join(f"t.{c.strip()}" for c in columns.split(","))
+    return (
+        f"SELECT d.value AS {dim}, {cols}\n"
+        f"        FROM top t\n"
+        f"        LEFT JOIN {_dim_table(dim)} d ON d.id = t.{dim}_id\n"
+        f"        ORDER BY {', '.join('t.' + o.strip() for o in order_by.split(','))}"
+    )
+
+
+def _by_utm_plan(engine, date_from, date_to, region=None, region_list=None, limit=20):
+    if not cache_is_empty(engine):
+        plan = _segment_plan(engine, by_utm, date_from, date_to, region=region, region_list=region_list, limit=limit)
+        if plan is not None:
+            return plan
+        reg_filter, reg_params = _cache_region_filter(engine, region, region_list, col="u.region_id")
+        src, src_params = _grained_source(engine, CACHE_UTM, date_from, date_to)
         sql = f"""
-        SELECT u.utm_source,
-               COALESCE(SUM(u.cnt) FILTER (WHERE u.event_type = 'lead'),    0)::int AS leads,
-               COALESCE(SUM(u.cnt) FILTER (WHERE u.event_type = 'prequal'), 0)::int AS prequals,
-               COALESCE(SUM(u.cnt) FILTER (WHERE u.event_type = 'qual'),    0)::int AS quals
-        FROM {CACHE_UTM} u
-        WHERE u.day BETWEEN :d_from AND :d_to {reg_filter}
-        GROUP BY u.utm_source
-        ORDER BY leads DESC
-        LIMIT :lim
+        WITH top AS (
+          SELECT u.utm_source_id,
+                 COALESCE(SUM(u.cnt) FILTER (WHERE u.event_type = 'lead'),    0)::int AS leads,
+                 COALESCE(SUM(u.cnt) FILTER (WHERE u.event_type = 'prequal'), 0)::int AS prequals,
+                 COALESCE(SUM(u.cnt) FILTER (WHERE u.event_type = 'qual'),    0)::int AS quals
+          FROM ({src}) u
+          WHERE TRUE {reg_filter}
+          GROUP BY u.utm_source_id
+          ORDER BY leads DESC
+          LIMIT :lim
+        )
+        {_dim_names_sql("utm_source", "leads, prequals, quals", "leads DESC")}
         """
-        params = {"d_from": date_from, "d_to": date_to, "lim": limit, **reg_params}
-        return run_sql(engine, sql, params)
+        params = {"d_from": date_from, "d_to": date_to, "lim": limit, **reg_params, **src_params}
+        return _SqlPlan(sql, params)
     return pd.DataFrame(columns=["utm_source", "leads", "prequals", "quals"])
 
 
-def by_formname(engine, date_from, date_to, region=None, region_list=None, limit=25):
+def by_utm(engine, date_from, date_to, region=None, region_list=None, limit=20):
+    return _execute_plan(engine, _by_utm_plan(engine, date_from, date_to, region=region, region_list=region_list, limit=limit))
+
+
+def _by_formname_plan(engine, date_from, date_to, region=None, region_list=None, limit=25):
     if not cache_is_empty(engine):
-        if isinstance(region_list, (list, tuple)) and len(region_list) > 0:
-            placeholders = ", ".join(f":reg{i}" for i in range(len(region_list)))
-            reg_filter = f"AND f.region IN ({placeholders})"
-            reg_params = {f"reg{i}": r for i, r in enumerate(region_list)}
-        elif region and region != "Все":
-            reg_filter = "AND f.region ILIKE :region"
-            reg_params = {"region": f"%{region}%"}
-        else:
-            reg_filter = ""
-            reg_params = {}
+        plan = _segment_plan(engine, by_formname, date_from, date_to, region=region, region_list=region_list, limit=limit)
+        if plan is not None:
+            return plan
+        reg_filter, reg_params = _cache_region_filter(engine, region, region_list, col="f.region_id")
+        src, src_params = _grained_source(engine, CACHE_FORMNAMES, date_from, date_to)
         sql = f"""
-        SELECT f.formname,
-          SUM(f.leads)::int           AS leads,
-          SUM(f.quals)::int           AS quals,
-          SUM(f.prequals)::int        AS prequals,
-          SUM(f.passports)::int       AS passports,
-          SUM(f.pokaz_naznachen)::int AS pokaz_naznachen,
-          SUM(f.pokaz_proveden)::int  AS pokaz_proveden,
-          SUM(f.broni)::int           AS broni
-        FROM {CACHE_FORMNAMES} f
-        WHERE f.day BETWEEN :d_from AND :d_to {reg_filter}
-        GROUP BY f.formname
-        ORDER BY leads DESC
-        LIMIT :lim
+        WITH top AS (
+          SELECT f.formname_id,
+            SUM(f.leads)::int           AS leads,
+            SUM(f.quals)::int           AS quals,
+            SUM(f.prequals)::int        AS prequals,
+            SUM(f.passports)::int       AS passports,
+            SUM(f.pokaz_naznachen)::int AS pokaz_naznachen,
+            SUM(f.pokaz_proveden)::int  AS pokaz_proveden,
+            SUM(f.broni)::int           AS broni
+          FROM ({src}) f
+          WHERE TRUE {reg_filter}
+          GROUP BY f.formname_id
+          ORDER BY leads DESC
+          LIMIT :lim
+        )
+        {_dim_names_sql("formname", "leads, quals, prequals, passports, pokaz_naznachen, pokaz_proveden, broni", "leads DESC")}
         """
-        return run_sql(engine, sql, {"d_from": date_from, "d_to": date_to, "lim": limit, **reg_params})
+        return _SqlPlan(sql, {"d_from": date_from, "d_to": date_to, "lim": limit, **reg_params, **src_params})
     return pd.DataFrame(
         columns=[
             "formname",
@@ -1353,34 +3606,36 @@ def by_formname(engine, date_from, date_to, region=None, region_list=None, limit
     )
 
 
-def by_landing(engine, date_from, date_to, region=None, region_list=None, limit=30):
+def by_formname(engine, date_from, date_to, region=None, region_list=None, limit=25):
+    return _execute_plan(engine, _by_formname_plan(engine, date_from, date_to, region=region, region_list=region_list, limit=limit))
+
+
+def _by_landing_plan(engine, date_from, date_to, region=None, region_list=None, limit=30):
     if not cache_is_empty(engine):
-        if isinstance(region_list, (list, tuple)) and len(region_list) > 0:
-            placeholders = ", ".join(f":reg{i}" for i in range(len(region_list)))
-            reg_filter = f"AND l.region IN ({placeholders})"
-            reg_params = {f"reg{i}": r for i, r in enumerate(region_list)}
-        elif region and region != "Все":
-            reg_filter = "AND l.region ILIKE :region"
-            reg_params = {"region": f"%{region}%"}
-        else:
-            reg_filter = ""
-            reg_params = {}
+        plan = _segment_plan(engine, by_landing, date_from, date_to, region=region, region_list=region_list, limit=limit)
+        if plan is not None:
+            return plan
+        reg_filter, reg_params = _cache_region_filter(engine, region, region_list, col="l.region_id")
+        src, src_params = _grained_source(engine, CACHE_LANDING, date_from, date_to)
         sql = f"""
-        SELECT l.landing,
-               SUM(l.leads)::int           AS leads,
-               SUM(l.prequals)::int        AS prequals,
-               SUM(l.quals)::int           AS quals,
-               SUM(l.pokaz_naznachen)::int AS pokaz_naznachen,
-               SUM(l.pokaz_proveden)::int  AS pokaz_proveden,
-               SUM(l.passports)::int       AS passports,
-               SUM(l.broni_cnt)::int       AS broni
-        FROM {CACHE_LANDING} l
-        WHERE l.day BETWEEN :d_from AND :d_to {reg_filter}
-        GROUP BY l.landing
-        ORDER BY leads DESC
-        LIMIT :lim
+        WITH top AS (
+          SELECT l.landing_id,
+                 SUM(l.leads)::int           AS leads,
+                 SUM(l.prequals)::int        AS prequals,
+                 SUM(l.quals)::int           AS quals,
+                 SUM(l.pokaz_naznachen)::int AS pokaz_naznachen,
+                 SUM(l.pokaz_proveden)::int  AS pokaz_proveden,
+                 SUM(l.passports)::int       AS passports,
+                 SUM(l.broni_cnt)::int       AS broni
+          FROM ({src}) l
+          WHERE TRUE {reg_filter}
+          GROUP BY l.landing_id
+          ORDER BY leads DESC
+          LIMIT :lim
+        )
+        {_dim_names_sql("landing", "leads, prequals, quals, pokaz_naznachen, pokaz_proveden, passports, broni", "leads DESC")}
         """
-        return run_sql(engine, sql, {"d_from": date_from, "d_to": date_to, "lim": limit, **reg_params})
+        return _SqlPlan(sql, {"d_from": date_from, "d_to": date_to, "lim": limit, **reg_params, **src_params})
     return pd.DataFrame(
         columns=[
             "landing",
@@ -1395,24 +3650,22 @@ def by_landing(engine, date_from, date_to, region=None, region_list=None, limit=
     )
 
 
+def by_landing(engine, date_from, date_to, region=None, region_list=None, limit=30):
+    return _execute_plan(engine, _by_landing_plan(engine, date_from, date_to, region=region, region_list=region_list, limit=limit))
+
+
 def by_source_key(engine, date_from, date_to, region=None, limit=20):
     """В дашборде не используется; отдельной кэш-таблицы нет — без «For dash» возвращаем пусто."""
     return pd.DataFrame(columns=["source_key", "leads", "quals"])
 
 
-def top_managers(engine, date_from, date_to, region=None, region_list=None, limit=10):
-    reg_filter, reg_params = _region_filter_sql(region=region, region_list=region_list)
+def _top_managers_plan(engine, date_from, date_to, region=None, region_list=None, limit=10):
     if not cache_is_empty(engine):
-        if isinstance(region_list, (list, tuple)) and len(region_list) > 0:
-            placeholders = ", ".join(f":reg{i}" for i in range(len(region_list)))
-            reg_filter = f"AND m.region IN ({placeholders})"
-            reg_params = {f"reg{i}": r for i, r in enumerate(region_list)}
-        elif region and region != "Все":
-            reg_filter = "AND m.region ILIKE :region"
-            reg_params = {"region": f"%{region}%"}
-        else:
-            reg_filter = ""
-            reg_params = {}
+        plan = _segment_plan(engine, top_managers, date_from, date_to, region=region, region_list=region_list, limit=limit)
+        if plan is not None:
+            return plan
+        reg_filter, reg_params = _cache_region_filter(engine, region, region_list, col="m.region_id")
+        src, src_params = _grained_source(engine, CACHE_MANAGERS, date_from, date_to)
         sql = f"""
         SELECT
           m.broker_id,
@@ -1421,110 +3674,118 @@ def top_managers(engine, date_from, date_to, region=None, region_list=None, limi
           SUM(m.prequals)::int AS prequals,
           SUM(m.quals)::int    AS quals,
           ROUND(100.0 * SUM(m.quals) / NULLIF(SUM(m.leads), 0), 1) AS conv_percent
-        FROM {CACHE_MANAGERS} m
-        WHERE m.day BETWEEN :d_from AND :d_to {reg_filter}
+        FROM ({src}) m
+        WHERE TRUE {reg_filter}
         GROUP BY m.broker_id
         ORDER BY SUM(m.quals) DESC
         LIMIT :lim
         """
-        return run_sql(engine, sql, {"d_from": date_from, "d_to": date_to, "lim": limit, **reg_params})
+        return _SqlPlan(sql, {"d_from": date_from, "d_to": date_to, "lim": limit, **reg_params, **src_params})
     return pd.DataFrame(columns=["broker_id", "broker_name", "leads", "prequals", "quals", "conv_percent"])
 
 
-def deal_stages_funnel(engine, date_from, date_to, region=None, region_list=None):
-    """Воронка по этапам. Читает из kpi_daily_region (метрики через SUM колонок).
-    Этапы menedzher_naznachen и vzyato_v_rabotu не хранятся в кэше — всегда 0."""
-    if isinstance(region_list, (list, tuple)) and len(region_list) > 0:
-        placeholders = ", ".join(f":reg{i}" for i in range(len(region_list)))
-        reg_filter = f"AND region IN ({placeholders})"
-        reg_params = {f"reg{i}": r for i, r in enumerate(region_list)}
-    elif region and region != "Все":
-        reg_filter = "AND region ILIKE :region"
-        reg_params = {"region": f"%{region}%"}
-    else:
-        reg_filter = ""
-        reg_params = {}
+def top_managers(engine, date_from, date_to, region=None, region_list=None, limit=10):
+    return _execute_plan(engine, _top_managers_plan(engine, date_from, date_to, region=region, region_list=region_list, limit=limit))
+
+
+def _funnel_stages_frame(df_row):
+    if df_row.empty:
+        return _empty_funnel_stages_df()
+    row = df_row.iloc[0]
+    return pd.DataFrame([{"stage": label, "cnt": int(row.get(col) or 0)} for col, label in FUNNEL_STAGES])
+
 
+def _deal_stages_funnel_plan(engine, date_from, date_to, region=None, region_list=None):
     if not cache_is_empty(engine):
+        cube = _kpi_cube(engine)
+        if cube is not None:
+            idx = cube.select(region=region, region_list=region_list)
+            row = _cube_frame(cube.range_sums(idx, date_from, date_to).sum(axis=0, keepdims=True), _FUNNEL_OUTPUT).iloc[0]
+            return pd.DataFrame([{"stage": label, "cnt": int(row.get(col) or 0)} for col, label in FUNNEL_STAGES])
+        reg_filter, reg_params = _cache_region_filter(engine, region, region_list)
         sql = f"""
         SELECT
-          SUM(leads)           AS lead_created_at,
-          SUM(prequals)        AS pre_qual_date,
-          SUM(quals)           AS kval_provedena,
-          SUM(pokaz_naznachen) AS pokaz_naznachen,
-          SUM(shows)           AS pokaz_proveden,
-          SUM(passports)       AS pasport_poluchen,
-          SUM(broni)           AS objekt_zabronirovan,
-          SUM(commission)      AS komissiya_poluchena
+          COALESCE(SUM(leads), 0)           AS lead_created_at,
+          COALESCE(SUM(prequals), 0)        AS pre_qual_date,
+          COALESCE(SUM(quals), 0)           AS kval_provedena,
+          COALESCE(SUM(pokaz_naznachen), 0) AS pokaz_naznachen,
+          COALESCE(SUM(shows), 0)           AS pokaz_proveden,
+          COALESCE(SUM(passports), 0)       AS pasport_poluchen,
+          COALESCE(SUM(broni), 0)           AS objekt_zabronirovan,
+          COALESCE(SUM(commission), 0)      AS komissiya_poluchena
         FROM {CACHE_TABLE}
         WHERE day BETWEEN :d_from AND :d_to {reg_filter}
         """
-        df_row = run_sql(engine, sql, {"d_from": date_from, "d_to": date_to, **reg_params})
-        if df_row.empty:
-            return _empty_funnel_stages_df()
-        row = df_row.iloc[0]
-        result = []
-        for col, label in FUNNEL_STAGES:
-            result.append({"stage": label, "cnt": int(row.get(col) or 0)})
-        return pd.DataFrame(result)
+        return _SqlPlan(sql, {"d_from": date_from, "d_to": date_to, **reg_params}, post=_funnel_stages_frame)
 
     return _empty_funnel_stages_df()
 
 
-def deal_stages(engine, date_from, date_to, region=None, region_list=None, limit=12):
-    reg_filter, reg_params = _region_filter_sql(region=region, region_list=region_list)
+def deal_stages_funnel(engine, date_from, date_to, region=None, region_list=None):
+    """Воронка по этапам. Читает из kpi_daily_region (метрики через SUM колонок).
+    Этапы menedzher_naznachen и vzyato_v_rabotu не хранятся в кэше — всегда 0."""
+    return _execute_plan(engine, _deal_stages_funnel_plan(engine, date_from, date_to, region=region, region_list=region_list))
+
+
+def _deal_stages_plan(engine, date_from, date_to, region=None, region_list=None, limit=12):
     if not cache_is_empty(engine):
-        if isinstance(region_list, (list, tuple)) and len(region_list) > 0:
-            placeholders = ", ".join(f":reg{i}" for i in range(len(region_list)))
-            reg_filter = f"AND s.region IN ({placeholders})"
-            reg_params = {f"reg{i}": r for i, r in enumerate(region_list)}
-        elif region and region != "Все":
-            reg_filter = "AND s.region ILIKE :region"
-            reg_params = {"region": f"%{region}%"}
-        else:
-            reg_filter = ""
-            reg_params = {}
+        plan = _segment_plan(engine, deal_stages, date_from, date_to, region=region, region_list=region_list, limit=limit)
+        if plan is not None:
+            return plan
+        reg_filter, reg_params = _cache_region_filter(engine, region, region_list, col="s.region_id")
+        src, src_params = _grained_source(engine, CACHE_STAGES, date_from, date_to)
         sql = f"""
-        SELECT s.stage, SUM(s.cnt)::int AS cnt
-        FROM {CACHE_STAGES} s
-        WHERE s.day BETWEEN :d_from AND :d_to {reg_filter}
-        GROUP BY s.stage
-        ORDER BY cnt DESC
-        LIMIT :lim
+        WITH top AS (
+          SELECT s.stage_id, SUM(s.cnt)::int AS cnt
+          FROM ({src}) s
+          WHERE TRUE {reg_filter}
+          GROUP BY s.stage_id
+          ORDER BY cnt DESC
+          LIMIT :lim
+        )
+        {_dim_names_sql("stage", "cnt", "cnt DESC")}
         """
-        return run_sql(engine, sql, {"d_from": date_from, "d_to": date_to, "lim": limit, **reg_params})
+        return _SqlPlan(sql, {"d_from": date_from, "d_to": date_to, "lim": limit, **reg_params, **src_params})
     return pd.DataFrame(columns=["stage", "cnt"])
 
 
-def rejection_reasons(engine, date_from, date_to, region=None, region_list=None, limit=15):
-    """Причины отказа за период — только kpi_cache_reasons."""
-    reg_filter, reg_params = _region_filter_sql(region=region, region_list=region_list)
+def deal_stages(engine, date_from, date_to, region=None, region_list=None, limit=12):
+    return _execute_plan(engine, _deal_stages_plan(engine, date_from, date_to, region=region, region_list=region_list, limit=limit))
+
+
+def _rejection_reasons_plan(engine, date_from, date_to, region=None, region_list=None, limit=15):
     if not cache_is_empty(engine):
-        if isinstance(region_list, (list, tuple)) and len(region_list) > 0:
-            placeholders = ", ".join(f":reg{i}" for i in range(len(region_list)))
-            reg_filter = f"AND r.region IN ({placeholders})"
-            reg_params = {f"reg{i}": r for i, r in enumerate(region_list)}
-        elif region and region != "Все":
-            reg_filter = "AND r.region ILIKE :region"
-            reg_params = {"region": f"%{region}%"}
-        else:
-            reg_filter = ""
-            reg_params = {}
+        plan = _segment_plan(engine, rejection_reasons, date_from, date_to, region=region, region_list=region_list, limit=limit)
+        if plan is not None:
+            return plan
+        reg_filter, reg_params = _cache_region_filter(engine, region, region_list, col="r.region_id")
+        src, src_params = _grained_source(engine, CACHE_REASONS, date_from, date_to)
         sql = f"""
-        SELECT r.reason, SUM(r.cnt)::int AS cnt
-        FROM {CACHE_REASONS} r
-        WHERE r.day BETWEEN :d_from AND :d_to {reg_filter}
-        GROUP BY r.reason
-        ORDER BY cnt DESC
-        LIMIT :lim
+        WITH top AS (
+          SELECT r.reason_id, SUM(r.cnt)::int AS cnt
+          FROM ({src}) r
+          WHERE TRUE {reg_filter}
+          GROUP BY r.reason_id
+          ORDER BY cnt DESC
+          LIMIT :lim
+        )
+        {_dim_names_sql("reason", "cnt", "cnt DESC")}
         """
-        return run_sql(engine, sql, {"d_from": date_from, "d_to": date_to, "lim": limit, **reg_params})
+        return _SqlPlan(sql, {"d_from": date_from, "d_to": date_to, "lim": limit, **reg_params, **src_params})
     return pd.DataFrame(columns=["reason", "cnt"])
 
 
+def rejection_reasons(engine, date_from, date_to, region=None, region_list=None, limit=15):
+    """Причины отказа за период — только kpi_cache_reasons."""
+    return _execute_plan(engine, _rejection_reasons_plan(engine, date_from, date_to, region=region, region_list=region_list, limit=limit))
+
+
 def date_bounds(engine):
-    """Границы дат только из kpi_daily_region; пустой кэш — сегодня..сегодня (без «For dash»)."""
-    if not cache_is_empty(engine):
+    """Границы дат kpi_daily_region (из kpi_cache_meta, иначе MIN/MAX); пустой кэш — сегодня..сегодня (без «For dash»)."""
+    meta = _meta_with_stats(engine)
+    if meta is not None and not pd.isna(meta["min_day"]):
+        return pd.DataFrame({"min_d": [meta["min_day"]], "max_d": [meta["max_day"]]})
+    if meta is None and not cache_is_empty(engine):
         try:
             return run_sql(engine, f"SELECT MIN(day) AS min_d, MAX(day) AS max_d FROM {CACHE_TABLE}")
         except Exception:
@@ -1536,8 +3797,11 @@ def date_bounds(engine):
 
 
 def region_list(engine):
-    """Список регионов из kpi_daily_region; пустой кэш — фиксированный список для UI (без «For dash»)."""
-    if not cache_is_empty(engine):
+    """Список регионов kpi_daily_region (из kpi_cache_meta, иначе DISTINCT); пустой кэш — фиксированный список для UI."""
+    meta = _meta_with_stats(engine)
+    if meta is not None and meta["regions"]:
+        return ["Все"] + list(meta["regions"])
+    if meta is None and not cache_is_empty(engine):
         try:
             df = run_sql(engine, f"SELECT DISTINCT region FROM {CACHE_TABLE} WHERE region IS NOT NULL AND TRIM(region) <> '' ORDER BY 1")
             return ["Все"] + df["region"].dropna().astype(str).tolist()
@@ -1546,29 +3810,521 @@ def region_list(engine):
     return ["Все", "Крым", "Сочи", "Анапа", "Баку"]
 
 
+# Части load_bundle — ключи наборов фаз дашборда; фильтр (region, regions) трактуется как в обёртках _cached_*:
+# несколько регионов — kpi/funnel/daily с разбивкой по регионам (kpi_by_region, daily_series_by_region).
+BUNDLE_PHASE1 = ("kpi", "funnel", "daily", "by_region")
+BUNDLE_PHASE2 = ("utm", "landing", "by_formname", "managers", "stages_funnel", "reject_reasons")
+BUNDLE_LIMITS = {"utm": 25, "landing": 30, "by_formname": 30, "managers": 10, "stages": 12, "reject_reasons": 15}
+_BUNDLE_DETAIL_PLANS = {
+    "utm": _by_utm_plan,
+    "landing": _by_landing_plan,
+    "by_formname": _by_formname_plan,
+    "managers": _top_managers_plan,
+    "stages": _deal_stages_plan,
+    "reject_reasons": _rejection_reasons_plan,
+}
+
+
+def _bundle_part_plan(engine, part, date_from, date_to, region, region_list, limit):
+    single = list(region_list) if region_list and len(region_list) == 1 else None
+    per_region = list(region_list) if region_list and len(region_list) > 1 else None
+    if part in ("kpi", "funnel"):
+        if per_region:
+            return _kpi_by_region_plan(engine, date_from, date_to, per_region)
+        return _kpi_extended_plan(engine, date_from, date_to, region=region, region_list=single)
+    if part == "daily":
+        if per_region:
+            return _daily_series_by_region_plan(engine, date_from, date_to, per_region)
+        return _daily_series_plan(engine, date_from, date_to, region=region, region_list=single)
+    if part == "by_region":
+        return _by_region_plan(engine, date_from, date_to)
+    if part == "stages_funnel":
+        return _deal_stages_funnel_plan(engine, date_from, date_to, region=region, region_list=region_list)
+    if part in _BUNDLE_DETAIL_PLANS:
+        return _BUNDLE_DETAIL_PLANS[part](engine, date_from, date_to, region=region, region_list=region_list, limit=limit)
+    raise ValueError(f"неизвестная часть load_bundle: {part}")
+
+
+_PLAN_COLUMNS_LOCK = threading.Lock()
+_PLAN_COLUMNS = {}
+
+
+def _plan_columns(engine, plans) -> list:
+    """[(колонка, OID типа)] для каждого плана. JSON типов Postgres не несёт, а DataFrame должны быть теми же,
+    что у run_sql: описание берётся из LIMIT 0 один раз на текст запроса (форм запросов немного), дальше — из памяти."""
+    keys = [" ".join(plan.sql.split()) for plan in plans]
+    with _PLAN_COLUMNS_LOCK:
+        missing = [(key, plan) for key, plan in zip(keys, plans) if key not in _PLAN_COLUMNS]
+    if missing:
+        with _pooled_connection(engine) as conn:
+            with conn.cursor() as cur:
+                for key, plan in missing:
+                    cur.execute(_NAMED_PARAM_RE.sub(r"%(\1)s", f"SELECT * FROM ({plan.sql}) q LIMIT 0"), plan.params)
+                    columns = [(desc[0], desc[1]) for desc in cur.description]
+                    with _PLAN_COLUMNS_LOCK:
+                        _PLAN_COLUMNS[key] = columns
+            conn.rollback()
+    with _PLAN_COLUMNS_LOCK:
+        return [_PLAN_COLUMNS[key] for key in keys]
+
+
+def _json_frame(rows, columns) -> pd.DataFrame:
+    """Строки json_agg → DataFrame с типами колонок как у _fetch_df (те же _typed_column по OID)."""
+    rows = rows or []
+    data = {}
+    for i, (name, oid) in enumerate(columns):
+        values = [row.get(name) for row in rows]
+        if oid in _PG_DATE_OIDS or oid in _PG_TIMESTAMPTZ_OIDS:
+            # В JSON даты — ISO-строки; psycopg2 отдаёт date/datetime — приводим к тому же, чтобы совпал dtype
+            values = [None if v is None else datetime.fromisoformat(v) for v in values]
+            if oid == 1082:
+                values = [None if v is None else v.date() for v in values]
+        data[i] = _typed_column(values, oid)
+    df = pd.DataFrame(data)
+    df.columns = [name for name, _oid in columns]
+    return df
+
+
+def _run_plans(engine, plans: dict) -> dict:
+    """{имя: план} → {имя: DataFrame}. Все SQL-планы уходят одним statement: каждый — подзапрос
+    (SELECT json_agg(q) FROM (…) q) со своими параметрами (:b<i>_<имя>); одинаковые планы выполняются один раз."""
+    results = {name: plan for name, plan in plans.items() if not isinstance(plan, _SqlPlan)}
+    groups = {}
+    for name, plan in plans.items():
+        if isinstance(plan, _SqlPlan):
+            groups.setdefault((_singleflight_key(engine, plan.sql, plan.params), plan.post), (plan, []))[1].append(name)
+    if groups:
+        unique = [plan for plan, _names in groups.values()]
+        columns = _plan_columns(engine, unique)
+        selects, params = [], {}
+        for i, plan in enumerate(unique):
+            sql = _NAMED_PARAM_RE.sub(rf":b{i}_\1", plan.sql)
+            params.update({f"b{i}_{key}": value for key, value in plan.params.items()})
+            selects.append(f"(SELECT json_agg(q) FROM ({sql}) q) AS b{i}")
+        row = run_sql(engine, "SELECT " + ",\n".join(selects), params).iloc[0]
+        for i, ((plan, names), cols) in enumerate(zip(groups.values(), columns)):
+            df = _json_frame(row[f"b{i}"], cols)
+            df = plan.post(df) if plan.post is not None else df
+            for n, name in enumerate(names):
+                results[name] = df if n == 0 else df.copy()
+    return {name: results[name] for name in plans}
+
+
+def load_bundle(engine, date_from, date_to, regions=None, parts=BUNDLE_PHASE1 + BUNDLE_PHASE2, region=None, limits=None) -> dict:
+    """Несколько наборов дашборда за один round trip: {часть: DataFrame} — те же DataFrame, что у отдельных функций.
+
+    parts — из BUNDLE_PHASE1/BUNDLE_PHASE2 (и "stages"); regions — выбранные регионы (region_list),
+    region — один регион подстрокой (как region= у функций); limits — переопределение BUNDLE_LIMITS.
+    Части, готовые без БД (куб в памяти, пустой кэш), в запрос не попадают; остальные — один SELECT (_run_plans).
+    """
+    limits = {**BUNDLE_LIMITS, **(limits or {})}
+    region_list = tuple(regions) if regions else None
+    plans = {part: _bundle_part_plan(engine, part, date_from, date_to, region, region_list, limits.get(part)) for part in parts}
+    return _run_plans(engine, plans)
+
+
 def load_all_parallel(engine, date_from, date_to, selected_regions):
-    """Только основные данные (kpi, by_region, funnel, daily). UTM, landing и прочие детали грузятся отдельно (progressive loading)."""
-    tasks = {
-        "kpi":       lambda: kpi_extended(engine, date_from, date_to, region_list=selected_regions),
-        "by_region": lambda: kpi_by_region(engine, date_from, date_to, selected_regions),
-        "funnel":    lambda: funnel_by_region(engine, date_from, date_to, selected_regions),
-        "daily":     lambda: daily_series_by_region(engine, date_from, date_to, selected_regions),
+    """Только основные данные (kpi, by_region, funnel, daily) — одним запросом (_run_plans). UTM, landing и прочие
+    детали грузятся отдельно (progressive loading)."""
+    try:
+        plans = {
+            "kpi":       _kpi_extended_plan(engine, date_from, date_to, region_list=selected_regions),
+            "by_region": _kpi_by_region_plan(engine, date_from, date_to, selected_regions),
+            "funnel":    _kpi_by_region_plan(engine, date_from, date_to, selected_regions),
+            "daily":     _daily_series_by_region_plan(engine, date_from, date_to, selected_regions),
+        }
+        return _run_plans(engine, plans)
+    except Exception as e:
+        print(f"[load_all_parallel] ERROR: {e}")
+        return {name: pd.DataFrame() for name in ("kpi", "by_region", "funnel", "daily")}
+
+
+# ── Сравнение двух периодов ───────────────────────────────────────────────────
+# compare(engine, fn, period1, period2): как fn, но по каждой метрике m — m (период 1), m_2 (период 2)
+# и m_delta = m − m_2. Источник — строки обоих периодов с меткой p (детальные — месяцы/недели из свёрток,
+# как у fn), метрики — условная агрегация FILTER (WHERE p = 1 / 2) в одном statement; пересекающиеся
+# периоды считаются честно (строка общего дня попадает в оба). Метрика — (имя, агрегат с {p} вместо условия периода).
+
+
+def _sum_metric(name, col, cast="::int", cond=""):
+    return name, f"COALESCE(SUM({col}) FILTER (WHERE {cond}{{p}}), 0){cast}"
+
+
+def _kpi_compare_metrics(output):
+    return [_sum_metric(name, col, "" if col in _CUBE_MONEY else "::bigint") for name, col in output]
+
+
+# fn → (таблица, (имя ключа, выражение) | None, справочник имени ключа, [метрика], колонка сортировки, [(имя, агрегат)] вне периодов)
+_COMPARE_SPECS = {
+    kpi_extended: (CACHE_TABLE, None, None, _kpi_compare_metrics(_KPI_OUTPUT), None, ()),
+    kpi_by_region: (CACHE_TABLE, ("region", "s.region"), None, _kpi_compare_metrics(_KPI_OUTPUT), "leads", ()),
+    by_region: (CACHE_TABLE, ("region", "COALESCE(s.region, '(не указан)')"), None, _kpi_compare_metrics(_DAILY_OUTPUT), "leads", ()),
+    deal_stages_funnel: (CACHE_TABLE, None, None, _kpi_compare_metrics(_FUNNEL_OUTPUT), None, ()),
+    by_utm: (
+        CACHE_UTM, ("utm_source_id", "s.utm_source_id"), "utm_source",
+        [_sum_metric(name, "s.cnt", cond=f"s.event_type = '{event}' AND ") for name, event in (("leads", "lead"), ("prequals", "prequal"), ("quals", "qual"))],
+        "leads", (),
+    ),
+    by_formname: (
+        CACHE_FORMNAMES, ("formname_id", "s.formname_id"), "formname",
+        [_sum_metric(m, f"s.{m}") for m in ("leads", "quals", "prequals", "passports", "pokaz_naznachen", "pokaz_proveden", "broni")],
+        "leads", (),
+    ),
+    by_landing: (
+        CACHE_LANDING, ("landing_id", "s.landing_id"), "landing",
+        [_sum_metric(m, f"s.{c}") for m, c in (
+            ("leads", "leads"), ("prequals", "prequals"), ("quals", "quals"), ("pokaz_naznachen", "pokaz_naznachen"),
+            ("pokaz_proveden", "pokaz_proveden"), ("passports", "passports"), ("broni", "broni_cnt"),
+        )],
+        "leads", (),
+    ),
+    top_managers: (
+        CACHE_MANAGERS, ("broker_id", "s.broker_id"), None,
+        [_sum_metric(m, f"s.{m}") for m in ("leads", "prequals", "quals")]
+        + [("conv_percent", "ROUND(100.0 * SUM(s.quals) FILTER (WHERE {p}) / NULLIF(SUM(s.leads) FILTER (WHERE {p}), 0), 1)")],
+        "quals", (("broker_name", "MAX(s.broker_name)"),),
+    ),
+    deal_stages: (CACHE_STAGES, ("stage_id", "s.stage_id"), "stage", [_sum_metric("cnt", "s.cnt")], "cnt", ()),
+    rejection_reasons: (CACHE_REASONS, ("reason_id", "s.reason_id"), "reason", [_sum_metric("cnt", "s.cnt")], "cnt", ()),
+}
+_COMPARE_SPECS[funnel_data] = _COMPARE_SPECS[kpi_extended]
+_COMPARE_SPECS[funnel_by_region] = _COMPARE_SPECS[kpi_by_region]
+# Эти fn без куба — SQL; с кубом оба периода считаются в памяти и сводятся _merge_periods
+_CUBE_COMPARABLE = (kpi_extended, funnel_data, kpi_by_region, funnel_by_region, by_region, deal_stages_funnel)
+
+
+def _period_source(engine, table, n, date_from, date_to):
+    """(SQL строк table за период n с колонкой p = n, параметры с префиксом p<n>_)."""
+    if table in _ROLLUP_SPEC:
+        src, params = _grained_source(engine, table, date_from, date_to)
+    else:
+        cols = ", ".join(("region", "region_id", "day", *_CUBE_METRICS))
+        src, params = f"SELECT {cols} FROM {table} WHERE day BETWEEN :d_from AND :d_to", {}
+    params = {**params, "d_from": date_from, "d_to": date_to}
+    src = _NAMED_PARAM_RE.sub(rf":p{n}_\1", src)
+    return f"SELECT {n} AS p, x.* FROM ({src}) x", {f"p{n}_{k}": v for k, v in params.items()}
+
+
+def _compare_sql(engine, spec, period1, period2, region, region_list, limit):
+    table, key, dim, metrics, order, extra = spec
+    sources, params = [], {"lim": limit}
+    for n, (date_from, date_to) in enumerate((period1, period2), start=1):
+        src, src_params = _period_source(engine, table, n, date_from, date_to)
+        sources.append(src)
+        params.update(src_params)
+    reg_filter, reg_params = _cache_region_filter(engine, region, region_list, col="s.region_id")
+    params.update(reg_params)
+    aggregates = [f"{expr} AS {name}" for name, expr in extra]
+    for n in (1, 2):
+        suffix = "" if n == 1 else "_2"
+        aggregates += [f"{expr.replace('{p}', f's.p = {n}')} AS {name}{suffix}" for name, expr in metrics]
+    outputs = [f"a.{name}" for name, _expr in extra]
+    for name, _expr in metrics:
+        outputs += [f"a.{name}", f"a.{name}_2", f"a.{name} - a.{name}_2 AS {name}_delta"]
+    group = f"{key[1]} AS {key[0]},\n            " if key else ""
+    tail = f"GROUP BY {key[1]}\n          ORDER BY {order} DESC, {order}_2 DESC\n          LIMIT :lim" if key else ""
+    if key and dim:
+        head = f"SELECT d.value AS {dim}, "
+        join = f"LEFT JOIN {_dim_table(dim)} d ON d.id = a.{key[0]}"
+    else:
+        head = f"SELECT a.{key[0]}, " if key else "SELECT "
+        join = ""
+    sql = f"""
+        WITH s AS (
+          {" UNION ALL ".join(sources)}
+        ),
+        a AS (
+          SELECT {group}{", ".join(aggregates)}
+          FROM s
+          WHERE TRUE {reg_filter}
+          {tail}
+        )
+        {head}{", ".join(outputs)}
+        FROM a {join}
+        {f"ORDER BY a.{order} DESC, a.{order}_2 DESC" if key else ""}
+        """
+    return sql, params
+
+
+def _merge_periods(df1, df2, key, metrics, sort=True) -> pd.DataFrame:
+    """Два результата fn → колонки m, m_2, m_delta (как у SQL-версии compare); ключ есть не в обоих — нули.
+    sort — по первой метрике периода 1, затем 2; иначе — порядок df1, за ним ключи только из df2 в порядке df2
+    (merge сортирует ключи и при sort=False, поэтому порядок восстанавливается явно)."""
+    names = [name for name, _expr in metrics]
+    if key is None:
+        df = pd.concat([df1[names].reset_index(drop=True), df2[names].add_suffix("_2").reset_index(drop=True)], axis=1)
+    else:
+        df = df1[[key] + names].merge(df2[[key] + names], on=key, how="outer", suffixes=("", "_2"), sort=False)
+        for name in names:
+            for col in (name, f"{name}_2"):
+                df[col] = df[col].fillna(0).astype(df1[name].dtype if len(df1) else df2[name].dtype)
+        order = pd.Index(df1[key]).append(pd.Index(df2[key][~df2[key].isin(df1[key])]))
+        df = df.iloc[np.argsort(order.get_indexer(df[key]), kind="stable")]
+        if sort:
+            df = df.sort_values([names[0], f"{names[0]}_2"], ascending=False, kind="stable")
+        df = df.reset_index(drop=True)
+    out = df[[key]] if key is not None else pd.DataFrame(index=df.index)
+    for name in names:
+        out = out.assign(**{name: df[name], f"{name}_2": df[f"{name}_2"], f"{name}_delta": df[name] - df[f"{name}_2"]})
+    return out
+
+
+def _compare_stages(row) -> pd.DataFrame:
+    """Строка compare по _FUNNEL_OUTPUT → воронка этапов (stage, cnt, cnt_2, cnt_delta), как deal_stages_funnel."""
+    return pd.DataFrame([
+        {"stage": label, "cnt": int(row[col]), "cnt_2": int(row[f"{col}_2"]), "cnt_delta": int(row[col]) - int(row[f"{col}_2"])}
+        for col, label in FUNNEL_STAGES
+    ])
+
+
+def compare(engine, fn, period1, period2, region=None, region_list=None, limit=None) -> pd.DataFrame:
+    """Сравнение двух периодов для функции чтения fn (kpi_extended/funnel_data, kpi_by_region, by_region,
+    deal_stages_funnel и детальных by_utm/by_formname/by_landing/top_managers/deal_stages/rejection_reasons).
+
+    period1, period2 — (date_from, date_to). Колонки — как у fn, но каждая метрика m втроём: m (период 1), m_2,
+    m_delta = m − m_2. Один statement на оба периода (условная агрегация); top-K (limit, по умолчанию — как у fn) —
+    по метрике сортировки fn в периоде 1, затем 2. С кубом KPI-функции считаются в памяти без БД.
+    """
+    spec = _COMPARE_SPECS.get(fn)
+    if spec is None:
+        raise ValueError(f"compare не поддерживает {getattr(fn, '__name__', fn)}")
+    if limit is None:
+        param = inspect.signature(fn).parameters.get("limit")
+        limit = param.default if param is not None else None
+    _table, key, dim, metrics, _order, extra = spec
+    out_key = dim or (key[0] if key else None)
+    if fn in (kpi_by_region, funnel_by_region) and not (isinstance(region_list, (list, tuple)) and len(region_list) > 0):
+        return pd.DataFrame()
+    if fn is by_region:
+        region, region_list = None, None
+    elif fn in (kpi_by_region, funnel_by_region):
+        region = None
+    if fn not in _CUBE_COMPARABLE and cache_is_empty(engine):
+        names = [name for name, _expr in metrics]
+        return pd.DataFrame(columns=[out_key, *(name for name, _expr in extra), *(f"{n}{sfx}" for n in names for sfx in ("", "_2", "_delta"))])
+    if fn in _CUBE_COMPARABLE and (cache_is_empty(engine) or _kpi_cube(engine) is not None):
+        if fn in (kpi_by_region, funnel_by_region):
+            frames = [fn(engine, *period, region_list) for period in (period1, period2)]
+        elif fn is by_region:
+            frames = [fn(engine, *period) for period in (period1, period2)]
+        else:
+            frames = [fn(engine, *period, region=region, region_list=region_list) for period in (period1, period2)]
+        if fn is deal_stages_funnel:
+            return _merge_periods(*frames, "stage", [("cnt", None)], sort=False)
+        return _merge_periods(*frames, out_key, metrics)
+    sql, params = _compare_sql(engine, spec, period1, period2, region, region_list, limit)
+    df = run_sql(engine, sql, params)
+    return _compare_stages(df.iloc[0]) if fn is deal_stages_funnel else df
+
+
+# ── Сегментный кэш по дням ────────────────────────────────────────────────────
+# Ряды по дням и детальные разбивки аддитивны по дням. Строки (блок, ключ, метрики) за день или за полный
+# месяц (из свёртки _month) хранятся в памяти процесса по (fn, id регионов фильтра, зерно) до следующего
+# поколения кэша. Запрос за диапазон дочитывает из БД только недостающие блоки — расширение или сдвиг окна
+# стоит только новых дней; сборка — маска по блокам и groupby в pandas. st.cache_data в UI ключуется точным
+# диапазоном и на промахе приходит сюда.
+
+SEGMENT_CACHE_ENABLED = os.environ.get("KPI_SEGMENT_CACHE", "1") != "0"
+SEGMENT_CACHE_MAX_ENTRIES = 64
+
+# fn → спецификация как у _COMPARE_SPECS: (таблица, ключ, справочник, [метрика], сортировка, [доп. агрегат])
+_SEGMENT_SPECS = {
+    daily_series: (CACHE_TABLE, None, None, _kpi_compare_metrics(_DAILY_OUTPUT), None, ()),
+    daily_series_by_region: (CACHE_TABLE, ("region_id", "s.region_id"), None, _kpi_compare_metrics(_DAILY_OUTPUT), None, ()),
+    **{fn: _COMPARE_SPECS[fn] for fn in (by_utm, by_formname, by_landing, top_managers, deal_stages, rejection_reasons)},
+}
+_SEGMENT_GRAINS = (("day", 1), ("month", 2))
+
+_SEGMENT_LOCK = threading.Lock()
+_SEGMENT_STATE = {"generation": None, "entries": {}, "dims": {}}
+
+
+def _segment_entries(generation):
+    """Записи кэша поколения generation (вызывать под _SEGMENT_LOCK); None — generation уже устарело."""
+    state = _SEGMENT_STATE
+    if state["generation"] is None or generation > state["generation"]:
+        state.update(generation=generation, entries={}, dims={})
+    return state["entries"] if state["generation"] == generation else None
+
+
+def _segment_blocks(date_from, date_to, monthly) -> dict:
+    """{зерно: номера дней (от эпохи) начал блоков} для [date_from, date_to]: полные месяцы (monthly) и остальные дни."""
+    a, b = pd.Timestamp(date_from).date(), pd.Timestamp(date_to).date()
+    parts = {"day": [], "month": []}
+    for grain, d0, d1 in (_grain_segments(a, b) if monthly else [("day", a, b)]):
+        if grain == "month":
+            parts["month"].append(np.arange(np.datetime64(d0, "M"), np.datetime64(d1, "M") + 1).astype("datetime64[D]"))
+        else:
+            last = d1 + timedelta(days=6) if grain == "week" else d1
+            parts["day"].append(np.arange(np.datetime64(d0, "D"), np.datetime64(last, "D") + 1))
+    return {
+        grain: np.sort(np.concatenate(arrays)).astype(np.int64) if arrays else np.empty(0, dtype=np.int64)
+        for grain, arrays in parts.items()
     }
-    results = {}
-    with ThreadPoolExecutor(max_workers=4) as ex:
-        futures = {ex.submit(fn): name for name, fn in tasks.items()}
-        for future in as_completed(futures):
-            name = futures[future]
-            try:
-                results[name] = future.result()
-            except Exception as e:
-                results[name] = pd.DataFrame()
-                print(f"[load_all_parallel] {name} ERROR: {e}")
-    return results
+
+
+def _segment_lookup(generation, entry_key, blocks) -> tuple:
+    """([строки из памяти], {зерно: недостающие блоки})."""
+    rows, missing = [], {}
+    with _SEGMENT_LOCK:
+        entries = _segment_entries(generation)
+        for grain, needed in blocks.items():
+            entry = entries.pop((*entry_key, grain), None) if entries is not None and len(needed) else None
+            if entry is None:
+                missing[grain] = needed
+                continue
+            entries[(*entry_key, grain)] = entry  # LRU: недавно использованные — в конец
+            frame = entry["frame"]
+            rows.append(frame[frame["blk"].isin(needed)])
+            missing[grain] = needed[~np.isin(needed, np.fromiter(entry["covered"], dtype=np.int64))]
+    return rows, missing
+
+
+def _segment_store(generation, entry_key, missing, df) -> pd.DataFrame:
+    """Дописать прочитанные блоки в кэш (пустые дни тоже помечаются прочитанными); вернуть их строки."""
+    codes = df["g"].to_numpy()
+    df = df.drop(columns="g").assign(blk=df["blk"].to_numpy().astype("datetime64[D]").astype(np.int64))
+    # category из _typed_column у разных порций разная — в кэше текст хранится object
+    df = df.astype({c: object for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)})
+    with _SEGMENT_LOCK:
+        entries = _segment_entries(generation)
+        for grain, code in _SEGMENT_GRAINS:
+            blocks = missing[grain]
+            if entries is None or not len(blocks):
+                continue
+            entry = entries.pop((*entry_key, grain), None) or {"frame": df.iloc[:0], "covered": set()}
+            # Параллельный запрос мог уже дописать часть блоков — их строки не дублируем
+            new = [b for b in blocks.tolist() if b not in entry["covered"]]
+            if new:
+                rows = df[(codes == code) & df["blk"].isin(new).to_numpy()]
+                entry["frame"] = pd.concat([entry["frame"], rows], ignore_index=True)
+                entry["covered"].update(new)
+            entries[(*entry_key, grain)] = entry
+        while entries is not None and len(entries) > SEGMENT_CACHE_MAX_ENTRIES:
+            entries.pop(next(iter(entries)))
+    return df
+
+
+def _segment_fetch_sql(spec, reg_filter, monthly) -> str:
+    """Строки (g, blk, ключ, метрики) за дни :seg_days (g = 1) и месяцы :seg_months из свёртки (g = 2)."""
+    table, key, _dim, metrics, _order, extra = spec
+    dims, columns = _ROLLUP_SPEC.get(table, ((), _CUBE_METRICS))
+    cols = ", ".join(("region_id", "day", *dims, *columns))
+    sources = [f"SELECT 1 AS g, {cols} FROM {table} WHERE day = ANY(CAST(:seg_days AS date[]))"]
+    if monthly:
+        sources.append(f"SELECT 2 AS g, {cols} FROM {_rollup_name(table, 'month')} WHERE day = ANY(CAST(:seg_months AS date[]))")
+    select = ["s.g", "s.day AS blk"] + ([f"{key[1]} AS {key[0]}"] if key else [])
+    select += [f"{expr} AS {name}" for name, expr in extra]
+    select += [f"{expr.replace('{p}', 'TRUE')} AS {name}" for name, expr in metrics if name != "conv_percent"]
+    return f"""
+        SELECT {", ".join(select)}
+        FROM ({" UNION ALL ".join(sources)}) s
+        WHERE TRUE {reg_filter}
+        GROUP BY s.g, s.day{f", {key[1]}" if key else ""}
+        """
+
+
+def _segment_dim_values(engine, generation, dim, ids) -> dict:
+    """{id: значение} справочника dim для ids; прочитанные значения — в памяти до следующего поколения."""
+    with _SEGMENT_LOCK:
+        known = dict(_SEGMENT_STATE["dims"].get(dim, {})) if _SEGMENT_STATE["generation"] == generation else {}
+    missing = [i for i in ids if i not in known]
+    if missing:
+        df = run_sql(engine, f"SELECT id, value FROM {_dim_table(dim)} WHERE id = ANY(:ids)", {"ids": missing})
+        fetched = {int(i): str(v) for i, v in zip(df["id"].tolist(), df["value"].tolist())}
+        fetched.update({i: None for i in missing if i not in fetched})
+        known.update(fetched)
+        with _SEGMENT_LOCK:
+            if _SEGMENT_STATE["generation"] == generation:
+                _SEGMENT_STATE["dims"].setdefault(dim, {}).update(fetched)
+    return known
+
+
+def _segment_result(engine, generation, fn, spec, rows, date_from, date_to, region_list, limit) -> pd.DataFrame:
+    """Строки блоков → DataFrame с колонками и типами как у SQL-версии fn."""
+    _table, key, dim, metrics, order, extra = spec
+    names = [name for name, _expr in metrics if name != "conv_percent"]
+    if fn in (daily_series, daily_series_by_region):
+        days = _segment_blocks(date_from, date_to, False)["day"]
+        dates = _typed_column(days.astype("datetime64[D]").tolist(), 1082)
+        if fn is daily_series:
+            sums = rows.groupby("blk")[names].sum().reindex(days, fill_value=0)
+            return pd.DataFrame({"date": dates, **{n: sums[n].to_numpy(np.int64) for n in names}})
+        regions = sorted(dict.fromkeys(region_list))
+        ids = _region_ids(engine)
+        position = pd.Series({ids[r]: j for j, r in enumerate(regions) if r in ids}, dtype=np.int64)
+        grid = np.zeros((len(days), len(regions), len(names)), dtype=np.int64)
+        if len(rows):
+            agg = rows.groupby(["blk", "region_id"])[names].sum().reset_index()
+            np.add.at(grid, ((agg["blk"] - days[0]).to_numpy(), agg["region_id"].map(position).to_numpy()), agg[names].to_numpy(np.int64))
+        grid = grid.reshape(len(days) * len(regions), len(names))
+        return pd.DataFrame({
+            "date": np.repeat(dates, len(regions)),
+            "region": _typed_column(regions * len(days), 25),
+            **{n: grid[:, i] for i, n in enumerate(names)},
+        })
+    aggregations = {**{n: "sum" for n in names}, **{n: "max" for n, _expr in extra}}
+    top = rows.groupby(key[0], dropna=False).agg(aggregations).sort_values(order, ascending=False, kind="stable")
+    top = (top if limit is None else top.head(limit)).reset_index()
+    key_values = [None if pd.isna(v) else int(v) for v in top[key[0]].tolist()]
+    data = {}
+    if dim:
+        values = _segment_dim_values(engine, generation, dim, [i for i in key_values if i is not None])
+        data[dim] = _typed_column([None if i is None else values.get(i) for i in key_values], 25)
+    else:
+        data[key[0]] = _typed_column(key_values, 20)
+    for name, _expr in extra:
+        data[name] = _typed_column([None if pd.isna(v) else v for v in top[name].tolist()], 25)
+    data.update({n: top[n].to_numpy(np.int64) for n in names})
+    if fn is top_managers:
+        leads, quals = data["leads"], data["quals"]
+        # ROUND(numeric, 1) в Postgres — половина от нуля; 1000·q/l точно представимо на границе .5
+        data["conv_percent"] = _typed_column(
+            [None if l == 0 else float(np.floor(1000 * q / l + 0.5)) / 10 for q, l in zip(quals.tolist(), leads.tolist())], 1700
+        )
+    return pd.DataFrame(data)
+
+
+def _segment_plan(engine, fn, date_from, date_to, region=None, region_list=None, limit=None):
+    """План fn через сегментный кэш: DataFrame, если все блоки диапазона уже в памяти, иначе _SqlPlan только
+    за недостающие блоки (post дописывает их в кэш и собирает результат). None — кэш выключен или поколение неизвестно."""
+    if not SEGMENT_CACHE_ENABLED:
+        return None
+    generation = cache_generation(engine)
+    if generation is None:
+        return None
+    spec = _SEGMENT_SPECS[fn]
+    table, key, _dim, _metrics, _order, _extra = spec
+    monthly = table in _ROLLUP_SPEC and _rollups_ready(engine)
+    region_ids = _resolve_region_ids(engine, region=region, region_list=region_list)
+    blocks = _segment_blocks(date_from, date_to, monthly)
+    if not any(len(needed) for needed in blocks.values()):
+        return None
+    entry_key = (fn.__name__, None if region_ids is None else tuple(region_ids))
+    rows, missing = _segment_lookup(generation, entry_key, blocks)
+
+    def result(fetched=None):
+        frames = rows + ([fetched] if fetched is not None else [])
+        return _segment_result(engine, generation, fn, spec, pd.concat(frames, ignore_index=True), date_from, date_to, region_list, limit)
+
+    if not any(len(blocks) for blocks in missing.values()):
+        return result()
+    reg_filter, reg_params = ("", {}) if region_ids is None else ("AND s.region_id = ANY(:region_ids)", {"region_ids": region_ids})
+    params = {
+        "seg_days": missing["day"].astype("datetime64[D]").tolist(),
+        "seg_months": missing["month"].astype("datetime64[D]").tolist(),
+        **reg_params,
+    }
+    if not monthly:
+        params.pop("seg_months")
+    return _SqlPlan(
+        _segment_fetch_sql(spec, reg_filter, monthly), params,
+        post=lambda df: result(_segment_store(generation, entry_key, missing, df)),
+    )
 
 
 # ══════════════════════════════════════════════════════════════════════════════
-# RAW / CTE по «For dash» — только для ETL (INSERT_CACHE_* / refresh_kpi_daily_region), не для UI.
+# RAW / CTE по «For dash» — только для ETL (refresh_kpi_daily_region), не для UI.
 # ══════════════════════════════════════════════════════════════════════════════
 
 def _kpi_extended_raw(engine, date_from, date_to, region=None, region_list=None):
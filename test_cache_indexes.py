@@ -0,0 +1,24 @@
+"""Проверка планов чтения кэша на живой базе: каждое типовое чтение дашборда идёт Index Only Scan без heap.
+
+Нужна SUPABASE_DB_URL (как у дашборда) и заполненный кэш (refresh); без них тест пропускается.
+Запуск: python -m pytest -q test_cache_indexes.py
+"""
+import pytest
+
+import dashboard_supabase_data as data
+
+
+@pytest.fixture(scope="module")
+def engine():
+    engine = data.get_engine()
+    if engine is None:
+        pytest.skip("SUPABASE_DB_URL не задана")
+    return engine
+
+
+def test_cache_reads_are_index_only(engine):
+    plans = data.explain_cache_indexes(engine)
+    if plans.empty:
+        pytest.skip("кэш пуст — сначала refresh_kpi_daily_region()")
+    bad = plans[~plans["ok"].astype(bool)]
+    assert bad.empty, "не Index Only Scan / есть Heap Fetches:\n" + bad.to_string()